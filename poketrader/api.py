@@ -0,0 +1,331 @@
+"""
+This module contains a JSON API for comparisons. Each change answers with the
+updated lists and verdict, so that clients do not need to request the
+comparison again.
+"""
+import functools
+import json
+
+from django.conf import settings
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
+from django.views.decorators.http import (
+    require_GET, require_POST, require_http_methods)
+
+from . import history, matching, transfer
+from .models import ComparisonEvent, Pokemon, PokemonComparison, TradeOffer
+from .pokemon import compare_base_experiences
+from .views import add_pokemons_by_name
+
+# Content types and generators of the lines of each export format.
+EXPORT_FORMATS = {
+    'ndjson': ('application/x-ndjson', transfer.export_ndjson),
+    'csv': ('text/csv', transfer.export_csv),
+}
+
+
+def error_response(message, status=400):
+    return JsonResponse({'error': message}, status=status)
+
+
+def api_login_required(view):
+    """
+    Answers with an error, instead of redirecting to the login page, to
+    requests without a logged in user.
+    """
+    @functools.wraps(view)
+    def wrapper(request, *args, **kwargs):
+        if not request.user.is_authenticated:
+            return error_response('Authentication required.', status=401)
+        return view(request, *args, **kwargs)
+    return wrapper
+
+
+def with_comparison(view):
+    """
+    Replaces the comparison_id argument of a view by the comparison, if it
+    belongs to the logged in user.
+    """
+    @functools.wraps(view)
+    def wrapper(request, comparison_id, *args, **kwargs):
+        comparison = PokemonComparison.objects.filter(
+            id=comparison_id, user=request.user).first()
+        if comparison is None:
+            return error_response('No such comparison.', status=404)
+        return view(request, comparison, *args, **kwargs)
+    return wrapper
+
+
+def comparison_as_dict(comparison):
+    """
+    Returns the lists of a comparison and the verdict on them, as in
+    compare_pokemon_lists(), ready to be encoded as JSON.
+    """
+    list1, list2 = comparison.as_list_of_dicts()
+    return {
+        'id': comparison.id, 'list1': list1, 'list2': list2,
+        'verdict': transfer.get_verdict(comparison)
+    }
+
+
+def parse_request(request, *fields):
+    """
+    Returns the JSON object in the body of a request, or None if it is not
+    an object with all the given fields or has an invalid "pokemon_set".
+    """
+    try:
+        data = json.loads(request.body or '{}')
+    except ValueError:
+        return None
+    if not isinstance(data, dict) or any(f not in data for f in fields):
+        return None
+    if 'pokemon_set' in data:
+        if str(data['pokemon_set']) not in ('1', '2'):
+            return None
+        data['pokemon_set'] = int(data['pokemon_set'])
+    return data
+
+
+@api_login_required
+@require_POST
+def create(request):
+    comparison = PokemonComparison.objects.create(user=request.user)
+    return JsonResponse(comparison_as_dict(comparison), status=201)
+
+
+@api_login_required
+@require_GET
+def export_comparisons(request):
+    """
+    Streams all the comparisons of the user, as NDJSON or, with ?format=csv,
+    as CSV.
+    """
+    export_format = request.GET.get('format', 'ndjson')
+    if export_format not in EXPORT_FORMATS:
+        return error_response('Unknown format.')
+
+    content_type, export = EXPORT_FORMATS[export_format]
+    response = StreamingHttpResponse(
+        export(request.user), content_type=content_type)
+    response['Content-Disposition'] = (
+        'attachment; filename="comparisons.{}"'.format(export_format))
+    return response
+
+
+@api_login_required
+@require_POST
+def import_comparisons(request):
+    """
+    Creates a comparison for each line of an export sent as the body, in
+    NDJSON or, with the text/csv content type, in CSV. Only the lists are
+    read; each comparison gets new ids and totals.
+    """
+    if request.content_type == 'text/csv':
+        records = transfer.read_csv(request)
+    else:
+        records = transfer.read_ndjson(request)
+
+    created, errors = transfer.import_comparisons(request.user, records)
+
+    return JsonResponse({'created': created, 'errors': errors})
+
+
+@api_login_required
+@require_http_methods(['GET', 'DELETE'])
+@with_comparison
+def comparison(request, comparison):
+    if request.method == 'DELETE':
+        matching.withdraw(comparison.id)
+        comparison.delete()
+        return HttpResponse(status=204)
+
+    return JsonResponse(comparison_as_dict(comparison))
+
+
+@api_login_required
+@require_POST
+@with_comparison
+def add(request, comparison):
+    """
+    Adds pokémons, given as in
+
+        {"pokemon_set": 1, "pokemon_names": ["pikachu", "ditto"]}
+
+    to a list. Names that could not be added are given in "errors".
+    """
+    data = parse_request(request, 'pokemon_set', 'pokemon_names')
+    names = data and data['pokemon_names']
+    if not (isinstance(names, list)
+            and all(isinstance(n, str) for n in names)):
+        return error_response('Invalid request.')
+
+    comparison, _, errors = add_pokemons_by_name(
+        request.user, comparison.id, names, data['pokemon_set'])
+
+    return JsonResponse(dict(comparison_as_dict(comparison), errors=errors))
+
+
+@api_login_required
+@require_POST
+@with_comparison
+def remove(request, comparison):
+    """
+    Removes a pokémon from a list by its index, given as in
+
+        {"pokemon_set": 1, "index": 0}
+    """
+    data = parse_request(request, 'pokemon_set', 'index')
+    if data is None or not isinstance(data['index'], int):
+        return error_response('Invalid request.')
+
+    if not comparison.remove_pokemon(data['index'], data['pokemon_set']):
+        return error_response('No such index.')
+
+    return JsonResponse(comparison_as_dict(comparison))
+
+
+@api_login_required
+@require_POST
+@with_comparison
+def reset(request, comparison):
+    """
+    Removes all pokémons from a list, given as in {"pokemon_set": 1}.
+    """
+    data = parse_request(request, 'pokemon_set')
+    if data is None:
+        return error_response('Invalid request.')
+
+    comparison.reset_list(data['pokemon_set'])
+
+    return JsonResponse(comparison_as_dict(comparison))
+
+
+@api_login_required
+@require_POST
+@with_comparison
+def undo(request, comparison):
+    """
+    Undoes the last change to the lists that was not undone yet.
+    """
+    if not history.undo(comparison):
+        return error_response('Nothing to undo.')
+
+    return JsonResponse(comparison_as_dict(comparison))
+
+
+def event_as_dict(version, kind, list_number, position, name, created):
+    event = {'version': version, 'kind': kind, 'created': created.isoformat()}
+    if kind == ComparisonEvent.RESTORE:
+        event['restored_version'] = position
+    elif kind != ComparisonEvent.START:
+        event['pokemon_set'] = list_number
+    if kind in (ComparisonEvent.ADD, ComparisonEvent.REMOVE):
+        event.update(index=position, pokemon=name)
+    return event
+
+
+@api_login_required
+@require_GET
+@with_comparison
+def comparison_history(request, comparison):
+    """
+    Lists the changes to the lists, oldest first, as in
+
+        {"version": 2, "events": [{"version": 1, "kind": "add",
+         "pokemon_set": 1, "index": 0, "pokemon": "ditto", "created": ...}]}
+
+    With ?version=<n>, answers with the lists of that version instead, as
+    in {"version": 1, "list1": ["ditto"], "list2": []}.
+    """
+    if 'version' not in request.GET:
+        events = comparison.events.values_list(
+            'version', 'kind', 'list_number', 'position', 'pokemon__name',
+            'created')
+        return JsonResponse({
+            'version': comparison.version,
+            'events': [event_as_dict(*event) for event in events]
+        })
+
+    try:
+        version = int(request.GET['version'])
+        lists = history.get_lists_at(comparison, version)
+    except ValueError:
+        return error_response('Invalid version.')
+    except history.HistoryUnavailable as e:
+        return error_response(str(e), status=404)
+
+    names = Pokemon.objects.in_bulk(set(lists[0] + lists[1]))
+    return JsonResponse({
+        'version': version,
+        'list1': [names[i].name for i in lists[0]],
+        'list2': [names[i].name for i in lists[1]]
+    })
+
+
+def offer_as_dict(offer, matches):
+    """
+    Returns an offer and its matches, with the names of their pokémons,
+    ready to be encoded as JSON.
+    """
+    ids = set(history.parse_ids(offer.pokemons))
+    for match in matches:
+        ids.update(history.parse_ids(match.other.pokemons))
+    names = dict(Pokemon.objects.filter(pk__in=ids).values_list('id', 'name'))
+
+    def get_names(offer):
+        return [names[i] for i in history.parse_ids(offer.pokemons)
+                if i in names]
+
+    return {
+        'id': offer.id,
+        'pokemons': get_names(offer),
+        'base_experience': offer.base_experience,
+        'wanted_base_experience': offer.wanted_base_experience,
+        'matches': [{
+            'offer': match.other.id,
+            'user': match.other.user.username,
+            'pokemons': get_names(match.other),
+            'base_experience': match.other.base_experience,
+            'wanted_base_experience': match.other.wanted_base_experience,
+            'unfairness': compare_base_experiences(
+                match.other.base_experience, offer.wanted_base_experience,
+                settings.FAIRNESS_THRESHOLD)['unfairness']
+        } for match in matches]
+    }
+
+
+@api_login_required
+@require_http_methods(['GET', 'POST', 'DELETE'])
+@with_comparison
+def offer(request, comparison):
+    """
+    Publishes the first list as a trade offer, or updates it, on POST, for
+    pokémons worth the total base experience given as in
+
+        {"wanted_base_experience": 300}
+
+    or, by default, the total of the second list. Answers with the offer and
+    its matches among the offers of other users, the closest to what it
+    wants first. DELETE withdraws the offer.
+    """
+    if request.method == 'DELETE':
+        if not matching.withdraw(comparison.id):
+            return error_response('No such offer.', status=404)
+        return HttpResponse(status=204)
+
+    if request.method == 'POST':
+        data = parse_request(request)
+        wanted = data.get('wanted_base_experience') if data else None
+        if data is None or not (wanted is None or isinstance(wanted, int)):
+            return error_response('Invalid request.')
+        try:
+            offer = matching.publish(comparison, wanted)
+        except matching.InvalidOffer as e:
+            return error_response(str(e))
+    else:
+        offer = TradeOffer.objects.filter(
+            comparison_id=comparison.id).first()
+        if offer is None:
+            return error_response('No such offer.', status=404)
+
+    matches = list(matching.get_matches(offer))
+    return JsonResponse(offer_as_dict(offer, matches))
@@ -0,0 +1,10 @@
+from django.apps import AppConfig
+
+
+class PoketraderConfig(AppConfig):
+    name = 'poketrader'
+
+    def ready(self):
+        # Connects the receivers that keep trade offers up to date with
+        # their comparisons.
+        from . import matching  # noqa: F401
@@ -0,0 +1,19 @@
+"""
+ASGI config for poketrader project.
+
+It exposes the ASGI callable as a module-level variable named ``application``.
+The views that call the PokéAPI are served asynchronously (see
+settings.ASYNC_VIEWS).
+
+For more information on this file, see
+https://docs.djangoproject.com/en/3.1/howto/deployment/asgi/
+"""
+
+from django.core.asgi import get_asgi_application
+import os
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "poketrader.settings")
+os.environ.setdefault("ASYNC_VIEWS", "1")
+
+
+application = get_asgi_application()
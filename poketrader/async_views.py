@@ -0,0 +1,127 @@
+"""
+This module contains async versions of the views that fetch pokémons from the
+PokéAPI, served instead of the ones in views.py when settings.ASYNC_VIEWS is
+set, as asgi.py does. While they wait for the PokéAPI, the process keeps
+serving other requests.
+"""
+import asyncio
+import functools
+
+from asgiref.sync import sync_to_async
+from django.contrib import messages
+from django.contrib.auth.views import redirect_to_login
+from django.http import (
+    HttpResponse, HttpResponseNotAllowed, HttpResponseRedirect)
+
+from . import views
+from .pokemon import fetch_pokemon_async, normalize_name, APIException
+
+
+def login_required(view):
+    """
+    Same as django.contrib.auth.decorators.login_required(), for async
+    views.
+    """
+    @functools.wraps(view)
+    async def wrapper(request, *args, **kwargs):
+        is_authenticated = await sync_to_async(
+            lambda: request.user.is_authenticated)()
+        if not is_authenticated:
+            return redirect_to_login(request.get_full_path())
+        return await view(request, *args, **kwargs)
+    return wrapper
+
+
+def require_http_methods(methods):
+    """
+    Same as django.views.decorators.http.require_http_methods(), for async
+    views.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        async def wrapper(request, *args, **kwargs):
+            if request.method not in methods:
+                return HttpResponseNotAllowed(methods)
+            return await view(request, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+@login_required
+@require_http_methods(['GET', 'POST'])
+async def comparison(request, comparison_id):
+    if request.method == 'POST':
+        return await handle_comparison_post_request(request, comparison_id)
+    return await sync_to_async(views.handle_comparison_get_request)(
+        request, comparison_id)
+
+
+@login_required
+@require_http_methods(['POST'])
+async def add(request, comparison_id):
+    """
+    Same as views.add().
+    """
+    arguments = views.parse_add_request(request)
+    if isinstance(arguments, HttpResponse):
+        return arguments
+    is_json, list_number, names = arguments
+
+    comparison, added, errors = await add_pokemons_by_name(
+        request.user, comparison_id, names, list_number)
+
+    return views.respond_to_add(request, is_json, comparison, added, errors)
+
+
+async def handle_comparison_post_request(request, comparison_id):
+    pokemon_set = request.POST['pokemon_set']
+    pokemon_name = request.POST['pokemon_name']
+
+    comparison, _, errors = await add_pokemons_by_name(
+        request.user, comparison_id, [pokemon_name], int(pokemon_set))
+
+    for message in errors.values():
+        messages.add_message(
+            request, messages.ERROR, message, extra_tags='danger')
+
+    return HttpResponseRedirect('/comparison/{}'.format(comparison.id))
+
+
+async def add_pokemons_by_name(user, comparison_id, names, list_number):
+    """
+    Same as views.add_pokemons_by_name().
+    """
+    names = [normalize_name(n) for n in names if n.strip()]
+    pokemons, errors = await resolve_pokemons(names)
+    comparison, added = await sync_to_async(views.add_resolved_pokemons)(
+        user, comparison_id, names, pokemons, list_number)
+    return comparison, added, errors
+
+
+async def resolve_pokemons(names):
+    """
+    Same as views.resolve_pokemons(), but fetches all missing pokémons
+    concurrently with fetch_pokemon_async().
+    """
+    pokemons, missing = await sync_to_async(views.find_stored_pokemons)(names)
+    errors = {}
+
+    if not missing:
+        return pokemons, errors
+
+    missing = sorted(missing)
+    results = await asyncio.gather(
+        *(fetch_pokemon_async(name) for name in missing),
+        return_exceptions=True)
+
+    fetched = {}
+    for name, result in zip(missing, results):
+        if isinstance(result, APIException):
+            errors[name] = result.message
+        elif isinstance(result, BaseException):
+            raise result
+        else:
+            fetched[name] = result
+
+    await sync_to_async(views.store_fetched_pokemons)(pokemons, fetched)
+    return pokemons, errors
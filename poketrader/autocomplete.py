@@ -0,0 +1,183 @@
+"""
+This module completes pokémon names as they are typed. Completions come from
+an in-memory trie of the names of the stored pokémons, so each keystroke
+costs a walk down the trie instead of a query, and names mistyped by an edit
+or two are still completed.
+"""
+import threading
+import time
+
+from django.conf import settings
+
+from .models import Pokemon
+from .pokemon import normalize_name
+
+# Longer prefixes are not completed: no pokémon name is nearly that long.
+MAX_PREFIX_LENGTH = 50
+
+
+class Node:
+    """
+    A node of a NameIndex, with the nodes of the names that continue its
+    prefix by each character and the first names starting with its prefix.
+    """
+    __slots__ = ('children', 'names')
+
+    def __init__(self):
+        self.children = {}
+        self.names = []
+
+
+class NameIndex:
+    """
+    A trie of pokémon names. Each node keeps the first `limit` names starting
+    with its prefix, the shortest first, so completing a prefix only takes a
+    walk down the trie:
+
+    >>> index = NameIndex(['pikachu', 'pichu', 'pidgey', 'raichu'], limit=2)
+    >>> index.complete('pi')
+    ['pichu', 'pidgey']
+    >>> index.complete('PIK')
+    ['pikachu']
+    >>> index.complete('charmander')
+    []
+    """
+
+    def __init__(self, names, limit=10):
+        self.limit = limit
+        self.root = Node()
+
+        for name in sorted(set(names), key=lambda n: (len(n), n)):
+            node = self.root
+            self._add_name(node, name)
+            for character in name:
+                node = node.children.setdefault(character, Node())
+                self._add_name(node, name)
+
+    def _add_name(self, node, name):
+        if len(node.names) < self.limit:
+            node.names.append(name)
+
+    @classmethod
+    def from_database(cls):
+        return cls(
+            Pokemon.objects.values_list('name', flat=True),
+            limit=settings.AUTOCOMPLETE_LIMIT)
+
+    def complete(self, prefix):
+        """
+        Returns the first names starting with `prefix`.
+        """
+        node = self.root
+        for character in normalize_name(prefix):
+            node = node.children.get(character)
+            if node is None:
+                return []
+        return list(node.names)
+
+    def suggest(self, prefix, max_distance=None):
+        """
+        Returns the first names starting with `prefix`, followed by the ones
+        starting with a prefix at most `max_distance` insertions, deletions
+        or substitutions away from it, the closest first. Only names with the
+        same first character are suggested:
+
+        >>> index = NameIndex(['pikachu', 'pichu', 'raichu', 'ditto'])
+        >>> index.suggest('pika')
+        ['pikachu']
+        >>> index.suggest('pikz')
+        ['pikachu']
+        >>> index.suggest('pikahcu', max_distance=2)
+        ['pikachu']
+
+        By default, the number of edits allowed grows with the length of the
+        prefix (see get_max_distance()), so short prefixes must be typed
+        right:
+
+        >>> index.suggest('pz')
+        []
+        """
+        prefix = normalize_name(prefix)
+        if max_distance is None:
+            max_distance = get_max_distance(prefix)
+
+        suggestions = self.complete(prefix)
+        if len(suggestions) >= self.limit or not max_distance:
+            return suggestions
+
+        first = self.root.children.get(prefix[0])
+        if first is None:
+            return suggestions
+
+        distances = {}
+        # Rows of the Levenshtein distances from the prefixes of `prefix` to
+        # the prefix of each node, filled in as we walk down the trie, and
+        # pruned where every distance is already too large. The first
+        # character is seldom mistyped, and trusting it saves most of the
+        # walk.
+        pending = [(first, [1] + list(range(len(prefix))))]
+        while pending:
+            node, row = pending.pop()
+            if row[-1] <= max_distance:
+                for name in node.names:
+                    if row[-1] < distances.get(name, max_distance + 1):
+                        distances[name] = row[-1]
+            if min(row) > max_distance:
+                continue
+            for character, child in node.children.items():
+                child_row = [row[0] + 1]
+                for i, expected in enumerate(prefix, 1):
+                    child_row.append(min(
+                        child_row[i - 1] + 1,
+                        row[i] + 1,
+                        row[i - 1] + (character != expected)))
+                pending.append((child, child_row))
+
+        found = set(suggestions)
+        fuzzy = sorted(
+            (name for name in distances if name not in found),
+            key=lambda n: (distances[n], len(n), n))
+        return (suggestions + fuzzy)[:self.limit]
+
+
+def get_max_distance(prefix):
+    """
+    Returns how many edits away from `prefix` suggestions may be: none for
+    prefixes shorter than three characters, one for prefixes shorter than
+    seven and two for longer ones.
+
+    >>> [get_max_distance(p) for p in ('pi', 'pik', 'pikachu')]
+    [0, 1, 2]
+    """
+    if len(prefix) < 3:
+        return 0
+    if len(prefix) < 7:
+        return 1
+    return 2
+
+
+_index = None
+_index_built_at = 0
+_index_lock = threading.Lock()
+
+
+def get_index():
+    """
+    Returns the name index of this process, rebuilding it when it is older
+    than settings.AUTOCOMPLETE_INDEX_TIMEOUT seconds.
+    """
+    global _index, _index_built_at
+
+    with _index_lock:
+        if (_index is None or time.monotonic() - _index_built_at
+                > settings.AUTOCOMPLETE_INDEX_TIMEOUT):
+            _index = NameIndex.from_database()
+            _index_built_at = time.monotonic()
+        return _index
+
+
+def invalidate_index():
+    global _index
+
+    with _index_lock:
+        _index = None
@@ -0,0 +1,212 @@
+"""
+This module measures what the main pages of PokeTrader cost. It generates
+synthetic users, comparisons and pokémons, drives the views through the
+Django test client, with fetch_pokemon() stubbed out, and records the wall
+time, the number of SQL queries and the memory allocated by each scenario.
+"""
+import random
+import statistics
+import time
+import tracemalloc
+from unittest import mock
+
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+
+from .models import Pokemon, PokemonComparison, PokemonListItem
+
+User = get_user_model()
+
+USERNAME_PREFIX = 'benchmark-user-'
+SPECIES_PREFIX = 'benchmon-'
+
+
+def generate_dataset(
+        users=10, comparisons=20, list_size=6, species=200, seed=0):
+    """
+    Creates `users` users with `comparisons` comparisons each, both lists of
+    each comparison with `list_size` pokémons drawn from `species` synthetic
+    ones. The same seed always generates the same data. Returns the users.
+    """
+    rng = random.Random(seed)
+
+    Pokemon.objects.bulk_create([
+        Pokemon(
+            name='{}{:04}'.format(SPECIES_PREFIX, i),
+            base_experience=rng.randint(30, 350),
+            picture_url='https://example.com/{}.png'.format(i))
+        for i in range(species)
+    ], ignore_conflicts=True)
+    pokemon_ids = list(
+        Pokemon.objects.filter(name__startswith=SPECIES_PREFIX)
+        .order_by('name').values_list('id', flat=True)[:species])
+
+    first = User.objects.filter(
+        username__startswith=USERNAME_PREFIX).count()
+    User.objects.bulk_create([
+        User(username='{}{}'.format(USERNAME_PREFIX, first + i))
+        for i in range(users)
+    ])
+    created_users = list(User.objects.filter(username__in=[
+        '{}{}'.format(USERNAME_PREFIX, first + i) for i in range(users)
+    ]).order_by('id'))
+
+    PokemonComparison.objects.bulk_create([
+        PokemonComparison(user=user)
+        for user in created_users for i in range(comparisons)
+    ])
+    comparison_ids = PokemonComparison.objects.filter(
+        user__in=created_users).order_by('id').values_list('id', flat=True)
+
+    PokemonListItem.objects.bulk_create([
+        PokemonListItem(
+            comparison_id=comparison_id, list_number=list_number,
+            position=position, pokemon_id=rng.choice(pokemon_ids))
+        for comparison_id in comparison_ids
+        for list_number in (1, 2)
+        for position in range(list_size)
+    ], batch_size=1000)
+    PokemonComparison.objects.filter(user__in=created_users).repair_totals()
+
+    return created_users
+
+
+def fake_fetch_pokemon(name):
+    return {
+        'name': name.strip().lower(),
+        'base_experience': 100,
+        'picture_url': 'https://example.com/{}.png'.format(name)
+    }
+
+
+async def fake_fetch_pokemon_async(name):
+    return fake_fetch_pokemon(name)
+
+
+def measure(request, setup=None, iterations=20):
+    """
+    Calls `request` `iterations` times, after calling `setup` (unmeasured)
+    if given, and returns the median wall time in seconds, the largest
+    number of SQL queries and the peak memory allocated, in bytes, by a
+    call.
+    """
+    times = []
+    queries = 0
+    for i in range(iterations + 1):
+        arguments = setup() if setup is not None else ()
+        with CaptureQueriesContext(connection) as context:
+            if i < iterations:
+                start = time.perf_counter()
+                request(*arguments)
+                times.append(time.perf_counter() - start)
+            else:
+                # Tracing memory slows everything down, so it gets its
+                # own call.
+                tracemalloc.start()
+                try:
+                    request(*arguments)
+                    _, memory = tracemalloc.get_traced_memory()
+                finally:
+                    tracemalloc.stop()
+        queries = max(queries, len(context.captured_queries))
+
+    return {
+        'wall_time': statistics.median(times),
+        'queries': queries,
+        'memory': memory,
+        'iterations': iterations
+    }
+
+
+def run_scenarios(user, list_size=6, iterations=20):
+    """
+    Runs each scenario as `user`, which should already have comparisons, and
+    returns the measures of each one by name.
+    """
+    client = Client()
+    client.force_login(user)
+    comparison = PokemonComparison.objects.filter(user=user).first()
+    pokemon = Pokemon.objects.filter(name__startswith=SPECIES_PREFIX).first()
+    counter = iter(range(10 ** 9))
+
+    def check(response, status_code):
+        if response.status_code != status_code:
+            raise AssertionError('Got status {} from {}'.format(
+                response.status_code, response.request['PATH_INFO']))
+
+    def new_comparison():
+        new = PokemonComparison.objects.create(user=user)
+        new.add_pokemons([pokemon] * list_size, 1)
+        new.add_pokemons([pokemon] * list_size, 2)
+        return (new.id,)
+
+    def get(path):
+        return lambda *args: check(client.get(path), 200)
+
+    def post(path, data, args_to_path=False):
+        def request(*args):
+            url = path.format(*args) if args_to_path else path
+            check(client.post(url, data), 302)
+        return request
+
+    def add():
+        name = 'new-benchmon-{}'.format(next(counter))
+        check(client.post(
+            '/comparison/{}'.format(comparison.id),
+            {'pokemon_set': '1', 'pokemon_name': name}), 302)
+
+    scenarios = {
+        'index': (get('/'), None),
+        'comparison_get': (
+            get('/comparison/{}'.format(comparison.id)), None),
+        'comparison_post': (add, None),
+        'remove': (post(
+            '/remove/{}', {'pokemon_set': '1', 'index': '0'}, True),
+            new_comparison),
+        'reset': (post(
+            '/reset/{}', {'pokemon_set': '1'}, True), new_comparison),
+        'delete': (post('/delete/{}', {}, True), new_comparison),
+    }
+
+    with mock.patch(
+            'poketrader.views.fetch_pokemon', fake_fetch_pokemon), \
+            mock.patch(
+                'poketrader.async_views.fetch_pokemon_async',
+                fake_fetch_pokemon_async):
+        return {
+            name: measure(request, setup, iterations)
+            for name, (request, setup) in scenarios.items()
+        }
+
+
+def find_regressions(results, baseline, tolerance=0.25):
+    """
+    Compares the results of run_scenarios() to a baseline of previous
+    results. Returns a message for each scenario that makes more queries, or
+    takes more time or memory than the baseline plus the given tolerance:
+
+    >>> baseline = {'index': {'wall_time': 0.01, 'queries': 2, 'memory': 1000}}
+    >>> find_regressions(
+    ...     {'index': {'wall_time': 0.011, 'queries': 2, 'memory': 1100}},
+    ...     baseline)
+    []
+    >>> find_regressions(
+    ...     {'index': {'wall_time': 0.02, 'queries': 3, 'memory': 900}},
+    ...     baseline)
+    ['index: 3 queries, baseline 2', 'index: wall_time 0.02, baseline 0.01']
+    """
+    regressions = []
+    for name, expected in sorted(baseline.items()):
+        if name not in results:
+            continue
+        measured = results[name]
+        if measured['queries'] > expected['queries']:
+            regressions.append('{}: {} queries, baseline {}'.format(
+                name, measured['queries'], expected['queries']))
+        for key in ('wall_time', 'memory'):
+            if measured[key] > expected[key] * (1 + tolerance):
+                regressions.append('{}: {} {:g}, baseline {:g}'.format(
+                    name, key, measured[key], expected[key]))
+    return regressions
@@ -0,0 +1,121 @@
+"""
+This module contains helpers for the data migrations of this app, so that
+they do not lock the tables they change for long. Rows are migrated in
+chunks, in the order of their primary keys, each chunk in its own
+transaction, and the progress is saved with each chunk, so that an
+interrupted migration resumes where it stopped.
+
+Migrations that use migrate_in_chunks() should only run Python code and set
+`atomic = False`; otherwise all chunks are committed together at the end.
+"""
+import logging
+import time
+
+from django.apps.registry import Apps
+from django.db import connections, models, transaction
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+
+class MigrationProgress(models.Model):
+    """
+    How far each chunked data migration got. As with the table of applied
+    migrations, its table is created when first needed, and not by a
+    migration, so that migrations of any state of the app can use it.
+    """
+    name = models.CharField(max_length=255, unique=True)
+    last_id = models.BigIntegerField(default=0)
+    processed = models.BigIntegerField(default=0)
+    finished = models.DateTimeField(null=True)
+
+    class Meta:
+        apps = Apps()
+        app_label = 'poketrader'
+        db_table = 'poketrader_migrationprogress'
+
+
+def ensure_progress_table(schema_editor):
+    connection = schema_editor.connection
+    if (MigrationProgress._meta.db_table
+            not in connection.introspection.table_names()):
+        schema_editor.create_model(MigrationProgress)
+
+
+def migrate_in_chunks(
+        schema_editor, name, queryset, migrate_chunk, chunk_size=1000):
+    """
+    Calls migrate_chunk(ids) with the primary keys of each chunk of up to
+    `chunk_size` rows of `queryset`, in order. Each call runs in a
+    transaction that also saves the progress of the migration called `name`.
+
+    If the migration was interrupted, it resumes after the last chunk
+    committed, and if it finished, it is not run again (see
+    forget_progress()). The rows migrated and their rate are logged after
+    each chunk.
+
+    Returns the number of rows migrated by this call.
+    """
+    ensure_progress_table(schema_editor)
+    using = schema_editor.connection.alias
+    progress, _ = MigrationProgress.objects.using(using).get_or_create(
+        name=name)
+    if progress.finished:
+        logger.info('%s already finished.', name)
+        return 0
+    if progress.last_id:
+        logger.info(
+            '%s resumed after %d rows, from id %d.',
+            name, progress.processed, progress.last_id)
+
+    queryset = queryset.using(using).order_by('pk')
+    started = time.monotonic()
+    migrated = 0
+    while True:
+        ids = list(queryset.filter(pk__gt=progress.last_id).values_list(
+            'pk', flat=True)[:chunk_size])
+        if not ids:
+            break
+
+        with transaction.atomic(using=using):
+            migrate_chunk(ids)
+            progress.last_id = ids[-1]
+            progress.processed += len(ids)
+            progress.save(using=using)
+
+        migrated += len(ids)
+        logger.info(
+            '%s: %d rows migrated (%.0f rows/s).', name, progress.processed,
+            migrated / max(time.monotonic() - started, 1e-6))
+
+    progress.finished = timezone.now()
+    progress.save(using=using)
+    if migrated:
+        logger.info(
+            '%s finished: %d rows in %.1f s.',
+            name, progress.processed, time.monotonic() - started)
+    return migrated
+
+
+def forget_progress(schema_editor, name):
+    """
+    Forgets the progress of a migration, so that it runs again from the
+    start, as it should after it is reversed.
+    """
+    ensure_progress_table(schema_editor)
+    MigrationProgress.objects.using(schema_editor.connection.alias).filter(
+        name=name).delete()
+
+
+def bulk_create_with_ids(model, objects, using='default'):
+    """
+    Inserts the objects of a model, setting their ids. The objects are
+    inserted in bulk on databases that return the ids of rows inserted in
+    bulk, and one by one on the others.
+    """
+    if connections[using].features.can_return_rows_from_bulk_insert:
+        model._base_manager.using(using).bulk_create(objects)
+    else:
+        for obj in objects:
+            obj.save(using=using, force_insert=True)
+    return objects
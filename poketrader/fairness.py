@@ -0,0 +1,108 @@
+"""
+This module evaluates the fairness of many comparisons at once, with NumPy
+arrays, for when re-scoring them one by one with compare_pokemon_lists()
+would be too slow.
+"""
+import numpy as np
+from django.conf import settings
+
+from .models import PokemonComparison
+
+
+def compare_base_experience_arrays(
+        base_experience1, base_experience2, fairness_threshold=0.1):
+    """
+    Compares many pairs of total base experiences, as
+    compare_base_experiences() does, at once:
+
+    >>> result = compare_base_experience_arrays([213, 0, 100], [126, 126, 95])
+    >>> result['difference']
+    array([  87, -126,    5])
+    >>> result['unfairness'].round(2)
+    array([0.69,  nan, 0.05])
+    >>> result['fair']
+    array([False, False,  True])
+    >>> result['success']
+    array([ True, False,  True])
+    """
+    base_experience1 = np.asarray(base_experience1, dtype=np.int64)
+    base_experience2 = np.asarray(base_experience2, dtype=np.int64)
+    success = (base_experience1 > 0) & (base_experience2 > 0)
+    difference = base_experience1 - base_experience2
+    smaller_base_experience = np.minimum(base_experience1, base_experience2)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        unfairness = np.where(
+            success, np.abs(difference) / smaller_base_experience, np.nan)
+
+    return {
+        'base_experience1': base_experience1,
+        'base_experience2': base_experience2,
+        'difference': difference,
+        'unfairness': unfairness,
+        # NaN is never smaller or equal to anything, as in the scalar version
+        'fair': unfairness <= fairness_threshold,
+        'success': success
+    }
+
+
+def iter_base_experience_chunks(queryset=None, chunk_size=10000):
+    """
+    Streams the ids and stored totals of the comparisons in the queryset (all
+    comparisons, shard by shard, by default), in chunks ordered by id. Each
+    chunk is an array with one row of id, base_experience1 and
+    base_experience2 per comparison.
+    """
+    if queryset is None:
+        for using in settings.DATABASE_SHARDS:
+            yield from iter_base_experience_chunks(
+                PokemonComparison.objects.using(using), chunk_size)
+        return
+    queryset = queryset.order_by('id').values_list(
+        'id', 'base_experience1', 'base_experience2')
+
+    last_id = 0
+    while True:
+        rows = list(queryset.filter(id__gt=last_id)[:chunk_size])
+        if not rows:
+            break
+        yield np.array(rows, dtype=np.int64)
+        last_id = rows[-1][0]
+
+
+def evaluate_comparisons(
+        queryset=None, fairness_threshold=0.1, chunk_size=10000):
+    """
+    Evaluates the comparisons in the queryset chunk by chunk, yielding the
+    ids of each chunk and the result of compare_base_experience_arrays().
+    """
+    for chunk in iter_base_experience_chunks(queryset, chunk_size):
+        yield chunk[:, 0], compare_base_experience_arrays(
+            chunk[:, 1], chunk[:, 2], fairness_threshold=fairness_threshold)
+
+
+def sweep_thresholds(thresholds, queryset=None, chunk_size=10000):
+    """
+    Counts how many comparisons would be fair under each threshold. Returns
+    the number of comparisons, the number of them that cannot be compared
+    (because a list is empty), and an array with the number of comparisons
+    whose unfairness falls in the interval up to each threshold, sorted.
+
+    The number of fair comparisons for each threshold is thus the cumulative
+    sum of the last array.
+    """
+    thresholds = np.sort(np.asarray(thresholds, dtype=np.float64))
+    in_interval = np.zeros(len(thresholds), dtype=np.int64)
+    total = unsuccessful = 0
+
+    for ids, result in evaluate_comparisons(queryset, chunk_size=chunk_size):
+        success = result['success']
+        total += len(ids)
+        unsuccessful += np.count_nonzero(~success)
+        # Index of the smallest threshold under which each one is fair.
+        indices = np.searchsorted(
+            thresholds, result['unfairness'][success], side='left')
+        in_interval += np.bincount(
+            indices, minlength=len(thresholds) + 1)[:len(thresholds)]
+
+    return total, unsuccessful, in_interval
@@ -0,0 +1,142 @@
+"""
+This module tells the past lists of comparisons, and undoes their changes,
+from the log of events that every change appends (see ComparisonEvent). The
+lists of a version are rebuilt from the latest snapshot of the comparison
+before it, by replaying the events after the snapshot. Snapshots are saved
+when rebuilding the lists took more than settings.HISTORY_SNAPSHOT_INTERVAL
+events, so that changes only ever append events, and rebuilding the same
+versions is quick the next time.
+"""
+from django.conf import settings
+from django.db import router
+from django.db.models import Max
+
+from .models import ComparisonEvent, ComparisonSnapshot, Pokemon
+
+
+class HistoryUnavailable(Exception):
+    pass
+
+
+def replay(lists, events):
+    """
+    Applies events, given as (kind, list_number, position, pokemon_id)
+    tuples, to a pair of lists of pokémon ids:
+
+    >>> lists = ([25, 132], [])
+    >>> replay(lists, [
+    ...     ('add', 2, 0, 151), ('remove', 1, 0, 25), ('add', 1, 1, 25),
+    ...     ('reset', 2, None, None)])
+    >>> lists
+    ([132, 25], [])
+    """
+    for kind, list_number, position, pokemon_id in events:
+        if kind == ComparisonEvent.ADD:
+            lists[list_number - 1].insert(position, pokemon_id)
+        elif kind == ComparisonEvent.REMOVE:
+            del lists[list_number - 1][position]
+        elif kind == ComparisonEvent.RESET:
+            lists[list_number - 1].clear()
+
+
+def format_ids(ids):
+    """
+    >>> format_ids([25, 132])
+    '25,132'
+    """
+    return ','.join(str(i) for i in ids)
+
+
+def parse_ids(value):
+    """
+    >>> parse_ids('25,132'), parse_ids('')
+    ([25, 132], [])
+    """
+    return [int(i) for i in value.split(',') if i]
+
+
+def get_lists_at(comparison, version):
+    """
+    Returns the ids of the pokémons in each list of a comparison at a
+    version, with two or three queries, and saves a snapshot of them if that
+    took replaying many events. Raises HistoryUnavailable for versions from
+    before the log of the comparison started, or after its current one.
+    """
+    if not 0 <= version <= comparison.version:
+        raise HistoryUnavailable('No such version.')
+
+    events = comparison.events.filter(version__lte=version)
+    snapshot = comparison.snapshots.filter(
+        version__lte=version).order_by('-version').first()
+    if snapshot is None:
+        lists = ([], [])
+    else:
+        lists = parse_ids(snapshot.list1), parse_ids(snapshot.list2)
+        events = events.filter(version__gt=snapshot.version)
+
+    events = list(events.order_by('version', 'id').values_list(
+        'kind', 'list_number', 'position', 'pokemon'))
+    if snapshot is None and not any(
+            event[0] == ComparisonEvent.START for event in events):
+        if comparison.events.filter(kind=ComparisonEvent.START).exists():
+            raise HistoryUnavailable('The history starts after that version.')
+
+    replay(lists, events)
+
+    if len(events) > settings.HISTORY_SNAPSHOT_INTERVAL:
+        # The comparison may have been read from a replica, which is not
+        # written to.
+        using = router.db_for_write(ComparisonSnapshot, instance=comparison)
+        ComparisonSnapshot.objects.using(using).bulk_create([
+            ComparisonSnapshot(
+                comparison=comparison, version=version,
+                list1=format_ids(lists[0]), list2=format_ids(lists[1]))
+        ], ignore_conflicts=True)
+    return lists
+
+
+def get_undo_version(comparison):
+    """
+    Returns the version that undo() would restore the lists of a comparison
+    to, or None if there is nothing to undo. Undoing a change that restored
+    an older version goes back to the version before that one.
+    """
+    events = comparison.events.order_by()
+    version = comparison.version
+    while True:
+        last = events.filter(version__lte=version).aggregate(
+            last=Max('version'))['last']
+        if last is None:
+            return None
+        marker = events.filter(version=last, kind__in=[
+            ComparisonEvent.RESTORE, ComparisonEvent.START]).first()
+        if marker is None:
+            return last - 1
+        if marker.kind == ComparisonEvent.START:
+            return None
+        version = marker.position
+
+
+def restore(comparison, version):
+    """
+    Replaces the lists of a comparison by the ones of an older version, as a
+    new change.
+    """
+    lists = get_lists_at(comparison, version)
+    pokemons = Pokemon.objects.in_bulk(set(lists[0] + lists[1]))
+    comparison.replace_lists({
+        list_number: [pokemons[i] for i in ids]
+        for list_number, ids in enumerate(lists, 1)
+    }, restored_version=version)
+
+
+def undo(comparison):
+    """
+    Undoes the last change to a comparison that was not undone yet. Returns
+    False if there is nothing to undo.
+    """
+    version = get_undo_version(comparison)
+    if version is None:
+        return False
+    restore(comparison, version)
+    return True
@@ -0,0 +1,79 @@
+"""
+Measures the main scenarios of PokeTrader against a throwaway test database
+and reports the results as JSON. With --baseline, fails if any scenario got
+worse than in a previous report.
+
+Pages are rendered with the configured static files storage, so run
+collectstatic first.
+"""
+import json
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import get_runner
+from django.conf import settings
+
+from poketrader.benchmarks import (
+    generate_dataset, run_scenarios, find_regressions)
+
+
+class Command(BaseCommand):
+    help = 'Measures wall time, SQL queries and memory of the main pages.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=10)
+        parser.add_argument(
+            '--comparisons', type=int, default=100,
+            help='Number of comparisons of each user.')
+        parser.add_argument(
+            '--list-size', type=int, default=6,
+            help='Number of pokémons in each list.')
+        parser.add_argument('--iterations', type=int, default=20)
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument(
+            '--output', help='File to write the results to, as JSON.')
+        parser.add_argument(
+            '--baseline',
+            help='Results of a previous run to check for regressions.')
+        parser.add_argument(
+            '--tolerance', type=float, default=0.25,
+            help='Fraction of extra time and memory allowed over the '
+                 'baseline.')
+
+    def handle(self, *args, users, comparisons, list_size, iterations, seed,
+               output, baseline, tolerance, **options):
+        runner = get_runner(settings)(verbosity=0, interactive=False)
+        runner.setup_test_environment()
+        old_config = runner.setup_databases()
+        try:
+            dataset_users = generate_dataset(
+                users=users, comparisons=comparisons, list_size=list_size,
+                seed=seed)
+            results = run_scenarios(
+                dataset_users[0], list_size=list_size, iterations=iterations)
+        finally:
+            runner.teardown_databases(old_config)
+            runner.teardown_test_environment()
+
+        report = {
+            'dataset': {
+                'users': users, 'comparisons': comparisons,
+                'list_size': list_size, 'seed': seed
+            },
+            'scenarios': results
+        }
+
+        if output:
+            with open(output, 'w') as f:
+                json.dump(report, f, indent=2, sort_keys=True)
+        else:
+            json.dump(report, self.stdout, indent=2, sort_keys=True)
+            self.stdout.write('')
+
+        if baseline:
+            with open(baseline) as f:
+                regressions = find_regressions(
+                    results, json.load(f)['scenarios'], tolerance=tolerance)
+            if regressions:
+                raise CommandError(
+                    'Performance regressions:\n' + '\n'.join(regressions))
@@ -0,0 +1,33 @@
+"""
+Fills the database with synthetic users, comparisons and pokémons, as the
+benchmark command does, for profiling the pages by hand.
+"""
+from django.core.management.base import BaseCommand
+
+from poketrader.benchmarks import generate_dataset
+
+
+class Command(BaseCommand):
+    help = 'Generates synthetic users, comparisons and pokémons.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=10)
+        parser.add_argument(
+            '--comparisons', type=int, default=20,
+            help='Number of comparisons of each user.')
+        parser.add_argument(
+            '--list-size', type=int, default=6,
+            help='Number of pokémons in each list.')
+        parser.add_argument(
+            '--species', type=int, default=200,
+            help='Number of synthetic pokémons to draw from.')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, users, comparisons, list_size, species, seed,
+               **options):
+        created = generate_dataset(
+            users=users, comparisons=comparisons, list_size=list_size,
+            species=species, seed=seed)
+
+        self.stdout.write('Created users {}.'.format(
+            ', '.join(u.username for u in created)))
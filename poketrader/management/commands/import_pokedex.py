@@ -0,0 +1,152 @@
+"""
+Loads the pokémon catalog from local dumps of the PokéAPI, so that pokémons
+can be added to comparisons without calling the PokéAPI.
+
+Two formats are accepted:
+
+* CSV files, such as data/v2/csv/pokemon.csv from the PokéAPI repository,
+  with an "identifier" (or "name") column, a "base_experience" column and
+  either a "picture_url" column or an "id" column, from which the sprite URL
+  is derived;
+* JSON files with a list of pokémons as returned by /api/v2/pokemon/<name>
+  (or with the same flat fields as the CSV files). A JSON object with the
+  list under "results" is accepted, too.
+"""
+import csv
+import json
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from poketrader.models import Pokemon
+from poketrader.pokemon import normalize_name
+from poketrader.sharding import replicate_catalog
+
+SPRITE_URL = (
+    'https://raw.githubusercontent.com/PokeAPI/sprites/master/sprites/'
+    'pokemon/{}.png')
+
+
+def read_records(path):
+    """
+    Reads the pokémon records of a CSV or JSON dump, depending on the
+    extension of the file.
+    """
+    extension = os.path.splitext(path)[1].lower()
+
+    with open(path, encoding='utf-8', newline='') as f:
+        if extension == '.csv':
+            yield from csv.DictReader(f)
+        elif extension == '.json':
+            data = json.load(f)
+            if isinstance(data, dict):
+                data = data.get('results', [data])
+            yield from data
+        else:
+            raise CommandError(
+                'Unknown pokédex dump format: {}'.format(path))
+
+
+def parse_record(record):
+    """
+    Extracts the fields of our Pokemon model from a record of the dump.
+    Returns None if the record lacks any of them, or has a base experience
+    that is not a number.
+
+    >>> parse_record({'identifier': 'Pikachu', 'id': '25',
+    ...               'base_experience': '112'})  # doctest: +ELLIPSIS
+    {'name': 'pikachu', 'base_experience': 112, 'picture_url': '.../25.png'}
+    >>> parse_record({'name': 'ditto', 'base_experience': 101,
+    ...               'sprites': {'front_default': 'http://x/132.png'}})
+    {'name': 'ditto', 'base_experience': 101, 'picture_url': 'http://x/132.png'}
+    >>> parse_record({'identifier': 'pikachu-gmax', 'base_experience': ''})
+    >>> parse_record({'identifier': 'pikachu', 'id': '25',
+    ...               'base_experience': 'unknown'})
+    """
+    name = record.get('name') or record.get('identifier')
+    base_experience = record.get('base_experience')
+    picture_url = (
+        record.get('picture_url')
+        or (record.get('sprites') or {}).get('front_default'))
+    if not picture_url and record.get('id'):
+        picture_url = SPRITE_URL.format(record['id'])
+
+    if not name or base_experience in (None, '') or not picture_url:
+        return None
+    try:
+        base_experience = int(base_experience)
+    except (TypeError, ValueError):
+        return None
+
+    return {
+        'name': normalize_name(name),
+        'base_experience': base_experience,
+        'picture_url': picture_url
+    }
+
+
+def chunks(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+class Command(BaseCommand):
+    help = 'Imports the pokémon catalog from local PokéAPI dumps.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('paths', nargs='+', metavar='path')
+        parser.add_argument(
+            '--batch-size', type=int, default=500,
+            help='Number of pokémons written by each batch of queries.')
+
+    def handle(self, *args, paths, batch_size, **options):
+        created = updated = skipped = 0
+
+        for path in paths:
+            records = (parse_record(r) for r in read_records(path))
+            for chunk in chunks(records, batch_size):
+                valid = {r['name']: r for r in chunk if r is not None}
+                skipped += len(chunk) - len(valid)
+                c, u = self.upsert(valid)
+                created += c
+                updated += u
+
+        # Copies the catalog to the other shards, if comparisons are sharded.
+        replicate_catalog()
+
+        self.stdout.write(
+            '{} pokémons created, {} updated, {} skipped.'.format(
+                created, updated, skipped))
+
+    @transaction.atomic
+    def upsert(self, records):
+        """
+        Creates or updates the pokémons in `records`, a dict from names to
+        fields, with three queries.
+        """
+        existing = Pokemon.objects.filter(name__in=records).in_bulk(
+            field_name='name')
+
+        changed = []
+        for name, pokemon in existing.items():
+            record = records[name]
+            if (pokemon.base_experience, pokemon.picture_url) != (
+                    record['base_experience'], record['picture_url']):
+                pokemon.base_experience = record['base_experience']
+                pokemon.picture_url = record['picture_url']
+                changed.append(pokemon)
+        Pokemon.objects.bulk_update(
+            changed, ['base_experience', 'picture_url'])
+
+        Pokemon.objects.bulk_create(
+            Pokemon(**record) for name, record in records.items()
+            if name not in existing)
+
+        return len(records) - len(existing), len(changed)
@@ -0,0 +1,39 @@
+"""
+Matches the trade offers again (see poketrader.matching): by default, the
+ones marked as stale by changes to other offers, one by one, or, with --all,
+every offer at once, such as after changing settings.FAIRNESS_THRESHOLD or
+settings.TRADE_MATCH_LIMIT.
+"""
+import time
+
+from django.core.management.base import BaseCommand
+
+from poketrader.matching import match_all, rematch
+from poketrader.models import TradeOffer
+
+
+class Command(BaseCommand):
+    help = 'Finds the matches of the trade offers again.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--all', action='store_true', dest='all_offers',
+            help='Match every offer, not only the stale ones.')
+        parser.add_argument(
+            '--batch-size', type=int, default=500,
+            help='Number of matches, or offers, written by each '
+                 'query, with --all.')
+
+    def handle(self, *args, all_offers, batch_size, **options):
+        started = time.monotonic()
+        if all_offers:
+            offers, matches = match_all(batch_size=batch_size)
+        else:
+            offers = matches = 0
+            for offer in TradeOffer.objects.filter(stale=True).iterator():
+                matches += len(rematch(offer))
+                offers += 1
+
+        self.stdout.write(
+            '{} offers matched, with {} matches, in {:.1f} s.'.format(
+                offers, matches, time.monotonic() - started))
@@ -0,0 +1,57 @@
+"""
+Downloads the pictures of the stored pokémons into the local sprite mirror,
+so that pages do not need to wait for the pictures to be mirrored on demand.
+"""
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+
+from poketrader.models import Pokemon
+from poketrader.sharding import replicate_catalog
+from poketrader.sprites import get_session, fetch_sprite, SpriteUnavailable
+
+
+class Command(BaseCommand):
+    help = 'Mirrors the pictures of the stored pokémons locally.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--all', action='store_true', dest='include_mirrored',
+            help='Download the pictures of pokémons already mirrored, too.')
+        parser.add_argument(
+            '--workers', type=int, default=8,
+            help='Number of concurrent downloads.')
+
+    def handle(self, *args, include_mirrored, workers, **options):
+        pokemons = Pokemon.objects.exclude(picture_url='').order_by('id')
+        if not include_mirrored:
+            pokemons = pokemons.filter(sprite='')
+
+        session = get_session()
+
+        def fetch(pokemon):
+            try:
+                return fetch_sprite(pokemon, session)
+            except SpriteUnavailable as e:
+                return str(e)
+
+        # Only downloads run in threads. Pokémons are saved here, in batches.
+        mirrored = []
+        failed = 0
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            pokemons = list(pokemons)
+            for pokemon, result in zip(
+                    pokemons, executor.map(fetch, pokemons)):
+                if isinstance(result, str):
+                    failed += 1
+                    self.stderr.write(result)
+                else:
+                    pokemon.sprite, pokemon.thumbnail = result
+                    mirrored.append(pokemon)
+
+        Pokemon.objects.bulk_update(
+            mirrored, ['sprite', 'thumbnail'], batch_size=500)
+        replicate_catalog([p.pk for p in mirrored])
+
+        self.stdout.write('Mirrored {} sprites, {} failed.'.format(
+            len(mirrored), failed))
@@ -0,0 +1,92 @@
+"""
+Deletes the list items left behind by older versions, which kept the lists
+in many-to-many tables and never deleted the items removed from them. Such
+items have no comparison.
+"""
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import DatabaseError, connection
+
+from poketrader.models import PokemonListItem
+
+
+def get_table_size(table):
+    """
+    Returns the bytes used by a table and its indexes, or None if the
+    database cannot tell.
+    """
+    if connection.vendor == 'postgresql':
+        query = 'SELECT pg_total_relation_size(%s::regclass)'
+    elif connection.vendor == 'sqlite':
+        # Needs SQLite to be built with the dbstat virtual table.
+        query = (
+            'SELECT SUM(pgsize) FROM dbstat WHERE name IN '
+            '(SELECT name FROM sqlite_master WHERE tbl_name = %s)')
+    else:
+        return None
+
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(query, [table])
+            return cursor.fetchone()[0]
+    except DatabaseError:
+        return None
+
+
+class Command(BaseCommand):
+    help = 'Deletes the list items that belong to no comparison.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=1000,
+            help='Number of items deleted by each query.')
+        parser.add_argument(
+            '--max-rate', type=float, default=5000,
+            help='Most items deleted per second, to spare the database. '
+                 '0 means no limit.')
+        parser.add_argument(
+            '--dry-run', action='store_true',
+            help='Only report the items that would be deleted.')
+
+    def handle(self, *args, batch_size, max_rate, dry_run, **options):
+        table = PokemonListItem._meta.db_table
+        orphans = PokemonListItem.objects.filter(comparison__isnull=True)
+        total = PokemonListItem.objects.count()
+        size = get_table_size(table)
+
+        if dry_run:
+            deleted = orphans.count()
+        else:
+            deleted = self.purge(orphans, batch_size, max_rate)
+
+        message = '{} orphaned items {} of {}'.format(
+            deleted, 'found' if dry_run else 'deleted', total)
+        if size is not None and total:
+            # Deleted rows are left as free space in the table, for new rows
+            # to reuse, until the table is vacuumed, so their share of the
+            # table is a better measure than its size after deleting them.
+            message += ', about {:.1f} kB of the {:.1f} kB used by {}'.format(
+                size * deleted / total / 1024, size / 1024, table)
+        self.stdout.write(message + '.')
+
+    def purge(self, orphans, batch_size, max_rate):
+        deleted = 0
+        last_id = 0
+        started = time.monotonic()
+
+        while True:
+            ids = list(orphans.filter(id__gt=last_id).order_by('id')
+                       .values_list('id', flat=True)[:batch_size])
+            if not ids:
+                break
+
+            deleted += orphans.filter(
+                id__gte=ids[0], id__lte=ids[-1]).delete()[0]
+            last_id = ids[-1]
+
+            if max_rate:
+                time.sleep(max(
+                    0, deleted / max_rate - (time.monotonic() - started)))
+
+        return deleted
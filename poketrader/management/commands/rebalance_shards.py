@@ -0,0 +1,92 @@
+"""
+Moves the users whose comparisons are not on the shard they hash to, such as
+after a shard is added, to that shard (see poketrader.sharding). The pokémon
+catalog is copied to every shard first, so run this command after migrating
+a new shard, before it gets users.
+"""
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import DEFAULT_DB_ALIAS
+
+from poketrader.models import PokemonComparison, UserShard
+from poketrader.sharding import (
+    get_placement, get_user_shard, move_user, replicate_catalog)
+
+
+def iter_placements(batch_size=1000):
+    """
+    Yields the id and the shard of each user with comparisons, in batches:
+    first the users placed on a shard, and then the ones with comparisons
+    from before sharding was enabled, which are in the default database.
+    """
+    entries = UserShard.objects.using(DEFAULT_DB_ALIAS).order_by('user_id')
+    last_id = 0
+    while True:
+        batch = list(entries.filter(user_id__gt=last_id).values_list(
+            'user_id', 'shard')[:batch_size])
+        if not batch:
+            break
+        yield from batch
+        last_id = batch[-1][0]
+
+    unplaced = PokemonComparison.objects.using(DEFAULT_DB_ALIAS).exclude(
+        user_id__in=entries.values('user_id')).order_by(
+            'user_id').values_list('user_id', flat=True).distinct()
+    last_id = 0
+    while True:
+        batch = list(unplaced.filter(user_id__gt=last_id)[:batch_size])
+        if not batch:
+            break
+        for user_id in batch:
+            yield user_id, DEFAULT_DB_ALIAS
+        last_id = batch[-1]
+
+
+class Command(BaseCommand):
+    help = 'Moves users to the shard they belong to.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=500,
+            help='Number of comparisons copied by each transaction.')
+        parser.add_argument(
+            '--max-users', type=int, default=0,
+            help='Most users moved, to spread a rebalancing over several '
+                 'runs. 0 means no limit.')
+        parser.add_argument(
+            '--dry-run', action='store_true',
+            help='Only report the users that would be moved.')
+
+    def handle(self, *args, batch_size, max_users, dry_run, **options):
+        if not dry_run:
+            copied = replicate_catalog()
+            self.stdout.write('{} pokémons copied to the shards.'.format(
+                copied))
+
+        users = comparisons = 0
+        started = time.monotonic()
+        for user_id, shard in iter_placements():
+            target = get_placement(user_id)
+            if shard == target:
+                continue
+            if shard not in settings.DATABASE_SHARDS:
+                self.stderr.write(
+                    'User {} is on {}, which is not a shard.'.format(
+                        user_id, shard))
+                continue
+
+            if not dry_run:
+                comparisons += move_user(
+                    get_user_shard(user_id), target, batch_size)
+            users += 1
+            if users == max_users:
+                break
+
+        if dry_run:
+            self.stdout.write('{} users would be moved.'.format(users))
+        else:
+            self.stdout.write(
+                '{} users moved, with {} comparisons, in {:.1f} s.'.format(
+                    users, comparisons, time.monotonic() - started))
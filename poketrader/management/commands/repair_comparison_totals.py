@@ -0,0 +1,50 @@
+"""
+Checks the totals stored in each comparison against its items, and repairs
+the ones that do not match, in every shard.
+"""
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from poketrader.models import PokemonComparison, get_total_fields
+
+TOTAL_FIELDS = get_total_fields(1) + get_total_fields(2)
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the totals of the comparisons from their items.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=1000,
+            help='Number of comparisons checked by each query.')
+        parser.add_argument(
+            '--dry-run', action='store_true',
+            help='Only report the inconsistent comparisons.')
+
+    def handle(self, *args, batch_size, dry_run, **options):
+        checked = inconsistent = 0
+
+        for using in settings.DATABASE_SHARDS:
+            comparisons = PokemonComparison.objects.using(using)
+            last_id = 0
+            while True:
+                chunk = list(
+                    comparisons.filter(id__gt=last_id)
+                    .order_by('id').with_computed_totals()[:batch_size])
+                if not chunk:
+                    break
+
+                ids = [
+                    c.id for c in chunk
+                    if any(getattr(c, f) != getattr(c, 'computed_' + f)
+                           for f in TOTAL_FIELDS)
+                ]
+                if ids and not dry_run:
+                    comparisons.filter(id__in=ids).repair_totals()
+
+                checked += len(chunk)
+                inconsistent += len(ids)
+                last_id = chunk[-1].id
+
+        self.stdout.write('{} comparisons checked, {} inconsistent{}.'.format(
+            checked, inconsistent, '' if dry_run else ' and repaired'))
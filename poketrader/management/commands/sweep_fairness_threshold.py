@@ -0,0 +1,44 @@
+"""
+Reports how many of the stored comparisons would be fair under a range of
+fairness thresholds, to help tuning settings.FAIRNESS_THRESHOLD.
+"""
+import numpy as np
+from django.core.management.base import BaseCommand
+
+from poketrader.fairness import sweep_thresholds
+
+
+class Command(BaseCommand):
+    help = 'Counts the comparisons that would be fair under each threshold.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--start', type=float, default=0.05,
+            help='Smallest threshold to evaluate.')
+        parser.add_argument(
+            '--stop', type=float, default=0.5,
+            help='Largest threshold to evaluate.')
+        parser.add_argument(
+            '--step', type=float, default=0.05,
+            help='Difference between consecutive thresholds.')
+        parser.add_argument(
+            '--chunk-size', type=int, default=10000,
+            help='Number of comparisons loaded by each query.')
+
+    def handle(self, *args, start, stop, step, chunk_size, **options):
+        thresholds = np.round(np.arange(start, stop + step / 2, step), 6)
+        total, unsuccessful, in_interval = sweep_thresholds(
+            thresholds, chunk_size=chunk_size)
+        fair = np.cumsum(in_interval)
+        compared = total - unsuccessful
+
+        self.stdout.write(
+            '{} comparisons, {} with an empty list.'.format(
+                total, unsuccessful))
+        self.stdout.write('{:>10} {:>12} {:>12} {:>8}'.format(
+            'threshold', 'in interval', 'fair', 'fair %'))
+        for threshold, count, fair_count in zip(
+                thresholds, in_interval, fair):
+            percent = 100 * fair_count / compared if compared else 0
+            self.stdout.write('{:>10g} {:>12} {:>12} {:>7.1f}%'.format(
+                threshold, count, fair_count, percent))
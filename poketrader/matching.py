@@ -0,0 +1,333 @@
+"""
+This module matches the trade offers of users (see TradeOffer) with the
+offers of other users: an offer matches another one if the base experience
+it gives would be a fair trade, as compare_pokemon_lists() tells, for the
+one the other wants, and the other way around. Each offer keeps the
+settings.TRADE_MATCH_LIMIT matches that give the closest to what it wants,
+found by range queries on the index of the offer totals rather than by
+comparing offers pairwise.
+
+When an offer changes, only the offers whose matches it may change are
+marked as stale, and they are matched again when their matches are next
+read, or by `manage.py match_offers`. That command can also match all
+offers at once, from sorted arrays of their totals held in memory. Offers
+change when they are published again, and when the first list of their
+comparison changes or their user is deleted (see the signal receivers at
+the end).
+"""
+import bisect
+import collections
+import functools
+import itertools
+
+import numpy as np
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+from django.db.models import F, Q, Value
+from django.db.models.functions import Abs
+from django.db.models.signals import pre_delete
+
+from .history import format_ids
+from .models import (
+    PokemonComparison, TradeMatch, TradeOffer, User, lists_changed)
+from .suggestions import get_fair_range
+
+
+class InvalidOffer(Exception):
+    pass
+
+
+@functools.lru_cache(maxsize=4096)
+def get_fair_bounds(base_experience, fairness_threshold):
+    """
+    Returns the smallest and largest total base experience that would be a
+    fair trade for a positive one:
+
+    >>> get_fair_bounds(100, 0.1)
+    (91, 110)
+    """
+    return get_fair_range(0, base_experience, fairness_threshold)
+
+
+def find_matches(offer, limit=None, fairness_threshold=None):
+    """
+    Returns the `limit` offers of other users that match an offer, the
+    closest to what it wants first, with two range queries on the index of
+    offer totals.
+    """
+    limit = limit or settings.TRADE_MATCH_LIMIT
+    fairness_threshold = fairness_threshold or settings.FAIRNESS_THRESHOLD
+    target = offer.wanted_base_experience
+    low, high = get_fair_bounds(target, fairness_threshold)
+    wanted_low, wanted_high = get_fair_bounds(
+        offer.base_experience, fairness_threshold)
+
+    candidates = TradeOffer.objects.filter(
+        wanted_base_experience__range=(wanted_low, wanted_high)
+    ).exclude(user_id=offer.user_id)
+    above = candidates.filter(base_experience__range=(target, high)).order_by(
+        'base_experience', 'id')[:limit]
+    below = candidates.filter(
+        base_experience__range=(low, target - 1)).order_by(
+            '-base_experience', 'id')[:limit]
+
+    return sorted(
+        itertools.chain(above, below),
+        key=lambda other: (abs(other.base_experience - target), other.id)
+    )[:limit]
+
+
+def get_match_distance(matches, limit):
+    """
+    Returns the match_distance of an offer with the given matches, as
+    (other offer id, distance) pairs, closest first.
+    """
+    return matches[-1][1] if len(matches) == limit else None
+
+
+def rematch(offer, limit=None, fairness_threshold=None):
+    """
+    Finds the matches of an offer again, and returns them.
+    """
+    limit = limit or settings.TRADE_MATCH_LIMIT
+    with transaction.atomic(using=DEFAULT_DB_ALIAS):
+        # Cleared first, so that changes to other offers made meanwhile
+        # mark it again.
+        TradeOffer.objects.filter(pk=offer.pk).update(stale=False)
+        matches = find_matches(offer, limit, fairness_threshold)
+        pairs = [
+            (other.id, abs(other.base_experience
+                           - offer.wanted_base_experience))
+            for other in matches
+        ]
+        offer.matches.all().delete()
+        TradeMatch.objects.bulk_create([
+            TradeMatch(offer=offer, other_id=other_id, distance=distance)
+            for other_id, distance in pairs
+        ])
+        offer.match_distance = get_match_distance(pairs, limit)
+        TradeOffer.objects.filter(pk=offer.pk).update(
+            match_distance=offer.match_distance)
+    offer.stale = False
+    return matches
+
+
+def get_matches(offer):
+    """
+    Returns the matches of an offer, matching it again first if it is stale.
+    """
+    if offer.stale:
+        rematch(offer)
+    return offer.matches.select_related('other', 'other__user')
+
+
+def mark_affected(offer, withdrawn=False, fairness_threshold=None):
+    """
+    Marks as stale the offers whose matches may change with an offer: the
+    ones it is among the matches of and, unless it is being withdrawn, the
+    ones it now matches, closer to what they want than their last match.
+    """
+    fairness_threshold = fairness_threshold or settings.FAIRNESS_THRESHOLD
+    offers = TradeOffer.objects.exclude(user_id=offer.user_id)
+    marked = offers.filter(matches__other=offer).update(stale=True)
+    if withdrawn:
+        return marked
+
+    distance = Abs(Value(offer.base_experience) - F('wanted_base_experience'))
+    return marked + offers.filter(
+        Q(match_distance__isnull=True) | Q(match_distance__gte=distance),
+        wanted_base_experience__range=get_fair_bounds(
+            offer.base_experience, fairness_threshold),
+        base_experience__range=get_fair_bounds(
+            offer.wanted_base_experience, fairness_threshold),
+    ).update(stale=True)
+
+
+def publish(comparison, wanted_base_experience=None):
+    """
+    Publishes the first list of a comparison as an offer for pokémons worth
+    `wanted_base_experience` in total (by default, the total of its second
+    list), or updates the offer of the comparison. Raises InvalidOffer if
+    either total is not positive.
+    """
+    if wanted_base_experience is None:
+        wanted_base_experience = comparison.base_experience2
+    if comparison.base_experience1 <= 0:
+        raise InvalidOffer('The first list is empty.')
+    if wanted_base_experience <= 0:
+        raise InvalidOffer('The wanted base experience must be positive.')
+
+    pokemons = comparison.items.filter(list_number=1).values_list(
+        'pokemon_id', flat=True)
+    with transaction.atomic(using=DEFAULT_DB_ALIAS):
+        offer, _ = TradeOffer.objects.update_or_create(
+            comparison_id=comparison.pk, defaults={
+                'user_id': comparison.user_id,
+                'pokemons': format_ids(pokemons),
+                'base_experience': comparison.base_experience1,
+                'wanted_base_experience': wanted_base_experience,
+                'stale': True
+            })
+        mark_affected(offer)
+    return offer
+
+
+def withdraw(comparison_id):
+    """
+    Withdraws the offer of a comparison, if any. Returns whether there was
+    one.
+    """
+    offer = TradeOffer.objects.filter(comparison_id=comparison_id).first()
+    if offer is None:
+        return False
+    with transaction.atomic(using=DEFAULT_DB_ALIAS):
+        mark_affected(offer, withdrawn=True)
+        offer.delete()
+    return True
+
+
+def compute_matches(offers, limit, fairness_threshold):
+    """
+    Finds the matches of many offers at once, given as (id, user id, base
+    experience, wanted base experience) rows, as find_matches() does for
+    each one. Yields the id of each offer with its matches, as (other offer
+    id, distance) pairs:
+
+    >>> offers = [
+    ...     (1, 1, 100, 200), (2, 2, 190, 105), (3, 3, 210, 95),
+    ...     (4, 1, 200, 100), (5, 3, 300, 100)]
+    >>> sorted(compute_matches(offers, 5, 0.1))
+    [(1, [(2, 10), (3, 10)]), (2, [(1, 5)]), (3, [(1, 5)]), (4, []), (5, [])]
+
+    The offers are sorted by base experience, so that the ones that may
+    match each offer are found by binary searches. Only a window of those
+    closest to what it wants is looked at, widened until it surely holds the
+    closest matches.
+    """
+    offers = np.asarray(offers, dtype=np.int64).reshape(-1, 4)
+    offers = offers[np.lexsort((offers[:, 0], offers[:, 2]))]
+    ids, users, totals, wanted = offers.T
+    # Plain lists are faster to search for one value at a time.
+    sorted_totals = totals.tolist()
+
+    for i, (user, total, target) in enumerate(
+            zip(users.tolist(), sorted_totals, wanted.tolist())):
+        low, high = get_fair_bounds(target, fairness_threshold)
+        wanted_low, wanted_high = get_fair_bounds(total, fairness_threshold)
+        start = bisect.bisect_left(sorted_totals, low)
+        stop = bisect.bisect_right(sorted_totals, high)
+        middle = bisect.bisect_left(sorted_totals, target)
+        window = 16 * limit
+
+        while True:
+            first = max(start, middle - window)
+            last = min(stop, middle + window)
+            found = first + np.flatnonzero(
+                (wanted[first:last] >= wanted_low)
+                & (wanted[first:last] <= wanted_high)
+                & (users[first:last] != user))
+            distances = np.abs(totals[found] - target)
+            order = np.lexsort((ids[found], distances))[:limit]
+            if first == start and last == stop:
+                break
+            # The offers out of the window are at least this far.
+            beyond = min(
+                target - sorted_totals[first - 1] if first > start
+                else np.inf,
+                sorted_totals[last] - target if last < stop else np.inf)
+            if len(order) == limit and distances[order[-1]] < beyond:
+                break
+            window *= 2
+
+        yield int(ids[i]), list(zip(
+            ids[found[order]].tolist(), distances[order].tolist()))
+
+
+def insert_matches(matches, batch_size=500):
+    """
+    Inserts matches, given as (offer id, other offer id, distance) rows,
+    with multi-row INSERTs. Unlike bulk_create(), this needs no model
+    instances, which took most of the time of matching all offers.
+    """
+    connection = connections[DEFAULT_DB_ALIAS]
+    fields = ['offer_id', 'other_id', 'distance']
+    batch_size = min(
+        batch_size, connection.ops.bulk_batch_size(fields, matches))
+    query = 'INSERT INTO {} ({}) VALUES '.format(
+        connection.ops.quote_name(TradeMatch._meta.db_table),
+        ', '.join(connection.ops.quote_name(f) for f in fields))
+
+    with connection.cursor() as cursor:
+        for start in range(0, len(matches), batch_size):
+            batch = matches[start:start + batch_size]
+            cursor.execute(
+                query + ', '.join(['(%s, %s, %s)'] * len(batch)),
+                [value for row in batch for value in row])
+
+
+def match_all(limit=None, fairness_threshold=None, batch_size=500):
+    """
+    Matches all offers again at once, with compute_matches(), and replaces
+    all their matches in a single transaction. Returns the number of offers
+    and of matches.
+    """
+    limit = limit or settings.TRADE_MATCH_LIMIT
+    fairness_threshold = fairness_threshold or settings.FAIRNESS_THRESHOLD
+    offers = TradeOffer.objects.all()
+    with transaction.atomic(using=DEFAULT_DB_ALIAS):
+        # Clearing them locks the offers until the matches are replaced, so
+        # that none is withdrawn while it is matched; offers published
+        # meanwhile stay stale.
+        offers.update(stale=False)
+        rows = list(offers.values_list(
+            'id', 'user_id', 'base_experience', 'wanted_base_experience'))
+
+        matches = []
+        # Offer ids by match distance, which few offers do not share.
+        distances = collections.defaultdict(list)
+        for offer_id, offer_matches in compute_matches(
+                rows, limit, fairness_threshold):
+            matches.extend(
+                (offer_id, other_id, distance)
+                for other_id, distance in offer_matches)
+            distances[get_match_distance(offer_matches, limit)].append(
+                offer_id)
+
+        TradeMatch.objects.all().delete()
+        insert_matches(matches, batch_size)
+        for distance, ids in distances.items():
+            for start in range(0, len(ids), batch_size):
+                offers.filter(id__in=ids[start:start + batch_size]).update(
+                    match_distance=distance)
+    return len(rows), len(matches)
+
+
+def update_offer(sender, instance, list_numbers, **kwargs):
+    """
+    Publishes the offer of a comparison again when its first list changes,
+    so that it offers the pokémons in the list, or withdraws it if the list
+    was emptied.
+    """
+    if 1 not in list_numbers:
+        return
+    offer = TradeOffer.objects.filter(comparison_id=instance.pk).first()
+    if offer is None:
+        return
+    try:
+        publish(instance, offer.wanted_base_experience)
+    except InvalidOffer:
+        withdraw(instance.pk)
+
+
+def withdraw_user_offers(sender, instance, using, **kwargs):
+    """
+    Marks the offers whose matches change with the offers of a deleted user,
+    which are deleted with it.
+    """
+    if using == DEFAULT_DB_ALIAS:
+        for offer in TradeOffer.objects.filter(user_id=instance.pk):
+            mark_affected(offer, withdrawn=True)
+
+
+lists_changed.connect(update_offer, sender=PokemonComparison)
+pre_delete.connect(withdraw_user_offers, sender=User)
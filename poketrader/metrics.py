@@ -0,0 +1,235 @@
+"""
+This module measures where the time of each request goes: SQL queries, calls
+to fetch_pokemon() and to the PokéAPI, hits and misses of the pokédex cache
+and template rendering. request_metrics_middleware() reports them in the
+Server-Timing header and in log lines, and keeps a latency histogram of each
+view.
+"""
+import asyncio
+import bisect
+import collections
+import contextlib
+import contextvars
+import functools
+import json
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.utils.decorators import sync_and_async_middleware
+
+logger = logging.getLogger(__name__)
+
+# Metrics of the request being handled, if any.
+CURRENT = contextvars.ContextVar('request_metrics', default=None)
+
+# Latency histograms of each view in this process, by view name.
+HISTOGRAMS = {}
+HISTOGRAMS_LOCK = threading.Lock()
+
+
+class RequestMetrics:
+    """
+    Total durations, in seconds, and counts of the operations of a request.
+    It can be updated from threads started by the request, too:
+
+    >>> metrics = RequestMetrics()
+    >>> metrics.add('db', 0.0015)
+    >>> metrics.add('db', 0.001)
+    >>> metrics.add('cache_hit')
+    >>> metrics.as_server_timing()
+    'db;dur=2.5;desc="2 calls", cache_hit;desc="1 calls"'
+    """
+
+    def __init__(self):
+        self.durations = collections.Counter()
+        self.counts = collections.Counter()
+        self.lock = threading.Lock()
+
+    def add(self, name, duration=None, count=1):
+        with self.lock:
+            if duration is not None:
+                self.durations[name] += duration
+            self.counts[name] += count
+
+    def as_server_timing(self):
+        entries = []
+        for name, count in self.counts.items():
+            entry = name
+            if name in self.durations:
+                entry += ';dur={:.1f}'.format(self.durations[name] * 1000)
+            if name != 'total':
+                entry += ';desc="{} calls"'.format(count)
+            entries.append(entry)
+        return ', '.join(entries)
+
+    def as_dict(self):
+        return {
+            name: {
+                'count': count,
+                'ms': round(self.durations[name] * 1000, 3)
+            } if name in self.durations else {'count': count}
+            for name, count in self.counts.items()
+        }
+
+
+class Histogram:
+    """
+    Counts values in buckets, by their upper bounds, as in Prometheus:
+
+    >>> histogram = Histogram([0.1, 0.5, 1])
+    >>> for value in [0.05, 0.1, 0.3, 2]:
+    ...     histogram.observe(value)
+    >>> histogram.as_dict()
+    {'count': 4, 'sum': 2.45, 'buckets': [[0.1, 2], [0.5, 3], [1, 3], ['+Inf', 4]]}
+    """
+
+    def __init__(self, buckets):
+        self.buckets = sorted(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def as_dict(self):
+        cumulative = 0
+        buckets = []
+        for bound, count in zip(self.buckets + ['+Inf'], self.counts):
+            cumulative += count
+            buckets.append([bound, cumulative])
+        return {
+            'count': self.count, 'sum': round(self.sum, 6), 'buckets': buckets
+        }
+
+
+def add(name, duration=None, count=1):
+    """
+    Records an operation in the metrics of the current request, if any.
+    """
+    metrics = CURRENT.get()
+    if metrics is not None:
+        metrics.add(name, duration, count)
+
+
+@contextlib.contextmanager
+def timed(name):
+    """
+    Records the time spent in a block, or in a function if used as
+    decorator, in the metrics of the current request.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add(name, time.perf_counter() - start)
+
+
+def bound(function):
+    """
+    Binds a function to the current request so that it records its metrics
+    there even if called in another thread.
+    """
+    return functools.partial(contextvars.copy_context().run, function)
+
+
+def observe_latency(view_name, seconds):
+    with HISTOGRAMS_LOCK:
+        if view_name not in HISTOGRAMS:
+            HISTOGRAMS[view_name] = Histogram(settings.METRICS_LATENCY_BUCKETS)
+        HISTOGRAMS[view_name].observe(seconds)
+
+
+def get_latency_histograms():
+    with HISTOGRAMS_LOCK:
+        return {
+            name: histogram.as_dict()
+            for name, histogram in sorted(HISTOGRAMS.items())
+        }
+
+
+def reset_latency_histograms():
+    with HISTOGRAMS_LOCK:
+        HISTOGRAMS.clear()
+
+
+@sync_and_async_middleware
+def request_metrics_middleware(get_response):
+    """
+    Measures each request, adds its metrics to the Server-Timing header, logs
+    them as a JSON line and keeps the latency of its view.
+    """
+    for connection in connections.all():
+        install_query_timer(connection)
+
+    if asyncio.iscoroutinefunction(get_response):
+        async def middleware(request):
+            metrics = RequestMetrics()
+            token = CURRENT.set(metrics)
+            start = time.perf_counter()
+            try:
+                response = await get_response(request)
+            finally:
+                CURRENT.reset(token)
+            return report(request, response, metrics, start)
+    else:
+        def middleware(request):
+            metrics = RequestMetrics()
+            token = CURRENT.set(metrics)
+            start = time.perf_counter()
+            try:
+                response = get_response(request)
+            finally:
+                CURRENT.reset(token)
+            return report(request, response, metrics, start)
+
+    return middleware
+
+
+def report(request, response, metrics, start):
+    total = time.perf_counter() - start
+    metrics.add('total', total)
+
+    match = getattr(request, 'resolver_match', None)
+    view_name = match.view_name if match is not None else None
+    if view_name is not None:
+        observe_latency(view_name, total)
+
+    response['Server-Timing'] = metrics.as_server_timing()
+    logger.info(json.dumps({
+        'method': request.method, 'path': request.path,
+        'view': view_name, 'status': response.status_code,
+        'metrics': metrics.as_dict()
+    }))
+    return response
+
+
+def install_query_timer(connection, **kwargs):
+    """
+    Makes a database connection time its queries in the metrics of the
+    current request. Connections are per thread, so it is done for each new
+    one, when the connection_created signal is sent.
+    """
+    if time_query not in connection.execute_wrappers:
+        connection.execute_wrappers.insert(0, time_query)
+
+
+def time_query(execute, sql, params, many, context):
+    metrics = CURRENT.get()
+    if metrics is None:
+        return execute(sql, params, many, context)
+
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        metrics.add('db', time.perf_counter() - start)
+
+
+connection_created.connect(install_query_timer)
@@ -3,20 +3,50 @@
 from django.db import migrations, models
 import django.db.models.deletion
 
+from poketrader.data_migrations import bulk_create_with_ids
+
+CHUNK_SIZE = 500
+
 
 def convert_to_list_item(apps, schema_editor):
+    """
+    Adds an item to the new lists for each pokémon in the old ones, one chunk
+    of comparisons at a time, with bulk inserts. Items follow the order in
+    which the pokémons were added.
+
+    This migration also changes tables, so it runs in a single transaction,
+    and cannot use migrate_in_chunks() to commit each chunk.
+    """
     PokemonComparison = apps.get_model('poketrader', 'PokemonComparison')
     PokemonListItem = apps.get_model('poketrader', 'PokemonListItem')
-    for comparison in PokemonComparison.objects.all():
-        for pokemon in comparison.list1.all():
-            item = PokemonListItem(pokemon=pokemon)
-            item.save()
-            comparison.list_items1.add(item)
-        for pokemon in comparison.list2.all():
-            item = PokemonListItem(pokemon=pokemon)
-            item.save()
-            comparison.list_items2.add(item)
-        comparison.save()
+    using = schema_editor.connection.alias
+    lists = [
+        (PokemonComparison.list1.through,
+         PokemonComparison.list_items1.through),
+        (PokemonComparison.list2.through,
+         PokemonComparison.list_items2.through),
+    ]
+
+    comparison_ids = list(
+        PokemonComparison.objects.using(using).order_by('id').values_list(
+            'id', flat=True))
+    for start in range(0, len(comparison_ids), CHUNK_SIZE):
+        ids = comparison_ids[start:start + CHUNK_SIZE]
+        for old_through, new_through in lists:
+            rows = list(
+                old_through.objects.using(using)
+                .filter(pokemoncomparison_id__in=ids).order_by('id')
+                .values_list('pokemoncomparison_id', 'pokemon_id'))
+            items = bulk_create_with_ids(PokemonListItem, [
+                PokemonListItem(pokemon_id=pokemon_id)
+                for _, pokemon_id in rows
+            ], using=using)
+            new_through.objects.using(using).bulk_create([
+                new_through(
+                    pokemoncomparison_id=comparison_id,
+                    pokemonlistitem_id=item.id)
+                for (comparison_id, _), item in zip(rows, items)
+            ])
 
 
 class Migration(migrations.Migration):
@@ -0,0 +1,43 @@
+# Generated by Django 3.2.25 on 2026-10-18 05:40
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('poketrader', '0005_auto_20210217_2228'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='pokemonlistitem',
+            options={'ordering': ['list_number', 'position', 'id']},
+        ),
+        migrations.AddField(
+            model_name='pokemonlistitem',
+            name='comparison',
+            field=models.ForeignKey(
+                null=True, on_delete=django.db.models.deletion.CASCADE,
+                related_name='items', to='poketrader.pokemoncomparison'),
+        ),
+        migrations.AddField(
+            model_name='pokemonlistitem',
+            name='list_number',
+            field=models.PositiveSmallIntegerField(default=0),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='pokemonlistitem',
+            name='position',
+            field=models.PositiveIntegerField(default=0),
+            preserve_default=False,
+        ),
+        migrations.AddIndex(
+            model_name='pokemonlistitem',
+            index=models.Index(
+                fields=['comparison', 'list_number', 'position'],
+                name='pokemonlistitem_position_idx'),
+        ),
+    ]
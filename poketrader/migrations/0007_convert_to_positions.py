@@ -0,0 +1,103 @@
+# Generated by Django 3.2.25 on 2026-10-18 05:42
+
+import collections
+
+from django.db import migrations
+
+from poketrader.data_migrations import forget_progress, migrate_in_chunks
+
+CHUNK_SIZE = 500
+
+
+def convert_to_positions(apps, schema_editor):
+    """
+    Moves the lists from the many-to-many tables to the comparison, list
+    number and position of each item, one chunk of comparisons per
+    transaction. Items follow the order in which they were added to the
+    lists.
+    """
+    PokemonComparison = apps.get_model('poketrader', 'PokemonComparison')
+    PokemonListItem = apps.get_model('poketrader', 'PokemonListItem')
+    using = schema_editor.connection.alias
+    through_models = {
+        1: PokemonComparison.list_items1.through,
+        2: PokemonComparison.list_items2.through,
+    }
+
+    def convert(ids):
+        converted = set()
+        updated = []
+        created = []
+        for list_number, through in through_models.items():
+            rows = (
+                through.objects.using(using)
+                .filter(pokemoncomparison_id__in=ids)
+                .order_by('pokemoncomparison_id', 'id')
+                .values_list(
+                    'pokemoncomparison_id', 'pokemonlistitem_id',
+                    'pokemonlistitem__pokemon_id'))
+            positions = collections.Counter()
+            for comparison_id, item_id, pokemon_id in rows:
+                item = PokemonListItem(
+                    comparison_id=comparison_id, list_number=list_number,
+                    position=positions[comparison_id],
+                    pokemon_id=pokemon_id)
+                positions[comparison_id] += 1
+                # An item in more than one list becomes many items.
+                if item_id in converted:
+                    created.append(item)
+                else:
+                    item.id = item_id
+                    converted.add(item_id)
+                    updated.append(item)
+
+        PokemonListItem.objects.using(using).bulk_update(
+            updated, ['comparison', 'list_number', 'position'],
+            batch_size=CHUNK_SIZE)
+        PokemonListItem.objects.using(using).bulk_create(
+            created, batch_size=CHUNK_SIZE)
+
+    migrate_in_chunks(
+        schema_editor, 'poketrader.0007_convert_to_positions',
+        PokemonComparison.objects.all(), convert, chunk_size=CHUNK_SIZE)
+    forget_progress(schema_editor, 'poketrader.0007_convert_to_many_to_many')
+
+
+def convert_to_many_to_many(apps, schema_editor):
+    PokemonComparison = apps.get_model('poketrader', 'PokemonComparison')
+    PokemonListItem = apps.get_model('poketrader', 'PokemonListItem')
+    using = schema_editor.connection.alias
+    through_models = {
+        1: PokemonComparison.list_items1.through,
+        2: PokemonComparison.list_items2.through,
+    }
+
+    def convert(ids):
+        items = PokemonListItem.objects.using(using).filter(id__in=ids)
+        for list_number, through in through_models.items():
+            through.objects.using(using).bulk_create([
+                through(
+                    pokemoncomparison_id=item.comparison_id,
+                    pokemonlistitem_id=item.id)
+                for item in sorted(items, key=lambda i: i.position)
+                if item.list_number == list_number
+            ])
+
+    migrate_in_chunks(
+        schema_editor, 'poketrader.0007_convert_to_many_to_many',
+        PokemonListItem.objects.filter(comparison__isnull=False), convert,
+        chunk_size=CHUNK_SIZE)
+    forget_progress(schema_editor, 'poketrader.0007_convert_to_positions')
+
+
+class Migration(migrations.Migration):
+
+    atomic = False
+
+    dependencies = [
+        ('poketrader', '0006_pokemonlistitem_position'),
+    ]
+
+    operations = [
+        migrations.RunPython(convert_to_positions, convert_to_many_to_many),
+    ]
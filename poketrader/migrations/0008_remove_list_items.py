@@ -0,0 +1,21 @@
+# Generated by Django 3.2.25 on 2026-10-18 05:44
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('poketrader', '0007_convert_to_positions'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='pokemoncomparison',
+            name='list_items1',
+        ),
+        migrations.RemoveField(
+            model_name='pokemoncomparison',
+            name='list_items2',
+        ),
+    ]
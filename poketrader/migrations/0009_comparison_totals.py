@@ -0,0 +1,33 @@
+# Generated by Django 3.2.25 on 2026-10-18 06:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('poketrader', '0008_remove_list_items'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pokemoncomparison',
+            name='base_experience1',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='pokemoncomparison',
+            name='base_experience2',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='pokemoncomparison',
+            name='count1',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='pokemoncomparison',
+            name='count2',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
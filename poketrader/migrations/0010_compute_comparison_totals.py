@@ -0,0 +1,53 @@
+# Generated by Django 3.2.25 on 2026-10-18 06:24
+
+from django.db import migrations, models
+from django.db.models.functions import Coalesce
+
+from poketrader.data_migrations import migrate_in_chunks
+
+CHUNK_SIZE = 1000
+
+
+def compute_totals(apps, schema_editor):
+    """
+    Computes the totals of the existing comparisons from their items, one
+    chunk of comparisons per UPDATE and transaction.
+    """
+    PokemonComparison = apps.get_model('poketrader', 'PokemonComparison')
+    PokemonListItem = apps.get_model('poketrader', 'PokemonListItem')
+    using = schema_editor.connection.alias
+
+    expressions = {}
+    for list_number in (1, 2):
+        items = PokemonListItem.objects.filter(
+            comparison=models.OuterRef('pk'), list_number=list_number
+        ).order_by().values('comparison')
+        expressions['base_experience{}'.format(list_number)] = Coalesce(
+            models.Subquery(items.annotate(
+                total=models.Sum('pokemon__base_experience')).values('total')),
+            0)
+        expressions['count{}'.format(list_number)] = Coalesce(
+            models.Subquery(items.annotate(
+                count=models.Count('id')).values('count')),
+            0)
+
+    def compute(ids):
+        PokemonComparison.objects.using(using).filter(
+            id__gte=ids[0], id__lte=ids[-1]).update(**expressions)
+
+    migrate_in_chunks(
+        schema_editor, 'poketrader.0010_compute_totals',
+        PokemonComparison.objects.all(), compute, chunk_size=CHUNK_SIZE)
+
+
+class Migration(migrations.Migration):
+
+    atomic = False
+
+    dependencies = [
+        ('poketrader', '0009_comparison_totals'),
+    ]
+
+    operations = [
+        migrations.RunPython(compute_totals, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 3.2.25 on 2026-10-18 07:05
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('poketrader', '0010_compute_comparison_totals'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pokemoncomparison',
+            name='modified',
+            field=models.DateTimeField(
+                auto_now=True, default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='pokemoncomparison',
+            name='version',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
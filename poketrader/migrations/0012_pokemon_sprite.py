@@ -0,0 +1,23 @@
+# Generated by Django 3.2.25 on 2026-10-18 07:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('poketrader', '0011_comparison_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pokemon',
+            name='sprite',
+            field=models.CharField(blank=True, default='', max_length=100),
+        ),
+        migrations.AddField(
+            model_name='pokemon',
+            name='thumbnail',
+            field=models.CharField(blank=True, default='', max_length=100),
+        ),
+    ]
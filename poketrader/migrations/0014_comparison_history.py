@@ -0,0 +1,49 @@
+# Generated by Django 3.2.25 on 2026-10-18 09:12
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('poketrader', '0013_sharding'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ComparisonSnapshot',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('version', models.PositiveIntegerField()),
+                ('list1', models.TextField(blank=True)),
+                ('list2', models.TextField(blank=True)),
+                ('comparison', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='snapshots', to='poketrader.pokemoncomparison')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ComparisonEvent',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('version', models.PositiveIntegerField()),
+                ('kind', models.CharField(choices=[('add', 'Add'), ('remove', 'Remove'), ('reset', 'Reset'), ('restore', 'Restore'), ('start', 'Start')], max_length=7)),
+                ('list_number', models.PositiveSmallIntegerField(null=True)),
+                ('position', models.PositiveIntegerField(null=True)),
+                ('created', models.DateTimeField(default=django.utils.timezone.now)),
+                ('comparison', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='events', to='poketrader.pokemoncomparison')),
+                ('pokemon', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, to='poketrader.pokemon')),
+            ],
+            options={
+                'ordering': ['version', 'id'],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='comparisonsnapshot',
+            constraint=models.UniqueConstraint(fields=('comparison', 'version'), name='comparisonsnapshot_version_unique'),
+        ),
+        migrations.AddIndex(
+            model_name='comparisonevent',
+            index=models.Index(fields=['comparison', 'version'], name='comparisonevent_version_idx'),
+        ),
+    ]
@@ -0,0 +1,68 @@
+# Generated by Django 3.2.25 on 2026-10-18 09:14
+
+from django.db import migrations
+
+from poketrader.data_migrations import forget_progress, migrate_in_chunks
+
+CHUNK_SIZE = 1000
+NAME = 'poketrader.0015_start_history'
+
+
+def start_history(apps, schema_editor):
+    """
+    Starts the history of the existing comparisons with their current lists,
+    as a "start" event and an "add" event per item at their version.
+    """
+    PokemonComparison = apps.get_model('poketrader', 'PokemonComparison')
+    PokemonListItem = apps.get_model('poketrader', 'PokemonListItem')
+    ComparisonEvent = apps.get_model('poketrader', 'ComparisonEvent')
+    using = schema_editor.connection.alias
+
+    def start(ids):
+        versions = dict(PokemonComparison.objects.using(using).filter(
+            id__in=ids).values_list('id', 'version'))
+        items = PokemonListItem.objects.using(using).filter(
+            comparison__in=ids).order_by(
+                'comparison', 'list_number', 'position').values_list(
+                    'comparison', 'list_number', 'position', 'pokemon')
+        events = [
+            ComparisonEvent(
+                comparison_id=comparison_id, version=version, kind='start')
+            for comparison_id, version in versions.items()
+        ] + [
+            ComparisonEvent(
+                comparison_id=comparison_id,
+                version=versions[comparison_id], kind='add',
+                list_number=list_number, position=position,
+                pokemon_id=pokemon_id)
+            for comparison_id, list_number, position, pokemon_id in items
+        ]
+        ComparisonEvent.objects.using(using).bulk_create(events)
+
+    migrate_in_chunks(
+        schema_editor, NAME, PokemonComparison.objects.all(), start,
+        chunk_size=CHUNK_SIZE)
+
+
+def forget_history(apps, schema_editor):
+    """
+    Deletes the history of all comparisons, which starts again when this
+    migration is applied again.
+    """
+    using = schema_editor.connection.alias
+    for name in ('ComparisonEvent', 'ComparisonSnapshot'):
+        apps.get_model('poketrader', name).objects.using(using).all().delete()
+    forget_progress(schema_editor, NAME)
+
+
+class Migration(migrations.Migration):
+
+    atomic = False
+
+    dependencies = [
+        ('poketrader', '0014_comparison_history'),
+    ]
+
+    operations = [
+        migrations.RunPython(start_history, forget_history),
+    ]
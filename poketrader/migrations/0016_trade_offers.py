@@ -0,0 +1,54 @@
+# Generated by Django 3.2.25 on 2026-10-18 09:40
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('poketrader', '0015_start_comparison_history'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TradeOffer',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('comparison_id', models.PositiveIntegerField(unique=True)),
+                ('pokemons', models.TextField()),
+                ('base_experience', models.PositiveIntegerField()),
+                ('wanted_base_experience', models.PositiveIntegerField()),
+                ('stale', models.BooleanField(default=True)),
+                ('match_distance', models.PositiveIntegerField(null=True)),
+                ('modified', models.DateTimeField(auto_now=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='TradeMatch',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('distance', models.PositiveIntegerField()),
+                ('offer', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='matches', to='poketrader.tradeoffer')),
+                ('other', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='matched_by', to='poketrader.tradeoffer')),
+            ],
+            options={
+                'ordering': ['distance', 'other'],
+            },
+        ),
+        migrations.AddIndex(
+            model_name='tradeoffer',
+            index=models.Index(fields=['base_experience', 'wanted_base_experience'], name='tradeoffer_totals_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='tradeoffer',
+            index=models.Index(fields=['wanted_base_experience', 'base_experience'], name='tradeoffer_wanted_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='tradematch',
+            constraint=models.UniqueConstraint(fields=('offer', 'other'), name='tradematch_unique'),
+        ),
+    ]
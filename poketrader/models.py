@@ -1,35 +1,251 @@
-from django.db import models
+import functools
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, IntegrityError, models, transaction
+from django.db.models.functions import Coalesce
+from django.dispatch import Signal
+from django.utils import timezone
 from django.contrib.auth import get_user_model
 
+from .pokemon import compare_base_experiences
+from .sprites import get_sprite_storage
+
 User = get_user_model()
 
+# Sent by the methods of PokemonComparison that change its lists, in the
+# transaction of the change, with the comparison as `instance` and the
+# numbers of the lists changed as `list_numbers`.
+lists_changed = Signal()
+
 
 class Pokemon(models.Model):
     name = models.CharField(max_length=100, unique=True)
     base_experience = models.IntegerField()
     picture_url = models.URLField()
+    # Names of the local copies of the picture and of its thumbnail, if any,
+    # in the sprite storage (see sprites.py).
+    sprite = models.CharField(max_length=100, blank=True, default='')
+    thumbnail = models.CharField(max_length=100, blank=True, default='')
 
     def as_dict(self):
         return {
             'name': self.name,
             'base_experience': self.base_experience,
-            'picture_url': self.picture_url
+            'picture_url': self.picture_url,
+            'sprite_url': self.sprite_url
         }
 
+    @property
+    def sprite_url(self):
+        """
+        URL of the local copy of the sprite or, until it is mirrored, of the
+        original picture.
+        """
+        if self.thumbnail or self.sprite:
+            return get_sprite_storage().url(self.thumbnail or self.sprite)
+        return self.picture_url
+
+
+def is_sharded():
+    """
+    Tells whether comparisons are spread across several databases (see
+    sharding.py).
+    """
+    return len(settings.DATABASE_SHARDS) > 1
+
+
+class UserShard(models.Model):
+    """
+    The shard that keeps the comparisons of a user (see sharding.py).
+    """
+    user = models.OneToOneField(
+        User, on_delete=models.CASCADE, primary_key=True)
+    shard = models.CharField(max_length=100)
+    # Set while the comparisons of the user are moved to another shard,
+    # during which they cannot be changed.
+    moving = models.BooleanField(default=False)
+
+
+class IdSequence(models.Model):
+    """
+    The next id of the rows of a model kept in shards, so that ids are unique
+    across shards.
+    """
+    name = models.CharField(max_length=100, primary_key=True)
+    next_value = models.BigIntegerField()
+
+
+def allocate_ids(model, count):
+    """
+    Returns a range of `count` ids for new rows of a model kept in shards.
+    The first call starts after the largest id in any shard.
+    """
+    sequences = IdSequence.objects.using(DEFAULT_DB_ALIAS)
+    name = model._meta.label_lower
+    with transaction.atomic(using=DEFAULT_DB_ALIAS):
+        # Incrementing first locks the row until the transaction ends.
+        if not sequences.filter(name=name).update(
+                next_value=models.F('next_value') + count):
+            start = 1 + max(
+                model._base_manager.using(alias).aggregate(
+                    last=models.Max('pk'))['last'] or 0
+                for alias in settings.DATABASE_SHARDS)
+            try:
+                with transaction.atomic(using=DEFAULT_DB_ALIAS):
+                    sequences.create(name=name, next_value=start + count)
+            except IntegrityError:
+                # Another process created it meanwhile.
+                sequences.filter(name=name).update(
+                    next_value=models.F('next_value') + count)
+        next_value = sequences.get(name=name).next_value
+    return range(next_value - count, next_value)
+
+
+def atomic_in_own_database(method):
+    """
+    Runs a method of a model instance in a transaction of the database the
+    instance comes from.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with transaction.atomic(using=self._state.db):
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+class PokemonListItemManager(models.Manager):
+
+    def get_queryset(self):
+        return super().get_queryset().select_related('pokemon')
+
 
 class PokemonListItem(models.Model):
+    # Items left behind by older versions, which kept the lists in
+    # many-to-many tables, have no comparison.
+    comparison = models.ForeignKey(
+        'PokemonComparison', on_delete=models.CASCADE, related_name='items',
+        null=True)
+    list_number = models.PositiveSmallIntegerField()
+    position = models.PositiveIntegerField()
     pokemon = models.ForeignKey(Pokemon, on_delete=models.CASCADE)
 
+    objects = PokemonListItemManager()
+
+    class Meta:
+        ordering = ['list_number', 'position', 'id']
+        indexes = [
+            models.Index(
+                fields=['comparison', 'list_number', 'position'],
+                name='pokemonlistitem_position_idx')
+        ]
+
+
+def get_total_fields(list_number):
+    """
+    Returns the names of the fields with the total base experience and the
+    number of pokémons of a list:
+
+    >>> get_total_fields(2)
+    ('base_experience2', 'count2')
+    """
+    return 'base_experience{}'.format(list_number), 'count{}'.format(list_number)
+
+
+def get_change_fields():
+    """
+    Returns the values that mark a comparison as changed, for updates.
+    """
+    return {'version': models.F('version') + 1, 'modified': timezone.now()}
+
+
+def compute_totals():
+    """
+    Returns expressions that compute the totals of each list of a comparison
+    from its items, by field name.
+    """
+    expressions = {}
+    for list_number in (1, 2):
+        total_field, count_field = get_total_fields(list_number)
+        items = PokemonListItem.objects.filter(
+            comparison=models.OuterRef('pk'), list_number=list_number
+        ).order_by().values('comparison')
+        expressions[total_field] = Coalesce(models.Subquery(items.annotate(
+            total=models.Sum('pokemon__base_experience')).values('total')), 0)
+        expressions[count_field] = Coalesce(models.Subquery(items.annotate(
+            count=models.Count('id')).values('count')), 0)
+    return expressions
+
+
+class PokemonComparisonQuerySet(models.QuerySet):
+
+    def with_computed_totals(self):
+        """
+        Annotates each comparison with the totals computed from its items,
+        prefixed by "computed_".
+        """
+        return self.annotate(**{
+            'computed_' + field: expression
+            for field, expression in compute_totals().items()
+        })
+
+    def repair_totals(self):
+        """
+        Recomputes the totals of the comparisons from their items with a
+        single UPDATE.
+        """
+        return self.update(**compute_totals(), **get_change_fields())
+
+    def with_lists(self):
+        """
+        Prefetches both lists, and their pokémons, so that reading list1 and
+        list2 of every comparison in the queryset costs one query in total.
+        """
+        return self.prefetch_related('items')
+
+    def keyset_page(self, before=None, size=20):
+        """
+        Returns a page with up to `size` comparisons, newest first, whose ids
+        are smaller than `before`. Also returns the value of `before` for the
+        next page, or None if this is the last one.
+        """
+        queryset = self.order_by('-id')
+        if before is not None:
+            queryset = queryset.filter(id__lt=before)
+
+        page = list(queryset[:size + 1])
+        if len(page) > size:
+            page = page[:size]
+            return page, page[-1].id
+
+        return page, None
+
 
 class PokemonComparison(models.Model):
-    user = models.ForeignKey(User, on_delete=models.CASCADE)
-    list_items1 = models.ManyToManyField(PokemonListItem, related_name='list1')
-    list_items2 = models.ManyToManyField(PokemonListItem, related_name='list2')
+    # Comparisons may be kept in another database than users (see
+    # sharding.py).
+    user = models.ForeignKey(
+        User, on_delete=models.CASCADE, db_constraint=False)
+    # Totals of the lists, kept up to date by the methods that change them.
+    base_experience1 = models.PositiveIntegerField(default=0)
+    base_experience2 = models.PositiveIntegerField(default=0)
+    count1 = models.PositiveIntegerField(default=0)
+    count2 = models.PositiveIntegerField(default=0)
+    # Incremented, and the time updated, by every change to the lists.
+    version = models.PositiveIntegerField(default=0)
+    modified = models.DateTimeField(auto_now=True)
+
+    objects = PokemonComparisonQuerySet.as_manager()
+
+    def save(self, *args, **kwargs):
+        if self.pk is None and is_sharded():
+            self.pk = allocate_ids(PokemonComparison, 1)[0]
+        super().save(*args, **kwargs)
 
     def as_list_of_dicts(self):
+        list1, list2 = self.get_lists()
         return (
-            [p.as_dict() for p in self.list1],
-            [p.as_dict() for p in self.list2]
+            [p.as_dict() for p in list1],
+            [p.as_dict() for p in list2]
         )
 
     def list1_as_string(self):
@@ -40,16 +256,291 @@ class PokemonComparison(models.Model):
 
     @property
     def list1(self):
-        return [i.pokemon for i in self.list_items1.all()]
+        return self.get_lists()[0]
 
     @property
     def list2(self):
-        return [i.pokemon for i in self.list_items2.all()]
+        return self.get_lists()[1]
+
+    def get_lists(self):
+        """
+        Returns the pokémons of both lists, in order. Both are loaded by a
+        single query, or none if the items were prefetched by with_lists().
+        """
+        lists = ([], [])
+        for item in self.items.all():
+            lists[item.list_number - 1].append(item.pokemon)
+        return lists
+
+    def compare(self, fairness_threshold=0.1):
+        """
+        Compares the lists as compare_pokemon_lists() does, without loading
+        them.
+        """
+        return compare_base_experiences(
+            self.base_experience1, self.base_experience2,
+            fairness_threshold=fairness_threshold)
 
     def add_pokemon(self, pokemon, list_number):
-        item = PokemonListItem(pokemon=pokemon)
-        item.save()
-        if list_number == 1:
-            self.list_items1.add(item)
-        elif list_number == 2:
-            self.list_items2.add(item)
+        self.add_pokemons([pokemon], list_number)
+
+    @atomic_in_own_database
+    def add_pokemons(self, pokemons, list_number):
+        """
+        Appends pokémons to a list. Takes four queries however many pokémons
+        are added, and one more to look for the offer of the first list.
+        """
+        if not pokemons:
+            return
+        self._add_to_totals(
+            list_number, sum(p.base_experience for p in pokemons),
+            len(pokemons))
+        _, count_field = get_total_fields(list_number)
+        first = getattr(self, count_field) - len(pokemons)
+        PokemonListItem.objects.using(self._state.db).bulk_create([
+            PokemonListItem(
+                comparison=self, list_number=list_number,
+                position=position, pokemon=pokemon)
+            for position, pokemon in enumerate(pokemons, first)
+        ])
+        self._log([
+            ComparisonEvent(
+                kind=ComparisonEvent.ADD, list_number=list_number,
+                position=position, pokemon=pokemon)
+            for position, pokemon in enumerate(pokemons, first)
+        ])
+        self._changed([list_number])
+
+    def remove_pokemon(self, position, list_number):
+        """
+        Removes the pokémon at the given position of a list, moving the next
+        ones one position back. Returns False if there was no such position.
+        """
+        return self.remove_positions(list_number, [position]) > 0
+
+    @atomic_in_own_database
+    def remove_positions(self, list_number, positions):
+        """
+        Removes the pokémons at the given positions of a list, moving the
+        next ones back to fill the gaps. Positions out of the list are
+        ignored. Takes six queries however many pokémons are removed, and one
+        more for the first list, and returns their number.
+        """
+        items = self.items.filter(list_number=list_number)
+        removed = list(items.filter(position__in=set(positions)))
+        if not removed:
+            return 0
+
+        items.filter(id__in=[item.id for item in removed]).delete()
+        # Each item moves back by the number of items removed before it.
+        items.filter(position__gt=min(i.position for i in removed)).update(
+            position=models.F('position') - sum(
+                models.Case(
+                    models.When(position__gt=item.position, then=1),
+                    default=0)
+                for item in removed))
+        self._add_to_totals(
+            list_number, -sum(i.pokemon.base_experience for i in removed),
+            -len(removed))
+        # Removed from the last, so that each position holds when replayed.
+        self._log([
+            ComparisonEvent(
+                kind=ComparisonEvent.REMOVE, list_number=list_number,
+                position=item.position, pokemon_id=item.pokemon_id)
+            for item in sorted(removed, key=lambda i: -i.position)
+        ])
+        self._changed([list_number])
+        return len(removed)
+
+    def reset_list(self, list_number):
+        self.replace_list(list_number, [])
+
+    def replace_list(self, list_number, pokemons):
+        """
+        Replaces the pokémons of a list. Takes five queries however many
+        pokémons are replaced, or four to empty it, and one more for the
+        first list.
+        """
+        self.replace_lists({list_number: pokemons})
+
+    @atomic_in_own_database
+    def replace_lists(self, lists, restored_version=None):
+        """
+        Replaces the pokémons of the lists in `lists`, a dict from list
+        numbers to pokémons, as replace_list() does. If the lists are the
+        ones of an older version, as when undoing changes, it is given as
+        `restored_version`.
+        """
+        self.items.filter(list_number__in=lists).delete()
+        totals = {}
+        for list_number, pokemons in lists.items():
+            total_field, count_field = get_total_fields(list_number)
+            totals[total_field] = sum(p.base_experience for p in pokemons)
+            totals[count_field] = len(pokemons)
+        PokemonComparison.objects.using(self._state.db).filter(
+            pk=self.pk).update(**totals, **get_change_fields())
+        self.refresh_from_db(fields=[*totals, 'version', 'modified'])
+
+        items = []
+        events = []
+        if restored_version is not None:
+            events.append(ComparisonEvent(
+                kind=ComparisonEvent.RESTORE, position=restored_version))
+        for list_number, pokemons in lists.items():
+            events.append(ComparisonEvent(
+                kind=ComparisonEvent.RESET, list_number=list_number))
+            for position, pokemon in enumerate(pokemons):
+                items.append(PokemonListItem(
+                    comparison=self, list_number=list_number,
+                    position=position, pokemon=pokemon))
+                events.append(ComparisonEvent(
+                    kind=ComparisonEvent.ADD, list_number=list_number,
+                    position=position, pokemon=pokemon))
+        if items:
+            PokemonListItem.objects.using(self._state.db).bulk_create(items)
+        self._log(events)
+        self._changed(list(lists))
+
+    def _log(self, events):
+        """
+        Appends the events of the last change, with a single INSERT.
+        """
+        for event in events:
+            event.comparison = self
+            event.version = self.version
+        ComparisonEvent.objects.using(self._state.db).bulk_create(events)
+
+    def _changed(self, list_numbers):
+        """
+        Sends lists_changed, whose receivers update the offer of the first
+        list (see matching.update_offer()).
+        """
+        lists_changed.send(
+            sender=PokemonComparison, instance=self, list_numbers=list_numbers)
+
+    def _add_to_totals(self, list_number, base_experience, count):
+        """
+        Adds to the totals of a list with a single UPDATE, so that concurrent
+        changes are not lost, and then reloads them.
+        """
+        total_field, count_field = get_total_fields(list_number)
+        PokemonComparison.objects.using(self._state.db).filter(
+            pk=self.pk).update(**{
+                total_field: models.F(total_field) + base_experience,
+                count_field: models.F(count_field) + count
+            }, **get_change_fields())
+        self.refresh_from_db(
+            fields=[total_field, count_field, 'version', 'modified'])
+
+
+class ComparisonEvent(models.Model):
+    """
+    A change to a list of a comparison. Events are only ever added, so that
+    the lists of any version can be rebuilt from them (see history.py).
+    """
+    ADD = 'add'
+    REMOVE = 'remove'
+    RESET = 'reset'
+    # Marks changes that restore the lists of an older version.
+    RESTORE = 'restore'
+    # Marks the lists that a comparison had when its log started, added by
+    # the events of the same version.
+    START = 'start'
+    KINDS = [
+        (ADD, 'Add'), (REMOVE, 'Remove'), (RESET, 'Reset'),
+        (RESTORE, 'Restore'), (START, 'Start')
+    ]
+
+    comparison = models.ForeignKey(
+        PokemonComparison, on_delete=models.CASCADE, related_name='events')
+    # The version of the comparison after the change.
+    version = models.PositiveIntegerField()
+    kind = models.CharField(max_length=7, choices=KINDS)
+    list_number = models.PositiveSmallIntegerField(null=True)
+    # Position of the pokémon added or removed, or version restored.
+    position = models.PositiveIntegerField(null=True)
+    pokemon = models.ForeignKey(Pokemon, on_delete=models.CASCADE, null=True)
+    created = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        ordering = ['version', 'id']
+        indexes = [
+            models.Index(
+                fields=['comparison', 'version'],
+                name='comparisonevent_version_idx')
+        ]
+
+
+class ComparisonSnapshot(models.Model):
+    """
+    The lists of a comparison at a version, as comma-separated pokémon ids,
+    from which later versions are rebuilt (see history.py).
+    """
+    comparison = models.ForeignKey(
+        PokemonComparison, on_delete=models.CASCADE,
+        related_name='snapshots')
+    version = models.PositiveIntegerField()
+    list1 = models.TextField(blank=True)
+    list2 = models.TextField(blank=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['comparison', 'version'],
+                name='comparisonsnapshot_version_unique')
+        ]
+
+
+class TradeOffer(models.Model):
+    """
+    The first list of a comparison, published by its user to trade it for
+    pokémons worth about `wanted_base_experience` in total, and matched with
+    the offers of other users (see matching.py). Offers are kept in the
+    default database, whichever shard their comparison is in.
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    comparison_id = models.PositiveIntegerField(unique=True)
+    # The pokémons offered, as comma-separated ids, and their total base
+    # experience.
+    pokemons = models.TextField()
+    base_experience = models.PositiveIntegerField()
+    wanted_base_experience = models.PositiveIntegerField()
+    # Set when the matches of the offer may have changed, until it is matched
+    # again.
+    stale = models.BooleanField(default=True)
+    # How far the last match of the offer is from what it wants, when it has
+    # settings.TRADE_MATCH_LIMIT matches. Farther offers cannot be matched.
+    match_distance = models.PositiveIntegerField(null=True)
+    modified = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=['base_experience', 'wanted_base_experience'],
+                name='tradeoffer_totals_idx'),
+            models.Index(
+                fields=['wanted_base_experience', 'base_experience'],
+                name='tradeoffer_wanted_idx')
+        ]
+
+
+class TradeMatch(models.Model):
+    """
+    An offer of another user among the closest to what an offer wants.
+    """
+    # Indexed by the unique constraint, which starts with it.
+    offer = models.ForeignKey(
+        TradeOffer, on_delete=models.CASCADE, related_name='matches',
+        db_index=False)
+    other = models.ForeignKey(
+        TradeOffer, on_delete=models.CASCADE, related_name='matched_by')
+    # Difference between the base experience the offer wants and the one of
+    # the other offer.
+    distance = models.PositiveIntegerField()
+
+    class Meta:
+        ordering = ['distance', 'other']
+        constraints = [
+            models.UniqueConstraint(
+                fields=['offer', 'other'], name='tradematch_unique')
+        ]
@@ -0,0 +1,183 @@
+"""
+This module contains the PokéAPI clients, which give up on requests that
+take too long, and a circuit breaker to stop calling the PokéAPI while it
+keeps failing.
+"""
+import asyncio
+import threading
+import time
+import urllib.parse
+import weakref
+
+import httpx
+import pokepy
+import requests
+from django.conf import settings
+
+
+class TimeoutHTTPAdapter(requests.adapters.HTTPAdapter):
+    """
+    HTTP adapter that applies a timeout to every request sent through it.
+    """
+
+    def __init__(self, timeout, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.timeout = timeout
+
+    def send(self, request, timeout=None, **kwargs):
+        if timeout is None:
+            timeout = self.timeout
+        return super().send(request, timeout=timeout, **kwargs)
+
+
+class PokeAPIClient(pokepy.V2Client):
+    """
+    pokepy client whose requests go to settings.POKEAPI_URL (or `base_url`)
+    and time out after settings.POKEAPI_TIMEOUT seconds (or `timeout`).
+    Connections are kept alive and reused between requests.
+    """
+
+    def __init__(self, base_url=None, timeout=None):
+        self.Meta = type('Meta', (pokepy.V2Client.Meta,), {
+            'base_url': base_url or settings.POKEAPI_URL
+        })
+        super().__init__()
+
+        adapter = TimeoutHTTPAdapter(
+            settings.POKEAPI_TIMEOUT if timeout is None else timeout)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+
+class AsyncPokeAPIClient:
+    """
+    Asynchronous client for the pokémon endpoint of the PokéAPI, with the
+    same URL and timeout settings as PokeAPIClient. Requests made from the
+    same event loop share a pool of up to settings.POKEAPI_MAX_CONNECTIONS
+    connections.
+    """
+
+    def __init__(self, base_url=None, timeout=None, max_connections=None):
+        self.base_url = (base_url or settings.POKEAPI_URL).rstrip('/')
+        self.timeout = settings.POKEAPI_TIMEOUT if timeout is None else timeout
+        self.max_connections = (
+            settings.POKEAPI_MAX_CONNECTIONS if max_connections is None
+            else max_connections)
+        # httpx clients cannot be shared by event loops.
+        self.http_clients = weakref.WeakKeyDictionary()
+        self.lock = threading.Lock()
+
+    def get_http_client(self):
+        loop = asyncio.get_running_loop()
+        with self.lock:
+            if loop not in self.http_clients:
+                self.http_clients[loop] = httpx.AsyncClient(
+                    timeout=self.timeout, limits=httpx.Limits(
+                        max_connections=self.max_connections,
+                        max_keepalive_connections=self.max_connections))
+            return self.http_clients[loop]
+
+    async def get_pokemon(self, name):
+        """
+        Returns the pokémon resource, as a dict. Raises
+        httpx.HTTPStatusError for unsuccessful responses.
+        """
+        response = await self.get_http_client().get('{}/pokemon/{}'.format(
+            self.base_url, urllib.parse.quote(name, safe='')))
+        response.raise_for_status()
+        return response.json()
+
+
+class CircuitOpenError(Exception):
+    """
+    Exception raised by CircuitBreaker.call() while the circuit is open.
+    """
+
+
+class CircuitBreaker:
+    """
+    Calls functions until they fail `failure_threshold` times in a row. Then
+    the circuit opens: for `reset_timeout` seconds, calls fail at once with
+    CircuitOpenError.
+
+    >>> breaker = CircuitBreaker(
+    ...     failure_threshold=2, reset_timeout=60, failure_types=(OSError,))
+    >>> def fail():
+    ...     raise OSError('Upstream is down')
+    >>> for i in range(2):
+    ...     try:
+    ...         breaker.call(fail)
+    ...     except OSError:
+    ...         pass
+    >>> breaker.call(fail)  # doctest: +IGNORE_EXCEPTION_DETAIL
+    Traceback (most recent call last):
+      ...
+    pokeapi.CircuitOpenError: Circuit open after 2 failures.
+
+    Only exceptions of `failure_types` count as failures. After the timeout,
+    one call goes through: if it succeeds the circuit closes, otherwise it
+    stays open for another `reset_timeout` seconds.
+    """
+
+    def __init__(
+            self, failure_threshold, reset_timeout, failure_types=(Exception,),
+            clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failure_types = failure_types
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+
+    def call(self, function, *args, **kwargs):
+        self.before_call()
+        try:
+            result = function(*args, **kwargs)
+        except self.failure_types:
+            self.record_failure()
+            raise
+        self.record_success()
+        return result
+
+    async def call_async(self, function, *args, **kwargs):
+        """
+        Same as call(), for coroutine functions.
+        """
+        self.before_call()
+        try:
+            result = await function(*args, **kwargs)
+        except self.failure_types:
+            self.record_failure()
+            raise
+        self.record_success()
+        return result
+
+    def before_call(self):
+        with self.lock:
+            if self.opened_at is not None:
+                if self.clock() - self.opened_at < self.reset_timeout:
+                    raise CircuitOpenError(
+                        'Circuit open after {} failures.'.format(
+                            self.failures))
+                # Let this call try, but keep failing the others meanwhile.
+                self.opened_at = self.clock()
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                self.opened_at = self.clock()
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
@@ -2,14 +2,45 @@
 This module contains the Pokemon class (to represent pokémons) as well as the
 fetch_pokemon() function to retrieve pokémons.
 """
-import functools
+import collections
+import threading
+import time
+import urllib.parse
 
-import pokepy
+import httpx
+import requests
+from asgiref.sync import sync_to_async
+from beckett.exceptions import InvalidStatusCodeError
+from django.conf import settings
+from django.core.cache import caches
 
-CLIENT = pokepy.V2Client()
+from . import metrics
+from .pokeapi import (
+    PokeAPIClient, AsyncPokeAPIClient, CircuitBreaker, CircuitOpenError)
 
+CLIENT = PokeAPIClient()
 
-@functools.lru_cache(maxsize=512)
+# Used by the async views instead of CLIENT.
+ASYNC_CLIENT = AsyncPokeAPIClient()
+
+# Stops calling the PokéAPI for a while after many consecutive failures.
+BREAKER = CircuitBreaker(
+    settings.POKEAPI_FAILURE_THRESHOLD, settings.POKEAPI_RESET_TIMEOUT,
+    failure_types=(requests.RequestException, InvalidStatusCodeError,
+                   httpx.HTTPError, ValueError))
+
+# Hits, misses and hits of stale entries of the pokédex cache in this
+# process.
+CACHE_STATS = collections.Counter(hits=0, misses=0, stale=0)
+
+# Version of the format of the entries in the pokédex cache.
+CACHE_VERSION = 2
+
+# Cached in place of the data of pokémons that do not exist.
+NO_SUCH_POKEMON = 'no-such-pokemon'
+
+
+@metrics.timed('fetch')
 def fetch_pokemon(name):
     """
     This function retrieves data from the PokéAPI and returns
@@ -34,23 +65,176 @@ def fetch_pokemon(name):
     >>> fetch_pokemon('    charmander      ')
     {'name': 'charmander', 'base_experience': 62, 'picture_url': 'https://raw.githubusercontent.com/PokeAPI/sprites/master/sprites/pokemon/4.png'}
 
-    If the requested Pokémon does not exist, raise an APIException:
+    If the requested Pokémon does not exist, raise a PokemonNotFound
+    exception:
 
     >>> pokemon = fetch_pokemon('agumon')
     Traceback (most recent call last):
      ...
-    pokemon.APIException: There is no such Pokémon called "agumon."
+    pokemon.PokemonNotFound: There is no such Pokémon called "agumon."
     >>> pokemon = fetch_pokemon('flamedramon')
     Traceback (most recent call last):
       ...
-    pokemon.APIException: There is no such Pokémon called "flamedramon."
+    pokemon.PokemonNotFound: There is no such Pokémon called "flamedramon."
+
+    If the PokéAPI cannot answer, raise a PokeAPIUnavailable exception. Both
+    are APIExceptions.
+
+    Results are kept in the pokédex cache (see get_pokedex_cache()), which is
+    shared by all processes. Pokémons are fresh for
+    settings.POKEDEX_CACHE_TIMEOUT seconds. After that, for
+    settings.POKEDEX_STALE_TIMEOUT seconds, the cached pokémon is still
+    returned while it is refreshed in the background. Pokémons that do not
+    exist are cached for settings.POKEDEX_NEGATIVE_CACHE_TIMEOUT seconds.
+    """
+    name = normalize_name(name)
+    entry = get_pokedex_cache().get(
+        get_cache_key(name), version=CACHE_VERSION)
+
+    if entry is None:
+        count_cache_miss()
+        data = refresh_pokemon(name)
+    else:
+        data = read_cache_entry(name, entry)
+
+    return check_found(name, data)
+
+
+async def fetch_pokemon_async(name):
+    """
+    Same as fetch_pokemon(), but requests the PokéAPI with
+    ASYNC_CLIENT, without blocking the event loop.
+    """
+    name = normalize_name(name)
+    with metrics.timed('fetch'):
+        entry = await sync_to_async(
+            get_pokedex_cache().get, thread_sensitive=False)(
+                get_cache_key(name), version=CACHE_VERSION)
+
+        if entry is None:
+            count_cache_miss()
+            data = await refresh_pokemon_async(name)
+        else:
+            data = await sync_to_async(
+                read_cache_entry, thread_sensitive=False)(name, entry)
+
+        return check_found(name, data)
+
+
+def count_cache_miss():
+    CACHE_STATS['misses'] += 1
+    metrics.add('cache_miss')
+
+
+def read_cache_entry(name, entry):
+    """
+    Returns the data in an entry of the pokédex cache, refreshing it in the
+    background if stale.
+    """
+    CACHE_STATS['hits'] += 1
+    metrics.add('cache_hit')
+    fresh_until, data = entry
+    if time.time() > fresh_until:
+        CACHE_STATS['stale'] += 1
+        refresh_in_background(name)
+    return data
 
+
+def check_found(name, data):
+    if data == NO_SUCH_POKEMON:
+        raise PokemonNotFound(name)
+    return data
+
+
+def refresh_pokemon(name):
+    """
+    Retrieves a pokémon from the PokéAPI and stores it in the pokédex cache.
     """
     try:
-        api_pokemon = CLIENT.get_pokemon(name.strip())
-    except:
-        raise APIException(
-            "There is no such Pokémon called \"{}.\"".format(name))
+        data = request_pokemon(name)
+    except PokemonNotFound:
+        store_pokemon(
+            name, NO_SUCH_POKEMON, settings.POKEDEX_NEGATIVE_CACHE_TIMEOUT, 0)
+        raise
+
+    store_pokemon(
+        name, data, settings.POKEDEX_CACHE_TIMEOUT,
+        settings.POKEDEX_STALE_TIMEOUT)
+    return data
+
+
+async def refresh_pokemon_async(name):
+    """
+    Same as refresh_pokemon(), with request_pokemon_async().
+    """
+    try:
+        data = await request_pokemon_async(name)
+    except PokemonNotFound:
+        await sync_to_async(store_pokemon, thread_sensitive=False)(
+            name, NO_SUCH_POKEMON, settings.POKEDEX_NEGATIVE_CACHE_TIMEOUT, 0)
+        raise
+
+    await sync_to_async(store_pokemon, thread_sensitive=False)(
+        name, data, settings.POKEDEX_CACHE_TIMEOUT,
+        settings.POKEDEX_STALE_TIMEOUT)
+    return data
+
+
+def refresh_in_background(name):
+    """
+    Refreshes a pokémon in the pokédex cache in another thread, unless some
+    process is already refreshing it. Returns the thread, if any.
+    """
+    lock_key = 'refreshing:' + get_cache_key(name)
+    cache = get_pokedex_cache()
+    if not cache.add(lock_key, True, settings.POKEAPI_TIMEOUT * 2):
+        return None
+
+    def refresh():
+        try:
+            refresh_pokemon(name)
+        except APIException:
+            pass
+        finally:
+            cache.delete(lock_key)
+
+    thread = threading.Thread(target=refresh, daemon=True)
+    thread.start()
+    return thread
+
+
+def store_pokemon(name, data, fresh_timeout, stale_timeout):
+    get_pokedex_cache().set(
+        get_cache_key(name), (time.time() + fresh_timeout, data),
+        fresh_timeout + stale_timeout, version=CACHE_VERSION)
+
+
+def get_api_pokemon(name):
+    """
+    Asks CLIENT for a pokémon, returning None if there is none with that
+    name. The PokéAPI answers those with a 404, which BREAKER should not
+    count as a failure: typos are no sign of an outage.
+    """
+    try:
+        return CLIENT.get_pokemon(name)
+    except InvalidStatusCodeError as e:
+        if e.status_code == 404:
+            return None
+        raise
+
+
+def request_pokemon(name):
+    """
+    Retrieves a pokémon from the PokéAPI, bypassing the pokédex cache.
+    """
+    try:
+        with metrics.timed('pokeapi'):
+            api_pokemon = BREAKER.call(get_api_pokemon, normalize_name(name))
+    except (CircuitOpenError, requests.RequestException,
+            InvalidStatusCodeError, ValueError):
+        raise PokeAPIUnavailable(name)
+    if api_pokemon is None:
+        raise PokemonNotFound(name)
 
     return {
         'name': api_pokemon.name,
@@ -59,6 +243,71 @@ def fetch_pokemon(name):
     }
 
 
+async def get_api_pokemon_async(name):
+    """
+    Same as get_api_pokemon(), with ASYNC_CLIENT.
+    """
+    try:
+        return await ASYNC_CLIENT.get_pokemon(name)
+    except httpx.HTTPStatusError as e:
+        if e.response.status_code == 404:
+            return None
+        raise
+
+
+async def request_pokemon_async(name):
+    """
+    Same as request_pokemon(), with ASYNC_CLIENT.
+    """
+    try:
+        with metrics.timed('pokeapi'):
+            api_pokemon = await BREAKER.call_async(
+                get_api_pokemon_async, normalize_name(name))
+        if api_pokemon is None:
+            raise PokemonNotFound(name)
+        return {
+            'name': api_pokemon['name'],
+            'base_experience': api_pokemon['base_experience'],
+            'picture_url': api_pokemon['sprites']['front_default']
+        }
+    except (CircuitOpenError, httpx.HTTPError, ValueError, KeyError,
+            TypeError):
+        raise PokeAPIUnavailable(name)
+
+
+def get_pokedex_cache():
+    """
+    Returns the Django cache where fetched pokémons are stored, as configured
+    in settings.POKEDEX_CACHE_ALIAS.
+    """
+    return caches[settings.POKEDEX_CACHE_ALIAS]
+
+
+def normalize_name(name):
+    """
+    Returns the canonical form of a pokémon name, under which pokémons are
+    stored, cached and requested from the PokéAPI. Case and surrounding
+    spaces are ignored:
+
+    >>> normalize_name('  Pikachu ')
+    'pikachu'
+    >>> normalize_name('MR. MIME')
+    'mr. mime'
+    """
+    return name.strip().lower()
+
+
+def get_cache_key(name):
+    """
+    Returns the pokédex cache key of a pokémon name, ignoring case and
+    trailing spaces:
+
+    >>> get_cache_key('  Mr. Mime ')
+    'pokemon:mr.%20mime'
+    """
+    return 'pokemon:' + urllib.parse.quote(normalize_name(name))
+
+
 def compare_pokemon_lists(list1, list2, fairness_threshold=0.1):
     """
     Compare two pokémon lists to report whether it woud be fair to follow with
@@ -118,8 +367,23 @@ def compare_pokemon_lists(list1, list2, fairness_threshold=0.1):
     {'base_experience1': 0, 'base_experience2': 126, 'difference': -126, 'unfairness': nan, 'fair': False, 'success': False}
 
     """
-    base_experience1 = sum(p['base_experience'] for p in list1)
-    base_experience2 = sum(p['base_experience'] for p in list2)
+    return compare_base_experiences(
+        sum(p['base_experience'] for p in list1),
+        sum(p['base_experience'] for p in list2),
+        fairness_threshold=fairness_threshold)
+
+
+def compare_base_experiences(
+        base_experience1, base_experience2, fairness_threshold=0.1):
+    """
+    Compares the total base experiences of two lists, as
+    compare_pokemon_lists() does, for when the totals are already known:
+
+    >>> compare_base_experiences(213, 126)                # doctest: +ELLIPSIS
+    {'base_experience1': 213, 'base_experience2': 126, 'difference': 87, 'unfairness': 0.69..., 'fair': False, 'success': True}
+    >>> compare_base_experiences(0, 126)
+    {'base_experience1': 0, 'base_experience2': 126, 'difference': -126, 'unfairness': nan, 'fair': False, 'success': False}
+    """
     success = base_experience1 > 0 and base_experience2 > 0
     difference = base_experience1 - base_experience2
     smaller_base_experience = min(base_experience1, base_experience2)
@@ -147,3 +411,25 @@ class APIException(Exception):
     def __init__(self, message, *args, **kwargs):
         super().__init__(*(message, *args), **kwargs)
         self.message = message
+
+
+class PokemonNotFound(APIException):
+    """
+    Exception to be raised when there is no pokémon with the given name.
+    """
+
+    def __init__(self, name):
+        super().__init__(
+            "There is no such Pokémon called \"{}.\"".format(name))
+
+
+class PokeAPIUnavailable(APIException):
+    """
+    Exception to be raised when the PokéAPI fails, or takes too long, to
+    answer.
+    """
+
+    def __init__(self, name):
+        super().__init__(
+            "We could not reach the PokéAPI to look for \"{}.\" Please try "
+            "again later.".format(name))
@@ -0,0 +1,154 @@
+"""
+This module sends the queries of requests that change nothing to the read
+replicas of the database, if any (see settings.DATABASE_REPLICAS), so that
+pages being read do not compete with changes for the primary database.
+
+Everything else goes to the primary database: queries outside of requests,
+inside transactions, and after the request wrote something. Clients that
+changed something keep reading from the primary database for
+settings.DATABASE_REPLICA_PIN_SECONDS, longer than replicas should lag
+behind, so that they always see their own changes.
+"""
+import asyncio
+import contextvars
+import random
+import time
+
+import django
+from django.conf import settings
+from django.core.signals import request_started
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections
+from django.utils.decorators import sync_and_async_middleware
+
+# Set, while a client is pinned to the primary database, on its responses.
+PIN_COOKIE = 'db_pin'
+
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+# The routing state of the current request, or None outside of requests.
+CURRENT = contextvars.ContextVar('database_routing', default=None)
+
+# Replicas that failed to connect, with the time they can be tried again.
+_down_until = {}
+
+
+class RoutingState:
+
+    def __init__(self, use_replicas):
+        self.use_replicas = use_replicas
+        self.replica = None
+        self.wrote = False
+
+
+def is_healthy(alias):
+    """
+    Tells whether a replica can be used, connecting to it if needed. Replicas
+    that cannot be connected to are not tried again for
+    settings.DATABASE_REPLICA_RETRY_AFTER seconds.
+    """
+    if time.monotonic() < _down_until.get(alias, 0):
+        return False
+    try:
+        connections[alias].ensure_connection()
+    except DatabaseError:
+        _down_until[alias] = (
+            time.monotonic() + settings.DATABASE_REPLICA_RETRY_AFTER)
+        return False
+    return True
+
+
+class ReplicaRouter:
+
+    def db_for_read(self, model, **hints):
+        state = CURRENT.get()
+        if (state is None or not state.use_replicas or state.wrote
+                or connections[DEFAULT_DB_ALIAS].in_atomic_block):
+            return DEFAULT_DB_ALIAS
+
+        # All reads of a request go to the same replica, so that they see
+        # the same data.
+        if state.replica is None:
+            healthy = [
+                alias for alias in settings.DATABASE_REPLICAS
+                if is_healthy(alias)]
+            state.replica = (
+                random.choice(healthy) if healthy else DEFAULT_DB_ALIAS)
+        return state.replica
+
+    def db_for_write(self, model, **hints):
+        state = CURRENT.get()
+        if state is not None:
+            state.wrote = True
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Replicas hold the same data as the primary database.
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # Replicas get their tables from the primary database.
+        return db == DEFAULT_DB_ALIAS
+
+
+@sync_and_async_middleware
+def replica_routing_middleware(get_response):
+    """
+    Lets ReplicaRouter send the reads of GET and HEAD requests to replicas,
+    unless the client is pinned to the primary database, and pins clients
+    that change something.
+    """
+    def begin(request):
+        return CURRENT.set(RoutingState(
+            use_replicas=bool(settings.DATABASE_REPLICAS)
+            and request.method in SAFE_METHODS
+            and PIN_COOKIE not in request.COOKIES))
+
+    def finish(request, response, token):
+        state = CURRENT.get()
+        CURRENT.reset(token)
+        if settings.DATABASE_REPLICAS and (
+                state.wrote or request.method not in SAFE_METHODS):
+            response.set_cookie(
+                PIN_COOKIE, '1',
+                max_age=settings.DATABASE_REPLICA_PIN_SECONDS,
+                httponly=True, samesite='Lax')
+        return response
+
+    if asyncio.iscoroutinefunction(get_response):
+        async def middleware(request):
+            token = begin(request)
+            try:
+                response = await get_response(request)
+            except BaseException:
+                CURRENT.reset(token)
+                raise
+            return finish(request, response, token)
+    else:
+        def middleware(request):
+            token = begin(request)
+            try:
+                response = get_response(request)
+            except BaseException:
+                CURRENT.reset(token)
+                raise
+            return finish(request, response, token)
+
+    return middleware
+
+
+def close_unusable_connections(**kwargs):
+    """
+    Closes the persistent connections that stopped working, such as the ones
+    to a database that restarted, so that requests reconnect instead of
+    failing. Django does this itself since 4.1, for the databases with
+    CONN_HEALTH_CHECKS.
+    """
+    for connection in connections.all():
+        if (connection.settings_dict.get('CONN_HEALTH_CHECKS')
+                and connection.connection is not None
+                and not connection.is_usable()):
+            connection.close()
+
+
+if django.VERSION < (4, 1):
+    request_started.connect(close_unusable_connections)
@@ -44,11 +44,14 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    "poketrader.metrics.request_metrics_middleware",
+    "poketrader.routers.replica_routing_middleware",
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
     "django.middleware.csrf.CsrfViewMiddleware",
     "django.contrib.auth.middleware.AuthenticationMiddleware",
+    "poketrader.sharding.shard_routing_middleware",
     "django.contrib.messages.middleware.MessageMiddleware",
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
 ]
@@ -84,10 +87,131 @@ DATABASES = {
     }
 }
 
+# Seconds that connections are kept open between requests, and whether they
+# are checked before being reused. Set DATABASE_CONN_MAX_AGE to 0 behind an
+# external pooler such as PgBouncer.
+DATABASE_CONN_MAX_AGE = int(os.environ.get("DATABASE_CONN_MAX_AGE", 600))
+DATABASE_CONN_HEALTH_CHECKS = (
+    os.environ.get("DATABASE_CONN_HEALTH_CHECKS", "1") == "1")
+
 DATABASES['default'].update(
-    dj_database_url.config(conn_max_age=600, ssl_require=True)
+    dj_database_url.config(
+        conn_max_age=DATABASE_CONN_MAX_AGE,
+        conn_health_checks=DATABASE_CONN_HEALTH_CHECKS, ssl_require=True)
 )
 
+# Read replicas of the default database, given as space-separated database
+# URLs in DATABASE_REPLICA_URLS. The reads of GET requests go to them (see
+# poketrader.routers). To try them locally, use the same SQLite file, as in
+# DATABASE_REPLICA_URLS=sqlite:///db.sqlite3. In tests, replicas are the
+# test database.
+DATABASE_REPLICAS = []
+for number, url in enumerate(
+        os.environ.get("DATABASE_REPLICA_URLS", "").split(), 1):
+    alias = "replica{}".format(number)
+    DATABASES[alias] = dj_database_url.parse(
+        url, conn_max_age=DATABASE_CONN_MAX_AGE,
+        conn_health_checks=DATABASE_CONN_HEALTH_CHECKS,
+        ssl_require=not url.startswith("sqlite"),
+        test_options={"MIRROR": "default"})
+    DATABASE_REPLICAS.append(alias)
+
+# Databases that keep the comparisons of the users, each user's in one of
+# them (see poketrader.sharding): the default database, and the ones given
+# as space-separated database URLs in DATABASE_SHARD_URLS. Replicas only
+# serve the default database.
+DATABASE_SHARDS = ["default"]
+for number, url in enumerate(
+        os.environ.get("DATABASE_SHARD_URLS", "").split(), 1):
+    alias = "shard{}".format(number)
+    DATABASES[alias] = dj_database_url.parse(
+        url, conn_max_age=DATABASE_CONN_MAX_AGE,
+        conn_health_checks=DATABASE_CONN_HEALTH_CHECKS,
+        ssl_require=not url.startswith("sqlite"))
+    DATABASE_SHARDS.append(alias)
+
+DATABASE_ROUTERS = [
+    "poketrader.sharding.ShardRouter",
+    "poketrader.routers.ReplicaRouter",
+]
+
+# Seconds that clients read from the default database, instead of the
+# replicas, after changing something, and that replicas that failed to
+# connect are left alone.
+DATABASE_REPLICA_PIN_SECONDS = int(
+    os.environ.get("DATABASE_REPLICA_PIN_SECONDS", 5))
+DATABASE_REPLICA_RETRY_AFTER = 30
+
+# Cache
+# https://docs.djangoproject.com/en/2.0/topics/cache/
+#
+# Pokémons fetched from the PokéAPI go to the "pokedex" cache. It is stored
+# in local files by default so that all workers share it and it survives
+# restarts. To store it in a SQLite (or any other) database instead, set
+# POKEDEX_CACHE_BACKEND to "django.core.cache.backends.db.DatabaseCache",
+# POKEDEX_CACHE_LOCATION to a table name and run `manage.py createcachetable`.
+
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+    },
+    "pokedex": {
+        "BACKEND": os.environ.get(
+            "POKEDEX_CACHE_BACKEND",
+            "django.core.cache.backends.filebased.FileBasedCache"),
+        "LOCATION": os.environ.get(
+            "POKEDEX_CACHE_LOCATION", os.path.join(BASE_DIR, ".cache", "pokedex")),
+        "OPTIONS": {"MAX_ENTRIES": 10000},
+    },
+}
+
+POKEDEX_CACHE_ALIAS = "pokedex"
+
+# Cache for rendered fragments of pages, such as pokémon cards and lists, and
+# seconds to keep them. Fragments are keyed by the data they show, so they
+# never need to be invalidated.
+FRAGMENT_CACHE_ALIAS = os.environ.get("FRAGMENT_CACHE_ALIAS", "default")
+FRAGMENT_CACHE_TIMEOUT = int(os.environ.get("FRAGMENT_CACHE_TIMEOUT", 24 * 3600))
+
+# Seconds an existing pokémon is fresh in the pokédex cache, seconds after
+# that it is still served while being refreshed, and seconds to keep
+# non-existing pokémons.
+POKEDEX_CACHE_TIMEOUT = int(os.environ.get("POKEDEX_CACHE_TIMEOUT", 7 * 24 * 3600))
+POKEDEX_STALE_TIMEOUT = int(
+    os.environ.get("POKEDEX_STALE_TIMEOUT", 30 * 24 * 3600))
+POKEDEX_NEGATIVE_CACHE_TIMEOUT = int(
+    os.environ.get("POKEDEX_NEGATIVE_CACHE_TIMEOUT", 3600))
+
+# PokéAPI client: base URL, seconds to wait for each request, and how many
+# consecutive failures make us stop calling it for POKEAPI_RESET_TIMEOUT
+# seconds.
+POKEAPI_URL = os.environ.get("POKEAPI_URL", "https://pokeapi.co/api/v2")
+POKEAPI_TIMEOUT = float(os.environ.get("POKEAPI_TIMEOUT", 3))
+POKEAPI_FAILURE_THRESHOLD = int(os.environ.get("POKEAPI_FAILURE_THRESHOLD", 5))
+POKEAPI_RESET_TIMEOUT = float(os.environ.get("POKEAPI_RESET_TIMEOUT", 30))
+
+# Maximum number of concurrent requests to the PokéAPI when adding many
+# pokémons at once, and of connections to the PokéAPI kept by each process
+# when serving async views.
+POKEAPI_MAX_WORKERS = int(os.environ.get("POKEAPI_MAX_WORKERS", 8))
+POKEAPI_MAX_CONNECTIONS = int(os.environ.get("POKEAPI_MAX_CONNECTIONS", 100))
+
+# Serve the comparison views asynchronously. Set by asgi.py, so that WSGI
+# deployments keep the synchronous views.
+ASYNC_VIEWS = os.environ.get("ASYNC_VIEWS") == "1"
+
+# Local mirror of the pokémon pictures (see poketrader/sprites.py): directory,
+# URL, seconds to wait for a download, seconds before a picture that could
+# not be mirrored is tried again, largest picture accepted in bytes and size
+# of the thumbnails, which requires Pillow (0 disables them). The sprite view
+# serves SPRITES_URL; change it only if another server does.
+SPRITES_ROOT = os.environ.get("SPRITES_ROOT", os.path.join(BASE_DIR, "sprites"))
+SPRITES_URL = os.environ.get("SPRITES_URL", "/sprites/")
+SPRITE_TIMEOUT = float(os.environ.get("SPRITE_TIMEOUT", 5))
+SPRITE_RETRY_TIMEOUT = int(os.environ.get("SPRITE_RETRY_TIMEOUT", 600))
+SPRITE_MAX_BYTES = int(os.environ.get("SPRITE_MAX_BYTES", 1024 * 1024))
+SPRITE_THUMBNAIL_SIZE = int(os.environ.get("SPRITE_THUMBNAIL_SIZE", 96))
+
 # Password validation
 # https://docs.djangoproject.com/en/2.0/ref/settings/#auth-password-validators
 
@@ -125,4 +249,56 @@ LOGIN_URL = '/login'
 LOGIN_REDIRECT_URL = '/'
 LOGOUT_REDIRECT_URL = '/'
 
+# Largest unfairness factor (see pokemon.compare_pokemon_lists()) of a fair
+# trade.
+FAIRNESS_THRESHOLD = float(os.environ.get("FAIRNESS_THRESHOLD", 0.15))
+
+# Seconds before the index of pokémons used for suggesting fair trades is
+# rebuilt from the database.
+SUGGESTION_INDEX_TIMEOUT = 600
+
+# Seconds before the index of pokémon names used for autocompletion is
+# rebuilt from the database, and most names completed for each prefix.
+AUTOCOMPLETE_INDEX_TIMEOUT = 600
+AUTOCOMPLETE_LIMIT = 10
+
+# Most events of the history of a comparison replayed to rebuild its lists at
+# a version, such as when undoing a change, before a snapshot of them is
+# saved (see poketrader.history).
+HISTORY_SNAPSHOT_INTERVAL = 50
+
+# Most matches kept for each trade offer, among the offers of other users
+# (see poketrader.matching).
+TRADE_MATCH_LIMIT = 10
+
+# Number of comparisons shown on each page of the index.
+COMPARISONS_PER_PAGE = 25
+
+# Rows read by each query of an export of comparisons, and comparisons
+# created by each transaction of an import.
+EXPORT_CHUNK_SIZE = 1000
+IMPORT_BATCH_SIZE = 500
+
+# Upper bounds, in seconds, of the buckets of the latency histograms of each
+# view, shown at /metrics to staff members.
+METRICS_LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
 django_heroku.settings(locals())
+
+# django_heroku configures the default database from DATABASE_URL on its own.
+DATABASES["default"]["CONN_MAX_AGE"] = DATABASE_CONN_MAX_AGE
+DATABASES["default"]["CONN_HEALTH_CHECKS"] = DATABASE_CONN_HEALTH_CHECKS
+
+# Metrics of each request (see poketrader.metrics) are logged as JSON lines.
+LOGGING["loggers"]["poketrader.metrics"] = {
+    "handlers": ["console"],
+    "level": os.environ.get("METRICS_LOG_LEVEL", "INFO"),
+    "propagate": False,
+}
+
+# Progress of the data migrations (see poketrader.data_migrations).
+LOGGING["loggers"]["poketrader.data_migrations"] = {
+    "handlers": ["console"],
+    "level": "INFO",
+    "propagate": False,
+}
@@ -0,0 +1,361 @@
+"""
+This module spreads the comparisons of the users, with their items, across
+several databases, the shards listed in settings.DATABASE_SHARDS, so that
+writes are not limited by what a single database can take. All comparisons
+of a user are kept in the same shard, so the pages of a user only query
+that shard. Users, sessions and everything else stay in the default
+database, and the pokémon catalog is copied to every shard, as items refer
+to it.
+
+New users are placed by rendezvous hashing of their id, which is stable and
+only moves the users that hash to a new shard when one is added. Where the
+comparisons of each user are is recorded in UserShard, in the default
+database, so users stay on their shard until `manage.py rebalance_shards`
+moves them. Comparison ids are unique across shards (see allocate_ids()), so
+they do not change when comparisons are moved.
+"""
+import asyncio
+import contextlib
+import contextvars
+import hashlib
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, IntegrityError, models, transaction
+from django.db.models.signals import post_save, pre_delete
+from django.http import HttpResponse
+from django.utils.decorators import sync_and_async_middleware
+
+from .models import (
+    ComparisonEvent, ComparisonSnapshot, Pokemon, PokemonComparison,
+    PokemonListItem, User, UserShard, is_sharded)
+from .routers import SAFE_METHODS
+
+# Models whose rows are kept in the shard of their user.
+SHARDED_MODELS = {
+    'poketrader.pokemoncomparison', 'poketrader.pokemonlistitem',
+    'poketrader.comparisonevent', 'poketrader.comparisonsnapshot'
+}
+
+# Models of the rows that belong to comparisons, moved with them.
+RELATED_MODELS = [PokemonListItem, ComparisonEvent, ComparisonSnapshot]
+
+# Models only kept in the default database, even when it is not a shard.
+DEFAULT_ONLY_MODELS = {'usershard', 'idsequence', 'tradeoffer', 'tradematch'}
+
+# Seconds clients are told to wait before changing comparisons being moved.
+MOVING_RETRY_AFTER = 60
+
+# The shard of the user of the current request, or None outside of requests.
+CURRENT = contextvars.ContextVar('shard_routing', default=None)
+
+
+def get_placement(user_id, shards=None):
+    """
+    Returns the shard that a user belongs to, among `shards`
+    (settings.DATABASE_SHARDS by default): the one with the highest hash of
+    its name and the user id. Adding a shard only changes the placement of
+    the users that go to the new shard:
+
+    >>> shards = ['default', 'shard1']
+    >>> placements = [get_placement(i, shards) for i in range(1000)]
+    >>> more = [get_placement(i, shards + ['shard2']) for i in range(1000)]
+    >>> all(new in (old, 'shard2') for old, new in zip(placements, more))
+    True
+    """
+    def weight(shard):
+        key = '{}:{}'.format(shard, user_id).encode()
+        return hashlib.sha1(key).digest()
+
+    return max(shards or settings.DATABASE_SHARDS, key=weight)
+
+
+def get_user_shard(user_id):
+    """
+    Returns the UserShard entry of a user, placing the user on a shard if it
+    has none yet. Users with comparisons from before sharding was enabled
+    are placed on the default database, where they are.
+    """
+    entries = UserShard.objects.using(DEFAULT_DB_ALIAS)
+    entry = entries.filter(user_id=user_id).first()
+    if entry is None:
+        if PokemonComparison.objects.using(DEFAULT_DB_ALIAS).filter(
+                user_id=user_id).exists():
+            shard = DEFAULT_DB_ALIAS
+        else:
+            shard = get_placement(user_id)
+        try:
+            with transaction.atomic(using=DEFAULT_DB_ALIAS):
+                entry = entries.create(user_id=user_id, shard=shard)
+        except IntegrityError:
+            # Another request placed the user meanwhile.
+            entry = entries.get(user_id=user_id)
+    return entry
+
+
+class ShardState:
+    """
+    The shard of a user, looked up when first needed.
+    """
+
+    def __init__(self, get_user_id):
+        self.get_user_id = get_user_id
+        self._entry = None
+
+    @property
+    def entry(self):
+        if self._entry is None:
+            user_id = self.get_user_id()
+            if user_id is None:
+                return None
+            self._entry = get_user_shard(user_id)
+        return self._entry
+
+    @property
+    def shard(self):
+        entry = self.entry
+        return DEFAULT_DB_ALIAS if entry is None else entry.shard
+
+
+@contextlib.contextmanager
+def using_user(user_id):
+    """
+    Sends the queries of comparisons and items without an instance or user
+    to tell their shard, outside of requests, to the shard of a user.
+    """
+    token = CURRENT.set(ShardState(lambda: user_id))
+    try:
+        yield
+    finally:
+        CURRENT.reset(token)
+
+
+def is_sharded_instance(obj):
+    return (isinstance(obj, models.Model)
+            and obj._meta.label_lower in SHARDED_MODELS)
+
+
+class ShardRouter:
+    """
+    Sends the queries of comparisons and items to the shard of their user,
+    known from the instance or the user given as hints, or the user of the
+    current request. Leaves everything else to the next router.
+    """
+
+    def get_shard(self, model, **hints):
+        if not is_sharded() or model._meta.label_lower not in SHARDED_MODELS:
+            return None
+
+        # Related instances are given as hints, too, such as the user of a
+        # new comparison.
+        instance = hints.get('instance')
+        user = hints.get('user')
+        if isinstance(instance, User):
+            user = instance
+        elif is_sharded_instance(instance):
+            if instance._state.db:
+                return instance._state.db
+            user = getattr(instance, 'user_id', None)
+        user_id = getattr(user, 'pk', user)
+        if user_id is not None:
+            return get_user_shard(user_id).shard
+
+        state = CURRENT.get()
+        return DEFAULT_DB_ALIAS if state is None else state.shard
+
+    db_for_read = get_shard
+    db_for_write = get_shard
+
+    def allow_relation(self, obj1, obj2, **hints):
+        if (is_sharded() and is_sharded_instance(obj1)
+                and is_sharded_instance(obj2)):
+            return obj1._state.db == obj2._state.db
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db not in settings.DATABASE_SHARDS or db == DEFAULT_DB_ALIAS:
+            return None
+        return not (
+            app_label == 'poketrader' and model_name in DEFAULT_ONLY_MODELS)
+
+
+def get_moving_response(request):
+    """
+    Returns a 503 response if the request would change the comparisons of a
+    user while they are moved to another shard, or None.
+    """
+    if request.method in SAFE_METHODS or not is_sharded():
+        return None
+    entry = CURRENT.get().entry
+    if entry is None or not entry.moving:
+        return None
+    response = HttpResponse(
+        'Your comparisons are being moved, please try again in a minute.',
+        status=503, content_type='text/plain')
+    response['Retry-After'] = str(MOVING_RETRY_AFTER)
+    return response
+
+
+@sync_and_async_middleware
+def shard_routing_middleware(get_response):
+    """
+    Lets ShardRouter send the queries of comparisons and items to the shard
+    of the user of each request, and rejects changes to them while they are
+    moved. Must come after the authentication middleware.
+    """
+    def begin(request):
+        def get_user_id():
+            user = request.user
+            return user.pk if user.is_authenticated else None
+        return CURRENT.set(ShardState(get_user_id))
+
+    if asyncio.iscoroutinefunction(get_response):
+        async def middleware(request):
+            token = begin(request)
+            try:
+                response = await sync_to_async(get_moving_response)(request)
+                if response is None:
+                    response = await get_response(request)
+            finally:
+                CURRENT.reset(token)
+            return response
+    else:
+        def middleware(request):
+            token = begin(request)
+            try:
+                response = get_moving_response(request)
+                if response is None:
+                    response = get_response(request)
+            finally:
+                CURRENT.reset(token)
+            return response
+
+    return middleware
+
+
+def get_other_shards():
+    """
+    Returns the shards other than the default database, which keep a copy of
+    its pokémons.
+    """
+    return [alias for alias in settings.DATABASE_SHARDS
+            if alias != DEFAULT_DB_ALIAS]
+
+
+def replicate_catalog(ids=None, batch_size=1000):
+    """
+    Copies the pokémons with the given ids (all by default) from the default
+    database to the other shards, in batches. Returns the number of
+    pokémons copied.
+    """
+    pokemons = Pokemon.objects.using(DEFAULT_DB_ALIAS).order_by('pk')
+    if ids is not None:
+        pokemons = pokemons.filter(pk__in=ids)
+    fields = [field.name for field in Pokemon._meta.concrete_fields
+              if not field.primary_key]
+
+    copied = 0
+    for alias in get_other_shards():
+        last_id = 0
+        while True:
+            batch = list(pokemons.filter(pk__gt=last_id)[:batch_size])
+            if not batch:
+                break
+            copies = Pokemon.objects.using(alias)
+            existing = set(copies.filter(
+                pk__in=[p.pk for p in batch]).values_list('pk', flat=True))
+            with transaction.atomic(using=alias):
+                copies.bulk_update(
+                    [p for p in batch if p.pk in existing], fields)
+                copies.bulk_create(
+                    [p for p in batch if p.pk not in existing])
+            copied += len(batch)
+            last_id = batch[-1].pk
+    return copied
+
+
+def replicate_saved_pokemon(sender, instance, using, **kwargs):
+    if using == DEFAULT_DB_ALIAS and is_sharded():
+        replicate_catalog([instance.pk])
+
+
+def delete_sharded_comparisons(sender, instance, using, **kwargs):
+    """
+    Deletes the comparisons of a deleted user that are not in the default
+    database, which Django does not look for.
+    """
+    if using == DEFAULT_DB_ALIAS and is_sharded():
+        for alias in get_other_shards():
+            PokemonComparison.objects.using(alias).filter(
+                user_id=instance.pk).delete()
+
+
+post_save.connect(replicate_saved_pokemon, sender=Pokemon)
+pre_delete.connect(delete_sharded_comparisons, sender=User)
+
+
+def delete_user_data(user_id, alias):
+    """
+    Deletes the comparisons of a user, with their items, from a shard.
+    """
+    return PokemonComparison.objects.using(alias).filter(
+        user_id=user_id).delete()[0]
+
+
+def get_related_rows(model, comparisons, using):
+    """
+    Returns copies of the rows of a model that belong to the given
+    comparisons, in order, without their ids, which nothing else refers to.
+    """
+    fields = [field.attname for field in model._meta.concrete_fields
+              if not field.primary_key]
+    rows = model._base_manager.using(using).filter(
+        comparison__in=comparisons).order_by('id').values_list(*fields)
+    return [model(**dict(zip(fields, row))) for row in rows]
+
+
+def move_user(entry, target, batch_size=500):
+    """
+    Moves the comparisons of a user, with their items and history, to the
+    `target` shard, and records it in its UserShard entry. Comparisons are
+    copied in batches of `batch_size`, each one in a transaction, while the
+    entry is marked as moving so that requests do not change them. They are
+    deleted from the old shard once the entry tells the new one.
+
+    Returns the number of comparisons moved.
+    """
+    source = entry.shard
+    entries = UserShard.objects.using(DEFAULT_DB_ALIAS).filter(pk=entry.pk)
+    entries.update(moving=True)
+    try:
+        # Leftovers of an interrupted move.
+        delete_user_data(entry.pk, target)
+
+        comparisons = PokemonComparison.objects.using(source).filter(
+            user_id=entry.pk).order_by('id')
+        moved = 0
+        last_id = 0
+        while True:
+            batch = list(comparisons.filter(id__gt=last_id)[:batch_size])
+            if not batch:
+                break
+            related = [
+                (model, get_related_rows(model, batch, source))
+                for model in RELATED_MODELS]
+            with transaction.atomic(using=target):
+                PokemonComparison.objects.using(target).bulk_create(batch)
+                for model, rows in related:
+                    model._base_manager.using(target).bulk_create(
+                        rows, batch_size=batch_size)
+            moved += len(batch)
+            last_id = batch[-1].id
+
+        entries.update(shard=target, moving=False)
+    except BaseException:
+        entries.update(moving=False)
+        raise
+
+    entry.shard = target
+    entry.moving = False
+    delete_user_data(entry.pk, source)
+    return moved
@@ -0,0 +1,199 @@
+"""
+This module keeps a local mirror of the pokémon sprites. Each sprite is
+downloaded once from its picture_url and stored under a name derived from
+its content, so that it can be served with far-future cache headers.
+Thumbnails are made too, if Pillow is installed.
+
+Requests never wait for a download: sprites are mirrored in the background
+when pokémons are stored, or by `manage.py mirror_sprites`, and pages show
+the original pictures until then.
+"""
+import hashlib
+import io
+import threading
+
+import requests
+from django.conf import settings
+from django.core.cache import caches
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage
+from django.db import connections
+
+from .pokeapi import TimeoutHTTPAdapter
+
+try:
+    from PIL import Image
+except ImportError:  # pragma: no cover
+    Image = None
+
+# Extensions of the image types accepted as sprites. Others, such as SVG,
+# could carry scripts.
+EXTENSIONS = {
+    'image/png': 'png',
+    'image/gif': 'gif',
+    'image/jpeg': 'jpg',
+    'image/webp': 'webp',
+}
+
+# Pattern of the names of stored sprites and thumbnails.
+NAME_PATTERN = r'[0-9a-f]{64}(-[0-9]+)?\.(png|gif|jpg|webp)'
+
+
+class SpriteUnavailable(Exception):
+    """
+    Exception raised when a sprite cannot be downloaded.
+    """
+
+
+def get_sprite_storage():
+    """
+    Returns the storage of the sprites, in settings.SPRITES_ROOT.
+    """
+    return FileSystemStorage(
+        location=settings.SPRITES_ROOT, base_url=settings.SPRITES_URL)
+
+
+def get_session():
+    session = requests.Session()
+    adapter = TimeoutHTTPAdapter(settings.SPRITE_TIMEOUT)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def download_sprite(url, session=None):
+    """
+    Returns the content and the extension of the image at `url`. Raises
+    SpriteUnavailable if it cannot be downloaded, is not a PNG, GIF, JPEG or
+    WebP image, or is larger than settings.SPRITE_MAX_BYTES.
+    """
+    session = session or get_session()
+    try:
+        with session.get(url, stream=True) as response:
+            response.raise_for_status()
+            content_type = response.headers.get('Content-Type', '')
+            extension = EXTENSIONS.get(content_type.split(';')[0].strip())
+            if extension is None:
+                raise SpriteUnavailable(
+                    '{} is not an image: {}'.format(url, content_type))
+
+            content = b''
+            for chunk in response.iter_content(64 * 1024):
+                content += chunk
+                if len(content) > settings.SPRITE_MAX_BYTES:
+                    raise SpriteUnavailable('{} is too large'.format(url))
+    except requests.RequestException as e:
+        raise SpriteUnavailable('Could not download {}: {}'.format(url, e))
+
+    return content, extension
+
+
+def store_sprite(content, extension):
+    """
+    Stores a sprite, unless it is already stored, and returns its name. Also
+    returns the name of its thumbnail, if one was made, or an empty string.
+    """
+    storage = get_sprite_storage()
+    digest = hashlib.sha256(content).hexdigest()
+    name = '{}.{}'.format(digest, extension)
+    save_once(storage, name, content)
+
+    thumbnail = ''
+    size = settings.SPRITE_THUMBNAIL_SIZE
+    if Image is not None and size:
+        thumbnail = '{}-{}.png'.format(digest, size)
+        if not storage.exists(thumbnail):
+            content = make_thumbnail(content, size)
+            if content is None:
+                thumbnail = ''
+            else:
+                save_once(storage, thumbnail, content)
+
+    return name, thumbnail
+
+
+def save_once(storage, name, content):
+    """
+    Saves a file unless it already exists. Content-addressed files with the
+    same name are the same, so if another process saved it meanwhile, the
+    copy is deleted.
+    """
+    if storage.exists(name):
+        return
+    saved = storage.save(name, ContentFile(content))
+    if saved != name:
+        storage.delete(saved)
+
+
+def make_thumbnail(content, size):
+    """
+    Returns a PNG of the image scaled down to fit in a `size` square, or
+    None if it is not larger than that or cannot be read.
+    """
+    try:
+        image = Image.open(io.BytesIO(content))
+        if max(image.size) <= size:
+            return None
+        image.thumbnail((size, size))
+    except (OSError, ValueError, Image.DecompressionBombError):
+        return None
+
+    output = io.BytesIO()
+    if image.mode not in ('RGB', 'RGBA', 'L', 'LA', 'P'):
+        image = image.convert('RGBA')
+    image.save(output, format='PNG', optimize=True)
+    return output.getvalue()
+
+
+def mirror_sprite(pokemon, session=None):
+    """
+    Downloads and stores the sprite of a pokémon and saves its local names.
+    Raises SpriteUnavailable if it cannot be downloaded.
+    """
+    pokemon.sprite, pokemon.thumbnail = fetch_sprite(pokemon, session)
+    pokemon.save(update_fields=['sprite', 'thumbnail'])
+
+
+def fetch_sprite(pokemon, session=None):
+    """
+    Downloads and stores the sprite of a pokémon, as mirror_sprite() does,
+    but only returns the names of the sprite and its thumbnail, without
+    touching the database.
+    """
+    if not pokemon.picture_url:
+        raise SpriteUnavailable('{} has no picture'.format(pokemon.name))
+
+    content, extension = download_sprite(pokemon.picture_url, session)
+    return store_sprite(content, extension)
+
+
+def mirror_in_background(pokemons):
+    """
+    Mirrors the sprites of pokémons in another thread, skipping the ones
+    some process tried to mirror in the last settings.SPRITE_RETRY_TIMEOUT
+    seconds, so that a host that is down is not asked again for each of
+    its pictures. Returns the thread, if any.
+    """
+    cache = caches[settings.POKEDEX_CACHE_ALIAS]
+    pokemons = [
+        pokemon for pokemon in pokemons
+        if cache.add('mirroring:{}'.format(pokemon.pk), True,
+                     settings.SPRITE_RETRY_TIMEOUT)
+    ]
+    if not pokemons:
+        return None
+
+    def mirror():
+        session = get_session()
+        try:
+            for pokemon in pokemons:
+                try:
+                    mirror_sprite(pokemon, session)
+                except SpriteUnavailable:
+                    pass
+        finally:
+            connections.close_all()
+
+    thread = threading.Thread(target=mirror, daemon=True)
+    thread.start()
+    return thread
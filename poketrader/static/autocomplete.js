@@ -0,0 +1,31 @@
+// Completes the last of the comma-separated pokémon names typed in the
+// inputs with a data-autocomplete-url, offering the whole input with each
+// completion in their datalist.
+document.querySelectorAll('input[data-autocomplete-url]').forEach(function (input) {
+  var datalist = document.getElementById(input.getAttribute('list'));
+  var completed = {};
+
+  input.addEventListener('input', function () {
+    var names = input.value.split(',');
+    var prefix = names.pop().trim();
+    var typed = names.map(function (name) { return name.trim(); });
+    if (!prefix || completed[input.value]) {
+      return;
+    }
+
+    var url = input.dataset.autocompleteUrl + '?q=' + encodeURIComponent(prefix);
+    fetch(url).then(function (response) {
+      return response.json();
+    }).then(function (data) {
+      datalist.innerHTML = '';
+      completed = {};
+      data.names.forEach(function (name) {
+        var value = typed.concat([name]).join(', ');
+        var option = document.createElement('option');
+        option.value = value;
+        datalist.appendChild(option);
+        completed[value] = true;
+      });
+    });
+  });
+});
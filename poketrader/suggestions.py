@@ -0,0 +1,198 @@
+"""
+This module suggests pokémons to add to the weaker list of a comparison to
+make it fair. Suggestions come from an in-memory index of the pokémons
+sorted by base experience, so each one costs a few binary searches instead
+of a scan of the whole pokédex.
+"""
+import bisect
+import collections
+import math
+import threading
+import time
+
+from django.conf import settings
+
+from .models import Pokemon
+from .pokemon import compare_base_experiences
+
+
+class BaseExperienceIndex:
+    """
+    Pokémon names grouped by base experience, with the distinct base
+    experiences in a sorted list:
+
+    >>> index = BaseExperienceIndex(
+    ...     [('pikachu', 112), ('ditto', 101), ('raichu', 112)])
+    >>> index.values
+    [101, 112]
+    >>> index.names[112]
+    ['pikachu', 'raichu']
+    """
+
+    def __init__(self, pokemons):
+        names = collections.defaultdict(list)
+        for name, base_experience in pokemons:
+            names[base_experience].append(name)
+
+        self.values = sorted(names)
+        self.names = {value: sorted(n) for value, n in names.items()}
+
+    @classmethod
+    def from_database(cls):
+        return cls(Pokemon.objects.values_list('name', 'base_experience'))
+
+    def closest(self, target, low, high, count):
+        """
+        Returns up to `count` base experiences between `low` and `high`
+        (inclusive), the closest to `target` first:
+
+        >>> index = BaseExperienceIndex(
+        ...     [('a', 10), ('b', 20), ('c', 30), ('d', 40), ('e', 50)])
+        >>> index.closest(32, 15, 45, 3)
+        [30, 40, 20]
+        >>> index.closest(32, 35, 45, 3)
+        [40]
+        """
+        start = bisect.bisect_left(self.values, low)
+        stop = bisect.bisect_right(self.values, high)
+        after = min(max(bisect.bisect_left(self.values, target), start), stop)
+        before = after - 1
+
+        closest = []
+        while len(closest) < count and (before >= start or after < stop):
+            if after >= stop or (
+                    before >= start
+                    and target - self.values[before]
+                    <= self.values[after] - target):
+                closest.append(self.values[before])
+                before -= 1
+            else:
+                closest.append(self.values[after])
+                after += 1
+        return closest
+
+
+_index = None
+_index_built_at = 0
+_index_lock = threading.Lock()
+
+
+def get_index():
+    """
+    Returns the base experience index of this process, rebuilding it when
+    it is older than settings.SUGGESTION_INDEX_TIMEOUT seconds.
+    """
+    global _index, _index_built_at
+
+    with _index_lock:
+        if (_index is None or time.monotonic() - _index_built_at
+                > settings.SUGGESTION_INDEX_TIMEOUT):
+            _index = BaseExperienceIndex.from_database()
+            _index_built_at = time.monotonic()
+        return _index
+
+
+def invalidate_index():
+    global _index
+
+    with _index_lock:
+        _index = None
+
+
+def get_fair_range(weaker, stronger, fairness_threshold):
+    """
+    Returns the smallest and largest base experience that, added to the
+    weaker list, would make the trade fair:
+
+    >>> get_fair_range(100, 200, 0.1)
+    (82, 120)
+    """
+    low = math.floor(stronger / (1 + fairness_threshold) - weaker)
+    high = math.ceil(stronger * (1 + fairness_threshold) - weaker)
+    # Rounding outwards, and then checking, keeps us safe from float errors.
+    while not compare_base_experiences(
+            weaker + low, stronger, fairness_threshold)['fair']:
+        low += 1
+    while not compare_base_experiences(
+            weaker + high, stronger, fairness_threshold)['fair']:
+        high -= 1
+    return max(low, 1), high
+
+
+def suggest_additions(
+        base_experience1, base_experience2, fairness_threshold, count=5,
+        index=None):
+    """
+    Suggests pokémons to add to the weaker list to make a trade fair.
+
+    Returns the number of the weaker list (or None if there is nothing to
+    suggest), a list of single pokémons and a list of pairs of pokémons,
+    each one with the pokémon names, the base experience they add and the
+    resulting unfairness, the fairest first:
+
+    >>> index = BaseExperienceIndex(
+    ...     [('ditto', 101), ('pikachu', 112), ('caterpie', 39),
+    ...      ('weedle', 39), ('rattata', 51)])
+    >>> list_number, singles, pairs = suggest_additions(
+    ...     200, 100, 0.1, count=2, index=index)
+    >>> list_number
+    2
+    >>> [(s['names'], s['base_experience']) for s in singles]
+    [(['ditto'], 101), (['pikachu'], 112)]
+    >>> [(s['names'], s['base_experience']) for s in pairs]
+    [(['rattata', 'rattata'], 102), (['caterpie', 'rattata'], 90)]
+
+    Already fair trades need nothing:
+
+    >>> suggest_additions(100, 105, 0.1, index=index)
+    (None, [], [])
+    """
+    if index is None:
+        index = get_index()
+
+    if base_experience1 <= base_experience2:
+        list_number, weaker, stronger = 1, base_experience1, base_experience2
+    else:
+        list_number, weaker, stronger = 2, base_experience2, base_experience1
+
+    if stronger <= 0 or compare_base_experiences(
+            weaker, stronger, fairness_threshold)['fair']:
+        return None, [], []
+
+    low, high = get_fair_range(weaker, stronger, fairness_threshold)
+    target = stronger - weaker
+
+    def suggestion(names, added):
+        return {
+            'names': names,
+            'base_experience': added,
+            'unfairness': compare_base_experiences(
+                weaker + added, stronger, fairness_threshold)['unfairness']
+        }
+
+    singles = []
+    for value in index.closest(target, low, high, count):
+        for name in index.names[value]:
+            singles.append(suggestion([name], value))
+    singles = singles[:count]
+
+    # For each base experience, the closest one that completes a fair pair.
+    candidates = []
+    for value in index.values:
+        if 2 * value > high:
+            break
+        for other in index.closest(
+                target - value, max(low - value, value), high - value, 1):
+            candidates.append((abs(value + other - target), value, other))
+
+    pairs = []
+    for _, value, other in sorted(candidates)[:count]:
+        if value == other:
+            names = index.names[value][:2]
+            if len(names) < 2:
+                names = names * 2
+        else:
+            names = [index.names[value][0], index.names[other][0]]
+        pairs.append(suggestion(names, value + other))
+
+    return list_number, singles, pairs
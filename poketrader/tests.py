@@ -1,19 +1,92 @@
+import asyncio
+import base64
 import contextlib
-
-from django.test import TestCase, RequestFactory
+import csv
+import hashlib
+import http.server
+import io
+import json
+import logging
+import math
+import os
+import random
+import re
+import tempfile
+import threading
+import time
+import types
+import unittest
+from unittest import mock
+
+from asgiref.sync import async_to_sync
+from beckett.exceptions import InvalidStatusCodeError
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.utils import make_template_fragment_key
+from django.core.management import call_command
+from django.test import (
+    AsyncRequestFactory, Client, TestCase, RequestFactory, override_settings)
+from django.test.utils import CaptureQueriesContext
+from django.db import OperationalError, connection
+from django.http import HttpResponse
 from django.contrib.auth.models import User, AnonymousUser
 from django.contrib.messages.middleware import MessageMiddleware
 from django.contrib import messages
 
 from .views import (
     index as index_view, reset as reset_view, remove as remove_view,
-    comparison as comparison_view, delete as delete_view)
-from .models import Pokemon, PokemonComparison
-
-
+    comparison as comparison_view, delete as delete_view, add as add_view,
+    resolve_pokemons)
+from .models import (
+    ComparisonSnapshot, Pokemon, PokemonComparison, PokemonListItem,
+    TradeOffer, UserShard, allocate_ids)
+from . import async_views, pokemon
+from .pokeapi import PokeAPIClient, AsyncPokeAPIClient
+from .pokemon import (
+    fetch_pokemon, fetch_pokemon_async, get_pokedex_cache,
+    compare_base_experiences, APIException,
+    PokemonNotFound, PokeAPIUnavailable, CACHE_STATS)
+from .fairness import compare_base_experience_arrays, sweep_thresholds
+from .suggestions import invalidate_index, suggest_additions
+from .autocomplete import invalidate_index as invalidate_autocomplete_index
+from .benchmarks import generate_dataset, run_scenarios
+from .metrics import reset_latency_histograms
+from .sprites import (
+    mirror_in_background, mirror_sprite, SpriteUnavailable, Image)
+from . import history, matching, routers, sharding, views
+from .data_migrations import (
+    migrate_in_chunks, forget_progress, bulk_create_with_ids)
+
+# Keeps the metrics of each request, and the progress of the migrations of
+# the test database, out of the test output.
+logging.getLogger('poketrader.metrics').setLevel(logging.WARNING)
+logging.getLogger('poketrader.data_migrations').setLevel(logging.WARNING)
+
+TEST_CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'pokedex': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'test-pokedex',
+    },
+}
+
+
+def make_api_pokemon(name, base_experience, number):
+    return types.SimpleNamespace(
+        name=name, base_experience=base_experience,
+        sprites=types.SimpleNamespace(
+            front_default='http://example.com/{}.png'.format(number)))
+
+
+@override_settings(CACHES=TEST_CACHES)
 class ViewTestCase(TestCase):
 
     def setUp(self):
+        get_pokedex_cache().clear()
+        caches[settings.FRAGMENT_CACHE_ALIAS].clear()
+        pokemon.BREAKER.reset()
         self.factory = RequestFactory()
         self.session = {}
         self.user = AnonymousUser()
@@ -69,6 +142,20 @@ class ViewTestCase(TestCase):
     def get_comparison(self, user):
         return PokemonComparison.objects.get(user=user)
 
+    def create_comparison(self, user, names1=(), names2=()):
+        comparison = PokemonComparison.objects.create(user=user)
+
+        for list_number, names in ((1, names1), (2, names2)):
+            for name in names:
+                pokemon, _ = Pokemon.objects.get_or_create(
+                    name=name, defaults={
+                        'base_experience': len(name) * 10,
+                        'picture_url': 'http://example.com/{}.png'.format(name)
+                    })
+                comparison.add_pokemon(pokemon, list_number)
+
+        return comparison
+
     def _set_up_request(self, request):
         request.session = self.session
 
@@ -286,9 +373,68 @@ class IndexGetViewTest(ViewTestCase):
 
         self.assertRedirect(response, '/login')
 
+    def test_get_page_constant_number_of_queries(self):
+        with self.logged_in() as user:
+            self.create_comparison(user, ['pikachu'], ['ditto'])
+
+            with self.assertNumQueries(2):
+                index_view(self.get_get_request('/'))
+
+            for i in range(10):
+                self.create_comparison(
+                    user, ['pikachu', 'ditto', 'mew'], ['bulbasaur', 'onix'])
+
+            with self.assertNumQueries(2):
+                response = index_view(self.get_get_request('/'))
+
+            content = response.content.decode(response.charset)
+            self.assertIn('pikachu, ditto, mew', content)
+            self.assertIn('bulbasaur, onix', content)
+
+    @override_settings(COMPARISONS_PER_PAGE=2)
+    def test_get_page_paginated(self):
+        with self.logged_in() as user:
+            comparisons = [
+                self.create_comparison(user, [name], ['ditto'])
+                for name in ('pikachu', 'charmander', 'bulbasaur')
+            ]
+
+            response = index_view(self.get_get_request('/'))
+
+            content = response.content.decode(response.charset)
+            self.assertIn('bulbasaur', content)
+            self.assertIn('charmander', content)
+            self.assertNotIn('pikachu', content)
+            self.assertIn('?before={}'.format(comparisons[1].id), content)
+
+            response = index_view(self.get_get_request(
+                '/', before=comparisons[1].id))
+
+            content = response.content.decode(response.charset)
+            self.assertIn('pikachu', content)
+            self.assertNotIn('charmander', content)
+            self.assertNotIn('?before=', content)
+
+    def test_get_page_invalid_page(self):
+        with self.logged_in() as user:
+            response = index_view(self.get_get_request('/', before='x'))
+
+            self.assertEqual(response.status_code, 400)
+
 
 class ComparisonViewTest(ViewTestCase):
 
+    def test_get_comparison_loads_lists_with_one_query(self):
+        with self.logged_in() as user:
+            comparison = self.create_comparison(
+                user, ['pikachu', 'ditto'], ['mew'])
+
+            with self.assertNumQueries(1):
+                list1, list2 = comparison.as_list_of_dicts()
+
+            self.assertEqual([p['name'] for p in list1], ['pikachu', 'ditto'])
+            self.assertEqual([p['name'] for p in list2], ['mew'])
+
     def test_get_comparison(self):
         with self.logged_in() as user:
             response = self.fetch_and_save_pokemon('pikachu')
@@ -371,6 +517,41 @@ class RemoveViewTest(ViewTestCase):
             self.assertEqual(comparison.list1[0].name, 'pikachu')
             self.assertEqual(comparison.list1[1].name, 'bulbasaur')
 
+    def test_remove_repeated_pokemon_by_position(self):
+        with self.logged_in() as user:
+            comparison = self.create_comparison(
+                user, ['pikachu', 'ditto', 'pikachu', 'mew'], ['pikachu'])
+
+            request = self.get_post_request(
+                '/remove', pokemon_set='1', index='2')
+
+            # One of them looks for an offer of the first list.
+            with self.assertNumQueries(10):
+                remove_view(request, comparison.id)
+
+            list1, list2 = self.get_comparison(user).get_lists()
+            self.assertEqual(
+                [p.name for p in list1], ['pikachu', 'ditto', 'mew'])
+            self.assertEqual([p.name for p in list2], ['pikachu'])
+
+            comparison.add_pokemon(Pokemon.objects.get(name='ditto'), 1)
+
+            self.assertEqual(
+                [p.name for p in self.get_comparison(user).list1],
+                ['pikachu', 'ditto', 'mew', 'ditto'])
+
+    def test_remove_missing_position(self):
+        with self.logged_in() as user:
+            comparison = self.create_comparison(user, ['pikachu'])
+
+            request = self.get_post_request(
+                '/remove', pokemon_set='1', index='5')
+
+            response = remove_view(request, comparison.id)
+
+            self.assertEqual(response.status_code, 302)
+            self.assertEqual(len(self.get_comparison(user).list1), 1)
+
     def test_get_page_redirect_unauthenticated(self):
         request = self.get_get_request('remove/1')
 
@@ -379,6 +560,129 @@ class RemoveViewTest(ViewTestCase):
         self.assertRedirect(response, '/login')
 
 
+class AddViewTest(ViewTestCase):
+
+    def fake_fetch_pokemon(self, name):
+        if name == 'agumon':
+            raise APIException(
+                "There is no such Pokémon called \"{}.\"".format(name))
+        return {
+            'name': name, 'base_experience': len(name) * 10,
+            'picture_url': 'http://example.com/{}.png'.format(name)
+        }
+
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch(
+            'poketrader.views.fetch_pokemon',
+            side_effect=self.fake_fetch_pokemon)
+        self.fetch_pokemon_mock = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_add_many_from_form(self):
+        with self.logged_in() as user:
+            request = self.get_post_request(
+                '/add', pokemon_set='2',
+                pokemon_name=['pikachu, ditto', 'agumon', 'pikachu'])
+
+            response = add_view(request, None)
+
+            comparison = self.get_comparison(user)
+            self.assertRedirect(response, '/comparison/{}'.format(comparison.id))
+            self.assertEqual(
+                [p.name for p in comparison.list2],
+                ['pikachu', 'ditto', 'pikachu'])
+            self.assertEqual(len(comparison.list1), 0)
+
+            messages_list = list(messages.get_messages(request))
+            self.assertEqual(len(messages_list), 1)
+            self.assertEqual(
+                messages_list[0].message,
+                "There is no such Pokémon called \"agumon.\"")
+
+    def test_add_names_in_any_case(self):
+        with self.logged_in() as user:
+            comparison = self.create_comparison(user, ['pikachu'])
+            request = self.get_post_request(
+                '/add', pokemon_set='1', pokemon_name=' PikaChu , DITTO')
+
+            add_view(request, comparison.id)
+
+            self.assertEqual(
+                [p.name for p in comparison.list1],
+                ['pikachu', 'pikachu', 'ditto'])
+            self.fetch_pokemon_mock.assert_called_once_with('ditto')
+            self.assertEqual(Pokemon.objects.count(), 2)
+
+    def test_add_many_from_json(self):
+        with self.logged_in() as user:
+            comparison = self.create_comparison(user, ['mew'])
+            request = self.factory.post(
+                '/add', json.dumps({
+                    'pokemon_set': 1,
+                    'pokemon_names': ['pikachu', 'agumon', 'mew']
+                }), content_type='application/json')
+            self._set_up_request(request)
+
+            response = add_view(request, comparison.id)
+
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(json.loads(response.content), {
+                'comparison_id': comparison.id,
+                'added': ['pikachu', 'mew'],
+                'errors': {
+                    'agumon': "There is no such Pokémon called \"agumon.\""
+                }
+            })
+            self.assertEqual(
+                [p.name for p in self.get_comparison(user).list1],
+                ['mew', 'pikachu', 'mew'])
+            self.assertEqual(self.fetch_pokemon_mock.call_count, 2)
+
+    def test_add_many_fetches_concurrently(self):
+        barrier = threading.Barrier(3, timeout=5)
+
+        def fetch_pokemon(name):
+            barrier.wait()
+            return self.fake_fetch_pokemon(name)
+
+        self.fetch_pokemon_mock.side_effect = fetch_pokemon
+
+        with self.logged_in() as user:
+            request = self.get_post_request(
+                '/add', pokemon_set='1',
+                pokemon_name='pikachu, ditto, bulbasaur')
+
+            add_view(request, None)
+
+            self.assertEqual(len(self.get_comparison(user).list1), 3)
+
+    def test_add_invalid_request(self):
+        with self.logged_in() as user:
+            request = self.factory.post(
+                '/add', json.dumps({'pokemon_set': 1, 'pokemon_names': 'mew'}),
+                content_type='application/json')
+            self._set_up_request(request)
+
+            response = add_view(request, None)
+
+            self.assertEqual(response.status_code, 400)
+
+            request = self.get_post_request(
+                '/add', pokemon_set='3', pokemon_name='pikachu')
+
+            response = add_view(request, None)
+
+            self.assertEqual(response.status_code, 400)
+
+    def test_get_page_redirect_unauthenticated(self):
+        request = self.get_post_request('add/1')
+
+        response = add_view(request, None)
+
+        self.assertRedirect(response, '/login')
+
+
 class DeleteViewTest(ViewTestCase):
 
     def test_delete_comparison(self):
@@ -396,6 +700,7 @@ class DeleteViewTest(ViewTestCase):
 
             with self.assertRaises(Exception):
                 comparison = self.get_comparison(user)
+            self.assertFalse(PokemonListItem.objects.exists())
 
     def test_get_page_redirect_unauthenticated(self):
         request = self.get_get_request('remove/1')
@@ -403,3 +708,1987 @@ class DeleteViewTest(ViewTestCase):
         response = delete_view(request, None)
 
         self.assertRedirect(response, '/login')
+
+
+@override_settings(CACHES=TEST_CACHES)
+class FetchPokemonTest(TestCase):
+
+    def setUp(self):
+        get_pokedex_cache().clear()
+        pokemon.BREAKER.reset()
+        patcher = mock.patch('poketrader.pokemon.CLIENT')
+        self.client_mock = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_cache_shared_entries(self):
+        self.client_mock.get_pokemon.return_value = make_api_pokemon(
+            'pikachu', 112, 25)
+        hits = CACHE_STATS['hits']
+
+        pokemon = fetch_pokemon('pikachu')
+        self.assertEqual(pokemon, fetch_pokemon('  PikaChu '))
+
+        self.assertEqual(self.client_mock.get_pokemon.call_count, 1)
+        self.assertEqual(CACHE_STATS['hits'], hits + 1)
+        self.assertEqual(pokemon['base_experience'], 112)
+
+    def test_cache_missing_pokemon(self):
+        self.client_mock.get_pokemon.side_effect = InvalidStatusCodeError(
+            404, [200])
+        misses = CACHE_STATS['misses']
+
+        for i in range(3):
+            with self.assertRaises(APIException) as context:
+                fetch_pokemon('agumon')
+            self.assertEqual(
+                context.exception.message,
+                "There is no such Pokémon called \"agumon.\"")
+
+        self.assertEqual(self.client_mock.get_pokemon.call_count, 1)
+        self.assertEqual(CACHE_STATS['misses'], misses + 1)
+
+    @override_settings(POKEDEX_NEGATIVE_CACHE_TIMEOUT=0)
+    def test_cache_missing_pokemon_timeout(self):
+        self.client_mock.get_pokemon.side_effect = InvalidStatusCodeError(
+            404, [200])
+
+        for i in range(2):
+            with self.assertRaises(APIException):
+                fetch_pokemon('agumon')
+
+        self.assertEqual(self.client_mock.get_pokemon.call_count, 2)
+
+
+class ImportPokedexCommandTest(TestCase):
+
+    def write_dump(self, name, content):
+        path = os.path.join(self.directory.name, name)
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(content)
+        return path
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def test_import_csv(self):
+        path = self.write_dump(
+            'pokemon.csv',
+            'id,identifier,species_id,base_experience\n'
+            '1,bulbasaur,1,64\n'
+            '25,pikachu,25,112\n'
+            '10195,pikachu-gmax,25,\n'
+            '10196,ditto-gmax,132,n/a\n')
+        out = io.StringIO()
+
+        call_command('import_pokedex', path, batch_size=1, stdout=out)
+
+        self.assertEqual(Pokemon.objects.count(), 2)
+        pikachu = Pokemon.objects.get(name='pikachu')
+        self.assertEqual(pikachu.base_experience, 112)
+        self.assertTrue(pikachu.picture_url.endswith('/pokemon/25.png'))
+        self.assertIn('2 pokémons created, 0 updated, 2 skipped', out.getvalue())
+
+    def test_import_json_updates(self):
+        Pokemon.objects.create(
+            name='ditto', base_experience=1, picture_url='http://x/old.png')
+        path = self.write_dump('pokemon.json', json.dumps([
+            {'name': 'ditto', 'base_experience': 101,
+             'sprites': {'front_default': 'http://x/132.png'}},
+            {'name': 'mew', 'base_experience': 300,
+             'sprites': {'front_default': 'http://x/151.png'}},
+        ]))
+        out = io.StringIO()
+
+        call_command('import_pokedex', path, stdout=out)
+
+        ditto = Pokemon.objects.get(name='ditto')
+        self.assertEqual(ditto.base_experience, 101)
+        self.assertEqual(ditto.picture_url, 'http://x/132.png')
+        self.assertTrue(Pokemon.objects.filter(name='mew').exists())
+        self.assertIn('1 pokémons created, 1 updated, 0 skipped', out.getvalue())
+
+    @mock.patch('poketrader.views.fetch_pokemon')
+    def test_imported_pokemon_not_fetched(self, fetch_pokemon_mock):
+        path = self.write_dump(
+            'pokemon.csv', 'id,identifier,base_experience\n25,pikachu,112\n')
+        call_command('import_pokedex', path, stdout=io.StringIO())
+
+        pokemons, errors = resolve_pokemons(['pikachu'])
+
+        self.assertEqual(pokemons['pikachu'].base_experience, 112)
+        fetch_pokemon_mock.assert_not_called()
+
+
+@override_settings(DATABASE_REPLICAS=['replica1', 'replica2'])
+class ReplicaRouterTest(TestCase):
+
+    def setUp(self):
+        self.router = routers.ReplicaRouter()
+        self.is_healthy = routers.is_healthy
+        patcher = mock.patch(
+            'poketrader.routers.is_healthy', return_value=True)
+        self.is_healthy_mock = patcher.start()
+        self.addCleanup(patcher.stop)
+        # Each test runs in a transaction, which would keep all reads on the
+        # default database.
+        self.default = types.SimpleNamespace(in_atomic_block=False)
+        patcher = mock.patch.object(
+            routers, 'connections', {'default': self.default})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def route(self, method='get', cookies=None, write=False):
+        """
+        Returns the databases a request would read from, before and after
+        writing if `write`, and its response.
+        """
+        databases = []
+
+        def view(request):
+            databases.append(self.router.db_for_read(Pokemon))
+            if write:
+                self.router.db_for_write(Pokemon)
+                databases.append(self.router.db_for_read(Pokemon))
+            return HttpResponse()
+
+        request = getattr(RequestFactory(), method)('/')
+        request.COOKIES.update(cookies or {})
+        response = routers.replica_routing_middleware(view)(request)
+        return databases, response
+
+    def test_read_from_replica(self):
+        databases, response = self.route()
+
+        self.assertIn(databases[0], ['replica1', 'replica2'])
+        self.assertNotIn(routers.PIN_COOKIE, response.cookies)
+
+    def test_read_your_writes(self):
+        databases, response = self.route(write=True)
+
+        self.assertEqual(databases[1], 'default')
+        self.assertEqual(
+            response.cookies[routers.PIN_COOKIE]['max-age'],
+            settings.DATABASE_REPLICA_PIN_SECONDS)
+
+        databases, _ = self.route(cookies={routers.PIN_COOKIE: '1'})
+        self.assertEqual(databases, ['default'])
+
+    def test_transactions_use_primary(self):
+        self.default.in_atomic_block = True
+
+        self.assertEqual(self.route()[0], ['default'])
+
+    def test_post_uses_primary(self):
+        databases, response = self.route(method='post')
+
+        self.assertEqual(databases, ['default'])
+        self.assertIn(routers.PIN_COOKIE, response.cookies)
+
+    def test_unhealthy_replicas(self):
+        self.is_healthy_mock.side_effect = lambda alias: alias == 'replica2'
+        self.assertEqual(self.route()[0], ['replica2'])
+
+        self.is_healthy_mock.side_effect = None
+        self.is_healthy_mock.return_value = False
+        self.assertEqual(self.route()[0], ['default'])
+
+    def test_outside_requests_and_without_replicas(self):
+        self.assertEqual(self.router.db_for_read(Pokemon), 'default')
+
+        with override_settings(DATABASE_REPLICAS=[]):
+            databases, response = self.route(method='post')
+        self.assertEqual(databases, ['default'])
+        self.assertNotIn(routers.PIN_COOKIE, response.cookies)
+
+    def test_retry_failed_replica_later(self):
+        replica = mock.Mock()
+        replica.ensure_connection.side_effect = OperationalError
+        self.addCleanup(routers._down_until.clear)
+
+        with mock.patch.object(routers, 'connections', {'replica1': replica}):
+            self.assertFalse(self.is_healthy('replica1'))
+            self.assertFalse(self.is_healthy('replica1'))
+
+        self.assertEqual(replica.ensure_connection.call_count, 1)
+
+
+@override_settings(DATABASE_SHARDS=['default', 'shard1'])
+class ShardRouterTest(TestCase):
+
+    def setUp(self):
+        self.router = sharding.ShardRouter()
+        self.user = User.objects.create(username='ash')
+
+    def route(self, user, method='get'):
+        """
+        Returns the databases a request of `user` would use for comparisons
+        and pokémons, and its response.
+        """
+        databases = []
+
+        def view(request):
+            databases.append(self.router.db_for_read(PokemonComparison))
+            databases.append(self.router.db_for_read(Pokemon))
+            return HttpResponse()
+
+        request = getattr(RequestFactory(), method)('/')
+        request.user = user
+        response = sharding.shard_routing_middleware(view)(request)
+        return databases, response
+
+    def test_placement(self):
+        placements = [sharding.get_placement(i) for i in range(100)]
+
+        self.assertEqual(
+            placements, [sharding.get_placement(i) for i in range(100)])
+        self.assertGreater(placements.count('default'), 25)
+        self.assertGreater(placements.count('shard1'), 25)
+
+    def test_route_to_shard_of_user(self):
+        UserShard.objects.create(user=self.user, shard='shard1')
+
+        self.assertEqual(self.route(self.user)[0], ['shard1', None])
+        self.assertEqual(self.route(AnonymousUser())[0], ['default', None])
+
+    def test_new_users_are_placed_by_hash(self):
+        databases, _ = self.route(self.user)
+
+        self.assertEqual(
+            databases[0], sharding.get_placement(self.user.id))
+        self.assertEqual(
+            UserShard.objects.get(user=self.user).shard, databases[0])
+
+    def test_users_with_comparisons_stay_in_default_database(self):
+        with override_settings(DATABASE_SHARDS=['default']):
+            PokemonComparison.objects.create(user=self.user)
+
+        with mock.patch.object(
+                sharding, 'get_placement', return_value='shard1'):
+            self.assertEqual(self.route(self.user)[0][0], 'default')
+
+    def test_route_by_hints(self):
+        UserShard.objects.create(user=self.user, shard='shard1')
+        comparison = PokemonComparison(user=self.user)
+
+        self.assertEqual(
+            self.router.db_for_write(PokemonComparison, instance=comparison),
+            'shard1')
+        self.assertEqual(
+            self.router.db_for_read(PokemonComparison, user=self.user),
+            'shard1')
+        comparison._state.db = 'default'
+        self.assertEqual(
+            self.router.db_for_read(PokemonListItem, instance=comparison),
+            'default')
+        self.assertEqual(self.router.db_for_read(PokemonComparison), 'default')
+
+    def test_moving_users_cannot_change_comparisons(self):
+        UserShard.objects.create(user=self.user, shard='shard1', moving=True)
+
+        _, response = self.route(self.user, method='post')
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(
+            response['Retry-After'], str(sharding.MOVING_RETRY_AFTER))
+        self.assertEqual(self.route(self.user)[1].status_code, 200)
+
+    def test_allow_migrate(self):
+        self.assertIsNone(self.router.allow_migrate('default', 'poketrader'))
+        self.assertTrue(self.router.allow_migrate(
+            'shard1', 'poketrader', model_name='pokemon'))
+        self.assertFalse(self.router.allow_migrate(
+            'shard1', 'poketrader', model_name='usershard'))
+
+    def test_not_sharded(self):
+        with override_settings(DATABASE_SHARDS=['default']):
+            self.assertIsNone(self.router.db_for_read(PokemonComparison))
+            self.assertIsNone(self.router.allow_migrate('default', 'auth'))
+        self.assertFalse(UserShard.objects.exists())
+
+    def test_allocate_ids(self):
+        with override_settings(DATABASE_SHARDS=['default']):
+            last = PokemonComparison.objects.create(user=self.user)
+
+            first = allocate_ids(PokemonComparison, 3)
+            second = allocate_ids(PokemonComparison, 2)
+
+        self.assertEqual(list(first), [last.id + 1, last.id + 2, last.id + 3])
+        self.assertEqual(list(second), [last.id + 4, last.id + 5])
+
+
+@unittest.skipUnless(
+    'shard1' in settings.DATABASES,
+    'Needs a shard, given in DATABASE_SHARD_URLS.')
+@override_settings(DATABASE_SHARDS=['default', 'shard1'])
+class ShardMoveTest(TestCase):
+    # The test runner sets up the databases of skipped tests, too.
+    databases = {'default', 'shard1'} & set(settings.DATABASES)
+
+    def setUp(self):
+        self.user = User.objects.create(username='ash')
+        self.pokemons = [
+            Pokemon.objects.create(
+                name=name, base_experience=base_experience,
+                picture_url='http://example.com/{}.png'.format(name))
+            for name, base_experience in [('ditto', 101), ('mew', 270)]
+        ]
+        # A user with comparisons from before sharding.
+        with override_settings(DATABASE_SHARDS=['default']):
+            self.comparison = PokemonComparison.objects.create(user=self.user)
+            for pokemon in self.pokemons:
+                self.comparison.add_pokemon(pokemon, 1)
+
+    def test_catalog_is_replicated(self):
+        self.assertEqual(
+            list(Pokemon.objects.using('shard1').values_list('id', 'name')),
+            [(p.id, p.name) for p in self.pokemons])
+
+    def test_move_user(self):
+        entry = sharding.get_user_shard(self.user.id)
+        self.assertEqual(entry.shard, 'default')
+
+        self.assertEqual(sharding.move_user(entry, 'shard1', batch_size=1), 1)
+
+        moved = PokemonComparison.objects.using('shard1').get()
+        self.assertEqual(moved.id, self.comparison.id)
+        self.assertEqual(
+            [p.name for p in moved.list1], ['ditto', 'mew'])
+        self.assertFalse(PokemonComparison.objects.using('default').exists())
+        self.assertFalse(PokemonListItem.objects.using('default').exists())
+        self.assertEqual(history.get_lists_at(moved, 1), ([
+            self.pokemons[0].id], []))
+        self.assertEqual(
+            UserShard.objects.get(user=self.user).shard, 'shard1')
+
+        client = Client()
+        client.force_login(self.user)
+        response = client.post(
+            '/api/comparisons/{}/add'.format(moved.id),
+            {'pokemon_set': 2, 'pokemon_names': ['ditto']},
+            content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            PokemonListItem.objects.using('shard1').count(), 3)
+
+        new = client.post('/api/comparisons/').json()
+        self.assertGreater(new['id'], moved.id)
+        self.assertTrue(PokemonComparison.objects.using('shard1').filter(
+            id=new['id']).exists())
+
+    def test_rebalance(self):
+        out = io.StringIO()
+
+        with mock.patch.object(
+                sharding, 'get_placement', return_value='shard1'):
+            call_command('rebalance_shards', dry_run=True, stdout=out)
+            self.assertIn('1 users would be moved.', out.getvalue())
+            self.assertTrue(PokemonComparison.objects.exists())
+
+            call_command('rebalance_shards', stdout=out)
+
+        self.assertIn('1 users moved, with 1 comparisons', out.getvalue())
+        self.assertEqual(
+            PokemonComparison.objects.using('shard1').get().id,
+            self.comparison.id)
+
+    def test_delete_user(self):
+        sharding.move_user(sharding.get_user_shard(self.user.id), 'shard1')
+
+        self.user.delete()
+
+        self.assertFalse(PokemonComparison.objects.using('shard1').exists())
+        self.assertFalse(UserShard.objects.exists())
+
+
+class PurgeOrphanItemsTest(TestCase):
+
+    def setUp(self):
+        user = User.objects.create(username='ash')
+        self.pokemon = Pokemon.objects.create(
+            name='ditto', base_experience=101,
+            picture_url='http://example.com/ditto.png')
+        self.comparison = PokemonComparison.objects.create(user=user)
+        for list_number in (1, 2):
+            self.comparison.add_pokemon(self.pokemon, list_number)
+        PokemonListItem.objects.bulk_create([
+            PokemonListItem(list_number=1, position=0, pokemon=self.pokemon)
+            for _ in range(5)
+        ])
+
+    def test_purge(self):
+        out = io.StringIO()
+
+        call_command(
+            'purge_orphan_items', batch_size=2, max_rate=0, stdout=out)
+
+        self.assertEqual(
+            PokemonListItem.objects.filter(comparison__isnull=True).count(),
+            0)
+        self.assertEqual(
+            [p.name for p in self.comparison.list1 + self.comparison.list2],
+            ['ditto', 'ditto'])
+        self.assertRegex(
+            out.getvalue(), r'^5 orphaned items deleted of 7(, about .* kB)?')
+
+    def test_dry_run(self):
+        out = io.StringIO()
+
+        call_command('purge_orphan_items', dry_run=True, stdout=out)
+
+        self.assertEqual(PokemonListItem.objects.count(), 7)
+        self.assertIn('5 orphaned items found of 7', out.getvalue())
+
+
+class ComparisonTotalsTest(ViewTestCase):
+
+    def assertTotals(self, comparison, totals):
+        comparison = PokemonComparison.objects.get(id=comparison.id)
+        self.assertEqual(
+            (comparison.base_experience1, comparison.count1,
+             comparison.base_experience2, comparison.count2), totals)
+
+    def test_totals_follow_changes(self):
+        with self.logged_in() as user:
+            comparison = self.create_comparison(
+                user, ['pikachu', 'ditto'], ['mew'])
+            self.assertTotals(comparison, (120, 2, 30, 1))
+
+            comparison.remove_pokemon(0, 1)
+            self.assertTotals(comparison, (50, 1, 30, 1))
+
+            comparison.reset_list(2)
+            self.assertTotals(comparison, (50, 1, 0, 0))
+            self.assertEqual(comparison.compare()['success'], False)
+
+    def test_totals_concurrent_instances(self):
+        with self.logged_in() as user:
+            comparison = self.create_comparison(user, ['pikachu'])
+            other = PokemonComparison.objects.get(id=comparison.id)
+
+            comparison.add_pokemon(Pokemon.objects.get(name='pikachu'), 1)
+            other.add_pokemon(Pokemon.objects.get(name='pikachu'), 1)
+
+            self.assertTotals(comparison, (210, 3, 0, 0))
+            self.assertEqual(
+                [i.position for i in comparison.items.all()], [0, 1, 2])
+
+    def test_bulk_changes(self):
+        with self.logged_in() as user:
+            comparison = self.create_comparison(
+                user, ['pikachu'], ['ditto', 'mew'])
+            pikachu, ditto, mew = [
+                Pokemon.objects.get(name=n) for n in ('pikachu', 'ditto', 'mew')]
+
+            # The number of queries does not depend on the number of pokémons.
+            # Changes to the first list look for its offer too.
+            for pokemons in ([mew], [pikachu, ditto, mew] * 2):
+                with self.assertNumQueries(7):
+                    comparison.add_pokemons(pokemons, 1)
+            self.assertTotals(comparison, (400, 8, 80, 2))
+
+            for positions in ([1], [0, 2, 5, 42, 2]):
+                with self.assertNumQueries(9):
+                    comparison.remove_positions(1, positions)
+            self.assertEqual(
+                [(i.position, i.pokemon.name)
+                 for i in comparison.items.filter(list_number=1)],
+                [(0, 'pikachu'), (1, 'mew'), (2, 'pikachu'), (3, 'mew')])
+            self.assertTotals(comparison, (200, 4, 80, 2))
+
+            with self.assertNumQueries(7):
+                comparison.replace_list(2, [mew, mew, pikachu])
+            self.assertEqual(
+                [p.name for p in comparison.list2], ['mew', 'mew', 'pikachu'])
+            self.assertTotals(comparison, (200, 4, 130, 3))
+
+    def test_get_comparison_verdict_from_totals(self):
+        with self.logged_in() as user:
+            comparison = self.create_comparison(user, ['pikachu'], ['squirtle'])
+
+            request = self.get_get_request(
+                'comparison/{}'.format(comparison.id))
+            response = comparison_view(request, comparison.id)
+
+            content = response.content.decode(response.charset)
+            self.assertIn('FAIR', content)
+            self.assertNotIn('UNFAIR', content)
+
+    def test_repair_command(self):
+        with self.logged_in() as user:
+            comparison = self.create_comparison(
+                user, ['pikachu', 'ditto'], ['mew'])
+            consistent = self.create_comparison(user, ['mew'])
+            PokemonComparison.objects.filter(id=comparison.id).update(
+                base_experience1=0, count2=5)
+            out = io.StringIO()
+
+            call_command('repair_comparison_totals', dry_run=True, stdout=out)
+
+            self.assertIn('2 comparisons checked, 1 inconsistent.', out.getvalue())
+            self.assertTotals(comparison, (0, 2, 30, 5))
+
+            call_command('repair_comparison_totals', stdout=out)
+
+            self.assertTotals(comparison, (120, 2, 30, 1))
+            self.assertTotals(consistent, (30, 1, 0, 0))
+
+
+class FairnessTest(ViewTestCase):
+
+    def test_same_results_as_scalar_version(self):
+        rng = random.Random(0)
+        pairs = [(rng.randint(0, 500), rng.randint(0, 500))
+                 for i in range(1000)] + [(0, 0), (10, 0), (100, 115)]
+
+        result = compare_base_experience_arrays(
+            [p[0] for p in pairs], [p[1] for p in pairs],
+            fairness_threshold=0.15)
+
+        for i, (base_experience1, base_experience2) in enumerate(pairs):
+            expected = compare_base_experiences(
+                base_experience1, base_experience2, fairness_threshold=0.15)
+            self.assertEqual(result['difference'][i], expected['difference'])
+            self.assertEqual(result['fair'][i], expected['fair'])
+            self.assertEqual(result['success'][i], expected['success'])
+            if expected['success']:
+                self.assertAlmostEqual(
+                    result['unfairness'][i], expected['unfairness'])
+            else:
+                self.assertTrue(math.isnan(result['unfairness'][i]))
+
+    def test_sweep_thresholds(self):
+        with self.logged_in() as user:
+            self.create_comparison(user, ['pikachu'], ['pikachu'])
+            self.create_comparison(user, ['pikachu'], ['squirtle'])
+            self.create_comparison(user, ['pikachu'], ['mew'])
+            self.create_comparison(user, ['pikachu'])
+
+            total, unsuccessful, in_interval = sweep_thresholds(
+                [0.0, 0.1, 0.5], chunk_size=2)
+
+            self.assertEqual((total, unsuccessful), (4, 1))
+            self.assertEqual(list(in_interval), [1, 0, 1])
+
+            out = io.StringIO()
+            call_command(
+                'sweep_fairness_threshold', start=0.1, stop=0.2, step=0.1,
+                stdout=out)
+
+            self.assertIn('4 comparisons, 1 with an empty list.', out.getvalue())
+            self.assertIn('0.2            1            2    66.7%', out.getvalue())
+
+
+class SuggestionsTest(ViewTestCase):
+
+    def setUp(self):
+        super().setUp()
+        invalidate_index()
+        self.addCleanup(invalidate_index)
+
+    def test_suggest_for_weaker_list(self):
+        with self.logged_in() as user:
+            comparison = self.create_comparison(
+                user, ['pikachu'], ['bulbasaur', 'mew', 'ditto'])
+
+            list_number, singles, pairs = suggest_additions(
+                comparison.base_experience1, comparison.base_experience2, 0.15)
+
+            self.assertEqual(list_number, 1)
+            self.assertEqual([s['names'] for s in singles], [['bulbasaur']])
+            self.assertEqual(
+                [s['names'] for s in pairs[:2]],
+                [['mew', 'pikachu'], ['ditto', 'ditto']])
+            for suggestion in singles + pairs:
+                comp = compare_base_experiences(
+                    comparison.base_experience1
+                    + suggestion['base_experience'],
+                    comparison.base_experience2, 0.15)
+                self.assertTrue(comp['fair'])
+
+    def test_suggestions_on_comparison_page(self):
+        with self.logged_in() as user:
+            comparison = self.create_comparison(user, ['ditto'], ['pikachu'])
+            self.create_comparison(user, ['mew'])
+
+            response = comparison_view(
+                self.get_get_request('comparison/{}'.format(comparison.id)),
+                comparison.id)
+
+            content = response.content.decode(response.charset)
+            self.assertIn('add to the left list', content)
+            self.assertIn('value="mew (+30)"', content)
+
+
+class AutocompleteTest(TestCase):
+
+    def setUp(self):
+        for name in ('pikachu', 'pichu', 'pidgey', 'raichu', 'ditto'):
+            Pokemon.objects.create(
+                name=name, base_experience=100,
+                picture_url='http://example.com/{}.png'.format(name))
+        invalidate_autocomplete_index()
+        self.addCleanup(invalidate_autocomplete_index)
+
+    def autocomplete(self, prefix):
+        response = self.client.get('/autocomplete/', {'q': prefix})
+        self.assertEqual(response.status_code, 200)
+        return response.json()['names']
+
+    def test_complete_prefix(self):
+        self.assertEqual(
+            self.autocomplete('Pi'), ['pichu', 'pidgey', 'pikachu'])
+        self.assertEqual(self.autocomplete('rai'), ['raichu'])
+        self.assertEqual(self.autocomplete('x'), [])
+
+    def test_complete_mistyped_prefix(self):
+        self.assertEqual(self.autocomplete('ptika'), ['pikachu'])
+        self.assertEqual(self.autocomplete('dittp'), ['ditto'])
+
+    def test_no_queries_once_indexed(self):
+        self.autocomplete('pi')
+        Pokemon.objects.filter(name='pidgey').delete()
+
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                self.autocomplete('pid'), ['pidgey', 'pichu', 'pikachu'])
+
+    def test_cacheable(self):
+        response = self.client.get('/autocomplete/', {'q': 'pi'})
+
+        self.assertIn('public', response['Cache-Control'])
+        self.assertIn(
+            'max-age={}'.format(settings.AUTOCOMPLETE_INDEX_TIMEOUT),
+            response['Cache-Control'])
+
+
+class ComparisonAPITest(TestCase):
+
+    def fake_fetch_pokemon(self, name):
+        if name == 'agumon':
+            raise PokemonNotFound(name)
+        return {
+            'name': name, 'base_experience': len(name) * 10,
+            'picture_url': 'http://example.com/{}.png'.format(name)
+        }
+
+    def setUp(self):
+        patcher = mock.patch(
+            'poketrader.views.fetch_pokemon',
+            side_effect=self.fake_fetch_pokemon)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.user = User.objects.create(username='ash')
+        self.client.force_login(self.user)
+        self.comparison_id = self.client.post('/api/comparisons/').json()['id']
+
+    def post(self, action, data):
+        return self.client.post(
+            '/api/comparisons/{}/{}'.format(self.comparison_id, action),
+            json.dumps(data), content_type='application/json')
+
+    def test_add(self):
+        response = self.post('add', {
+            'pokemon_set': 1, 'pokemon_names': ['pikachu', 'agumon', 'ditto']})
+
+        data = response.json()
+        self.assertEqual(
+            [p['name'] for p in data['list1']], ['pikachu', 'ditto'])
+        self.assertEqual(data['list2'], [])
+        self.assertEqual(
+            data['errors'],
+            {'agumon': 'There is no such Pokémon called "agumon."'})
+        self.assertEqual(data['verdict']['base_experience1'], 120)
+        self.assertIsNone(data['verdict']['unfairness'])
+        self.assertFalse(data['verdict']['success'])
+
+    def test_remove_and_reset(self):
+        self.post('add', {'pokemon_set': '1', 'pokemon_names': ['ditto']})
+        self.post('add', {
+            'pokemon_set': '2', 'pokemon_names': ['pikachu', 'mew']})
+
+        data = self.post('remove', {'pokemon_set': 2, 'index': 0}).json()
+
+        self.assertEqual([p['name'] for p in data['list2']], ['mew'])
+        self.assertEqual(data['verdict']['difference'], 20)
+        self.assertEqual(data['verdict']['unfairness'], 20 / 30)
+
+        data = self.post('reset', {'pokemon_set': 1}).json()
+
+        self.assertEqual(data['list1'], [])
+        self.assertEqual(data['verdict']['base_experience1'], 0)
+        self.assertEqual(
+            self.client.get('/api/comparisons/{}'.format(
+                self.comparison_id)).json(), data)
+
+    def test_invalid_requests(self):
+        self.assertEqual(self.post('add', {
+            'pokemon_set': 3, 'pokemon_names': ['ditto']}).status_code, 400)
+        self.assertEqual(self.post('add', {
+            'pokemon_set': 1, 'pokemon_names': 'ditto'}).status_code, 400)
+        self.assertEqual(self.post('remove', {
+            'pokemon_set': 1, 'index': 0}).status_code, 400)
+        self.assertEqual(self.client.post(
+            '/api/comparisons/{}/reset'.format(self.comparison_id), 'nope',
+            content_type='application/json').status_code, 400)
+
+    def test_other_users_comparison(self):
+        self.client.force_login(User.objects.create(username='gary'))
+
+        response = self.client.get(
+            '/api/comparisons/{}'.format(self.comparison_id))
+
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.json(), {'error': 'No such comparison.'})
+
+    def test_unauthenticated(self):
+        self.client.logout()
+
+        response = self.client.get(
+            '/api/comparisons/{}'.format(self.comparison_id))
+
+        self.assertEqual(response.status_code, 401)
+
+    def test_delete(self):
+        response = self.client.delete(
+            '/api/comparisons/{}'.format(self.comparison_id))
+
+        self.assertEqual(response.status_code, 204)
+        self.assertFalse(PokemonComparison.objects.exists())
+
+
+@override_settings(CACHES=TEST_CACHES)
+class DataMigrationTest(TestCase):
+
+    def setUp(self):
+        # The progress table was created by the migrations of the test
+        # database, so no schema changes are needed.
+        self.schema_editor = types.SimpleNamespace(connection=connection)
+        self.pokemons = bulk_create_with_ids(Pokemon, [
+            Pokemon(
+                name='pokemon-{}'.format(i), base_experience=i,
+                picture_url='http://example.com/{}.png'.format(i))
+            for i in range(10)
+        ])
+        self.addCleanup(forget_progress, self.schema_editor, 'test')
+
+    def test_bulk_create_with_ids(self):
+        self.assertEqual(
+            sorted(p.id for p in self.pokemons),
+            list(Pokemon.objects.order_by('id').values_list('id', flat=True)))
+
+    def test_resume_after_failure(self):
+        migrated = []
+        interrupted = []
+
+        def migrate_chunk(ids):
+            Pokemon.objects.filter(id__in=ids).update(base_experience=100)
+            if len(migrated) == 2 and not interrupted:
+                interrupted.append(ids)
+                raise RuntimeError('Interrupted')
+            migrated.append(ids)
+
+        queryset = Pokemon.objects.all()
+        with self.assertRaises(RuntimeError):
+            migrate_in_chunks(
+                self.schema_editor, 'test', queryset, migrate_chunk,
+                chunk_size=3)
+
+        self.assertEqual(
+            Pokemon.objects.filter(base_experience=100).count(), 6)
+
+        self.assertEqual(migrate_in_chunks(
+            self.schema_editor, 'test', queryset, migrate_chunk,
+            chunk_size=3), 4)
+        self.assertEqual(
+            [id for ids in migrated for id in ids],
+            [p.id for p in self.pokemons])
+        self.assertEqual(
+            Pokemon.objects.filter(base_experience=100).count(), 10)
+
+    def test_run_once(self):
+        migrate_chunk = mock.Mock()
+
+        for _ in range(2):
+            migrate_in_chunks(
+                self.schema_editor, 'test', Pokemon.objects.all(),
+                migrate_chunk)
+        self.assertEqual(migrate_chunk.call_count, 1)
+
+        forget_progress(self.schema_editor, 'test')
+        migrate_in_chunks(
+            self.schema_editor, 'test', Pokemon.objects.all(), migrate_chunk)
+        self.assertEqual(migrate_chunk.call_count, 2)
+
+
+class ExportImportTest(TestCase):
+
+    def setUp(self):
+        self.pokemons = {
+            name: Pokemon.objects.create(
+                name=name, base_experience=len(name) * 10,
+                picture_url='http://example.com/{}.png'.format(name))
+            for name in ('pikachu', 'ditto', 'mew')
+        }
+        self.user = User.objects.create(username='ash')
+        self.client.force_login(self.user)
+
+    def create_comparison(self, user, names1=(), names2=()):
+        comparison = PokemonComparison.objects.create(user=user)
+        for list_number, names in ((1, names1), (2, names2)):
+            for name in names:
+                comparison.add_pokemon(self.pokemons[name], list_number)
+        return comparison
+
+    def export(self, export_format):
+        response = self.client.get(
+            '/api/comparisons/export', {'format': export_format})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        return b''.join(response.streaming_content).decode()
+
+    def test_export_ndjson(self):
+        first = self.create_comparison(self.user, ['pikachu', 'mew'], ['ditto'])
+        second = self.create_comparison(self.user)
+        self.create_comparison(User.objects.create(username='gary'), ['mew'])
+
+        with override_settings(EXPORT_CHUNK_SIZE=1):
+            lines = self.export('ndjson').splitlines()
+
+        records = [json.loads(line) for line in lines]
+        self.assertEqual([r['id'] for r in records], [first.id, second.id])
+        self.assertEqual(records[0]['list1'], ['pikachu', 'mew'])
+        self.assertEqual(records[0]['list2'], ['ditto'])
+        self.assertEqual(records[0]['verdict']['base_experience1'], 100)
+        self.assertEqual(records[1]['list1'], [])
+        self.assertIsNone(records[1]['verdict']['unfairness'])
+
+    def test_export_csv(self):
+        comparison = self.create_comparison(
+            self.user, ['pikachu', 'mew'], ['ditto'])
+
+        rows = list(csv.DictReader(io.StringIO(self.export('csv'))))
+
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0]['id'], str(comparison.id))
+        self.assertEqual(rows[0]['list1'], 'pikachu, mew')
+        self.assertEqual(rows[0]['list2'], 'ditto')
+        self.assertEqual(rows[0]['fair'], 'False')
+
+    def test_export_unknown_format(self):
+        response = self.client.get(
+            '/api/comparisons/export', {'format': 'xml'})
+
+        self.assertEqual(response.status_code, 400)
+
+    def test_import_ndjson(self):
+        body = '\n'.join([
+            json.dumps({'list1': ['Pikachu', 'mew'], 'list2': ['ditto']}),
+            json.dumps({'list1': ['agumon', 'ditto']}),
+            '[1, 2]',
+            ''
+        ])
+
+        with override_settings(IMPORT_BATCH_SIZE=2):
+            response = self.client.post(
+                '/api/comparisons/import', body,
+                content_type='application/x-ndjson')
+
+        data = response.json()
+        self.assertEqual(data['created'], 2)
+        self.assertEqual(data['errors'], [
+            {'record': 2, 'error': 'Unknown pokémons: agumon.'},
+            {'record': 3, 'error': 'Invalid comparison.'}
+        ])
+        first, second = PokemonComparison.objects.filter(
+            user=self.user).order_by('id')
+        self.assertEqual(
+            [p.name for p in first.list1], ['pikachu', 'mew'])
+        self.assertEqual([p.name for p in first.list2], ['ditto'])
+        self.assertEqual(
+            (first.base_experience1, first.count1), (100, 2))
+        self.assertEqual([p.name for p in second.list1], ['ditto'])
+        self.assertEqual(second.count2, 0)
+
+    def test_import_exported_csv(self):
+        self.create_comparison(self.user, ['pikachu', 'mew'], ['ditto'])
+        self.create_comparison(self.user, ['ditto'])
+        exported = self.export('csv')
+        PokemonComparison.objects.all().delete()
+
+        response = self.client.post(
+            '/api/comparisons/import', exported, content_type='text/csv')
+
+        self.assertEqual(response.json(), {'created': 2, 'errors': []})
+        self.assertEqual(
+            [(c.list1_as_string(), c.list2_as_string(), c.base_experience2)
+             for c in PokemonComparison.objects.order_by('id')],
+            [('pikachu, mew', 'ditto', 50), ('ditto', '', 0)])
+
+    def test_login_required(self):
+        self.client.logout()
+
+        response = self.client.get('/api/comparisons/export')
+
+        self.assertEqual(response.status_code, 401)
+
+
+class HistoryTest(TestCase):
+
+    def setUp(self):
+        self.pokemons = {
+            name: Pokemon.objects.create(
+                name=name, base_experience=len(name) * 10,
+                picture_url='http://example.com/{}.png'.format(name))
+            for name in ('pikachu', 'ditto', 'mew')
+        }
+        self.user = User.objects.create(username='ash')
+        self.client.force_login(self.user)
+        self.comparison = PokemonComparison.objects.create(user=self.user)
+
+    def add(self, list_number, *names):
+        self.comparison.add_pokemons(
+            [self.pokemons[n] for n in names], list_number)
+
+    def get_names(self, version):
+        names = {p.id: p.name for p in self.pokemons.values()}
+        return tuple(
+            [names[i] for i in ids]
+            for ids in history.get_lists_at(self.comparison, version))
+
+    def test_lists_at_each_version(self):
+        self.add(1, 'pikachu', 'ditto', 'mew')
+        self.add(2, 'mew')
+        self.comparison.remove_positions(1, [0, 2])
+        self.comparison.reset_list(2)
+        self.comparison.replace_list(1, [self.pokemons['mew']])
+
+        self.assertEqual(
+            [self.get_names(v) for v in range(6)], [
+                ([], []),
+                (['pikachu', 'ditto', 'mew'], []),
+                (['pikachu', 'ditto', 'mew'], ['mew']),
+                (['ditto'], ['mew']),
+                (['ditto'], []),
+                (['mew'], []),
+            ])
+        with self.assertRaises(history.HistoryUnavailable):
+            history.get_lists_at(self.comparison, 6)
+
+    def test_snapshots(self):
+        for _ in range(4):
+            self.add(1, 'ditto')
+
+        with override_settings(HISTORY_SNAPSHOT_INTERVAL=2):
+            self.assertEqual(self.get_names(3), (['ditto'] * 3, []))
+            self.assertEqual(
+                list(self.comparison.snapshots.values_list(
+                    'version', 'list1')),
+                [(3, ','.join([str(self.pokemons['ditto'].id)] * 3))])
+
+            self.comparison.events.filter(version__lte=3).delete()
+            self.assertEqual(self.get_names(4), (['ditto'] * 4, []))
+
+    def test_undo(self):
+        self.add(1, 'pikachu')
+        self.add(2, 'ditto', 'mew')
+        self.comparison.remove_pokemon(0, 1)
+
+        response = self.client.post(
+            '/api/comparisons/{}/undo'.format(self.comparison.id))
+        self.assertEqual(
+            [p['name'] for p in response.json()['list1']], ['pikachu'])
+        self.comparison.refresh_from_db()
+
+        self.assertTrue(history.undo(self.comparison))
+        self.assertEqual(self.comparison.list2, [])
+        self.assertTrue(history.undo(self.comparison))
+        self.assertEqual(
+            (self.comparison.list1, self.comparison.base_experience1,
+             self.comparison.version), ([], 0, 6))
+        self.assertFalse(history.undo(self.comparison))
+
+        response = self.client.post(
+            '/api/comparisons/{}/undo'.format(self.comparison.id))
+        self.assertEqual(response.json(), {'error': 'Nothing to undo.'})
+
+    def test_undo_view(self):
+        self.add(1, 'pikachu')
+
+        response = self.client.post('/undo/{}'.format(self.comparison.id))
+
+        self.assertRedirects(
+            response, '/comparison/{}'.format(self.comparison.id),
+            fetch_redirect_response=False)
+        self.comparison.refresh_from_db()
+        self.assertEqual(self.comparison.count1, 0)
+
+    def test_history_api(self):
+        self.add(1, 'pikachu', 'ditto')
+        self.comparison.remove_pokemon(0, 1)
+        history.undo(self.comparison)
+        url = '/api/comparisons/{}/history'.format(self.comparison.id)
+
+        data = self.client.get(url).json()
+
+        self.assertEqual(data['version'], 3)
+        self.assertEqual(
+            [{k: v for k, v in e.items() if k != 'created'}
+             for e in data['events']], [
+                {'version': 1, 'kind': 'add', 'pokemon_set': 1, 'index': 0,
+                 'pokemon': 'pikachu'},
+                {'version': 1, 'kind': 'add', 'pokemon_set': 1, 'index': 1,
+                 'pokemon': 'ditto'},
+                {'version': 2, 'kind': 'remove', 'pokemon_set': 1,
+                 'index': 0, 'pokemon': 'pikachu'},
+                {'version': 3, 'kind': 'restore', 'restored_version': 1},
+                {'version': 3, 'kind': 'reset', 'pokemon_set': 1},
+                {'version': 3, 'kind': 'add', 'pokemon_set': 1, 'index': 0,
+                 'pokemon': 'pikachu'},
+                {'version': 3, 'kind': 'add', 'pokemon_set': 1, 'index': 1,
+                 'pokemon': 'ditto'},
+                {'version': 3, 'kind': 'reset', 'pokemon_set': 2},
+            ])
+        self.assertEqual(
+            self.client.get(url, {'version': 2}).json(),
+            {'version': 2, 'list1': ['ditto'], 'list2': []})
+        self.assertEqual(
+            self.client.get(url, {'version': 9}).status_code, 404)
+
+    def test_imported_comparisons_start_history(self):
+        response = self.client.post(
+            '/api/comparisons/import', '{"list1": ["mew"]}\n',
+            content_type='application/x-ndjson')
+        self.assertEqual(response.json()['created'], 1)
+        imported = PokemonComparison.objects.latest('id')
+
+        self.assertFalse(history.undo(imported))
+        imported.add_pokemon(self.pokemons['ditto'], 1)
+        self.assertTrue(history.undo(imported))
+        self.assertEqual([p.name for p in imported.list1], ['mew'])
+
+
+
+
+@unittest.skipUnless(
+    'shard1' in settings.DATABASES,
+    'Needs a second database, given in DATABASE_SHARD_URLS.')
+@override_settings(
+    DATABASE_SHARDS=['default'], DATABASE_REPLICAS=['shard1'],
+    HISTORY_SNAPSHOT_INTERVAL=2)
+class ReplicaHistoryTest(TestCase):
+    # Replicas are mirrors of the default database in tests, so a shard
+    # database stands for a replica that writes would really go to.
+    databases = {'default', 'shard1'} & set(settings.DATABASES)
+
+    def test_snapshots_saved_to_primary(self):
+        user = User.objects.create(username='ash')
+        pokemon = Pokemon.objects.create(
+            id=1, name='mew', base_experience=30,
+            picture_url='http://example.com/mew.png')
+        comparison = PokemonComparison.objects.create(id=1, user=user)
+        comparison.add_pokemons([pokemon] * 3, 1)
+        # Replicated, as of its last version.
+        comparison.save(using='shard1', force_insert=True)
+
+        replicated = PokemonComparison.objects.using('shard1').get(id=1)
+        self.assertEqual(history.get_lists_at(replicated, 1), ([1, 1, 1], []))
+
+        self.assertEqual(ComparisonSnapshot.objects.using('default').count(), 1)
+        self.assertFalse(ComparisonSnapshot.objects.using('shard1').exists())
+
+@override_settings(TRADE_MATCH_LIMIT=2, FAIRNESS_THRESHOLD=0.1)
+class MatchingTest(TestCase):
+
+    def setUp(self):
+        self.users = {
+            name: User.objects.create(username=name)
+            for name in ('ash', 'misty', 'brock')
+        }
+
+    def publish(self, username, base_experience, wanted_base_experience):
+        pokemon, _ = Pokemon.objects.get_or_create(
+            name='mon{}'.format(base_experience), defaults={
+                'base_experience': base_experience,
+                'picture_url': 'http://example.com/mon.png'})
+        comparison = PokemonComparison.objects.create(
+            user=self.users[username])
+        comparison.add_pokemon(pokemon, 1)
+        return matching.publish(comparison, wanted_base_experience)
+
+    def get_matches(self, offer):
+        offer.refresh_from_db()
+        return [match.other for match in matching.get_matches(offer)]
+
+    def test_matches_fair_offers_of_other_users(self):
+        offer = self.publish('ash', 100, 200)
+        fair = self.publish('misty', 190, 105)
+        self.publish('brock', 300, 100)
+        self.publish('ash', 200, 100)
+
+        self.assertEqual(self.get_matches(offer), [fair])
+        self.assertEqual(self.get_matches(fair), [offer])
+
+    def test_keeps_closest_matches(self):
+        offer = self.publish('ash', 100, 200)
+        far = self.publish('misty', 215, 100)
+        closer = self.publish('brock', 190, 100)
+        closest = self.publish('misty', 205, 100)
+
+        self.assertEqual(self.get_matches(offer), [closest, closer])
+        offer.refresh_from_db()
+        self.assertEqual(offer.match_distance, 10)
+        self.assertEqual(
+            matching.find_matches(offer, limit=3),
+            [closest, closer, far])
+
+    def test_changes_only_rematch_affected_offers(self):
+        offer = self.publish('ash', 100, 200)
+        close = self.publish('misty', 190, 105)
+        closer = self.publish('misty', 205, 100)
+        unrelated = self.publish('brock', 1000, 1000)
+        for o in (offer, close, closer, unrelated):
+            self.get_matches(o)
+
+        # Farther from what the offer wants than its last match.
+        far = self.publish('brock', 212, 100)
+        offer.refresh_from_db()
+        self.assertFalse(offer.stale)
+        self.assertEqual(self.get_matches(offer), [closer, close])
+
+        closest = self.publish('brock', 198, 100)
+        offer.refresh_from_db()
+        self.assertTrue(offer.stale)
+        self.assertEqual(self.get_matches(offer), [closest, closer])
+
+        comparison = PokemonComparison.objects.get(id=closer.comparison_id)
+        comparison.add_pokemon(Pokemon.objects.get(name='mon100'), 1)
+        matching.publish(comparison, 100)
+        self.assertEqual(self.get_matches(offer), [closest, close])
+
+        self.assertTrue(matching.withdraw(closest.comparison_id))
+        self.assertEqual(self.get_matches(offer), [close, far])
+        self.assertFalse(matching.withdraw(closest.comparison_id))
+
+        unrelated.refresh_from_db()
+        self.assertFalse(unrelated.stale)
+
+    def test_offer_follows_first_list(self):
+        offer = self.publish('ash', 100, 200)
+        fair = self.publish('misty', 190, 105)
+        comparison = PokemonComparison.objects.get(id=offer.comparison_id)
+        mon100 = Pokemon.objects.get(name='mon100')
+        self.assertEqual(self.get_matches(fair), [offer])
+
+        comparison.add_pokemon(mon100, 1)
+        offer.refresh_from_db()
+        self.assertEqual(offer.base_experience, 200)
+        self.assertEqual(offer.pokemons, '{0},{0}'.format(mon100.id))
+        self.assertEqual(self.get_matches(fair), [])
+
+        comparison.add_pokemon(mon100, 2)
+        self.assertEqual(self.get_matches(fair), [])
+
+        comparison.remove_pokemon(0, 1)
+        offer.refresh_from_db()
+        self.assertEqual(offer.base_experience, 100)
+        self.assertEqual(self.get_matches(fair), [offer])
+
+        history.undo(comparison)
+        offer.refresh_from_db()
+        self.assertEqual(offer.base_experience, 200)
+        self.assertEqual(self.get_matches(fair), [])
+
+        comparison.reset_list(1)
+        self.assertFalse(
+            TradeOffer.objects.filter(comparison_id=comparison.id).exists())
+        self.assertEqual(self.get_matches(fair), [])
+
+    def test_deleted_user_withdraws_offers(self):
+        offer = self.publish('ash', 100, 200)
+        fair = self.publish('misty', 190, 105)
+        other = self.publish('brock', 100, 190)
+        self.assertEqual(self.get_matches(fair), [offer, other])
+
+        self.users['ash'].delete()
+
+        self.assertFalse(TradeOffer.objects.filter(id=offer.id).exists())
+        fair.refresh_from_db()
+        self.assertTrue(fair.stale)
+        self.assertEqual(self.get_matches(fair), [other])
+
+    def test_match_all_agrees_with_range_queries(self):
+        rng = random.Random(0)
+        TradeOffer.objects.bulk_create([
+            TradeOffer(
+                user=rng.choice(list(self.users.values())), comparison_id=i,
+                pokemons='', base_experience=rng.randint(50, 150),
+                wanted_base_experience=rng.randint(50, 150))
+            for i in range(200)
+        ])
+
+        self.assertEqual(
+            matching.match_all(limit=5, fairness_threshold=0.1)[0], 200)
+
+        for offer in TradeOffer.objects.all():
+            self.assertFalse(offer.stale)
+            self.assertEqual(
+                [match.other_id for match in offer.matches.all()],
+                [other.id for other in matching.find_matches(offer, 5, 0.1)])
+
+    def test_match_all_reads_offers_in_transaction(self):
+        self.publish('ash', 100, 200)
+        self.publish('misty', 190, 105)
+        # Savepoints of the test case itself.
+        outer = len(connection.savepoint_ids)
+        compute = matching.compute_matches
+
+        def compute_matches(*args):
+            # Otherwise an offer could be withdrawn before its matches are
+            # inserted.
+            self.assertGreater(len(connection.savepoint_ids), outer)
+            return compute(*args)
+
+        with mock.patch.object(
+                matching, 'compute_matches', side_effect=compute_matches):
+            self.assertEqual(matching.match_all(), (2, 2))
+
+    def test_command(self):
+        self.publish('ash', 100, 200)
+        self.publish('misty', 190, 105)
+
+        out = io.StringIO()
+        call_command('match_offers', stdout=out)
+        self.assertIn('2 offers matched, with 2 matches', out.getvalue())
+        self.assertFalse(TradeOffer.objects.filter(stale=True).exists())
+
+        out = io.StringIO()
+        call_command('match_offers', '--all', stdout=out)
+        self.assertIn('2 offers matched, with 2 matches', out.getvalue())
+
+    def test_api(self):
+        self.publish('misty', 190, 105)
+        self.client.force_login(self.users['ash'])
+        comparison_id = self.client.post('/api/comparisons/').json()['id']
+        url = '/api/comparisons/{}/offer'.format(comparison_id)
+
+        self.assertEqual(self.client.get(url).status_code, 404)
+        response = self.client.post(url, content_type='application/json')
+        self.assertEqual(
+            response.json(), {'error': 'The first list is empty.'})
+
+        comparison = PokemonComparison.objects.get(id=comparison_id)
+        comparison.add_pokemon(Pokemon.objects.get(name='mon190'), 1)
+        comparison.add_pokemon(Pokemon.objects.get(name='mon190'), 2)
+        response = self.client.post(url, content_type='application/json')
+        self.assertEqual(response.json()['wanted_base_experience'], 190)
+        self.assertEqual(response.json()['matches'], [])
+
+        response = self.client.post(
+            url, '{"wanted_base_experience": 200}',
+            content_type='application/json')
+        self.assertEqual(response.json()['matches'], [])
+        comparison.remove_pokemon(0, 1)
+        comparison.add_pokemon(Pokemon.objects.create(
+            name='mon100', base_experience=100,
+            picture_url='http://example.com/mon.png'), 1)
+        response = self.client.post(
+            url, '{"wanted_base_experience": 200}',
+            content_type='application/json')
+        data = response.json()
+        self.assertEqual(data['pokemons'], ['mon100'])
+        self.assertEqual(
+            [(m['user'], m['pokemons']) for m in data['matches']],
+            [('misty', ['mon190'])])
+        self.assertAlmostEqual(data['matches'][0]['unfairness'], 10 / 190)
+        self.assertEqual(self.client.get(url).json(), data)
+
+        self.client.delete('/api/comparisons/{}'.format(comparison_id))
+        self.assertFalse(
+            TradeOffer.objects.filter(comparison_id=comparison_id).exists())
+
+
+class ConditionalGetTest(ViewTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create(username='ash')
+        self.client.force_login(self.user)
+        self.comparison = self.create_comparison(
+            self.user, ['pikachu'], ['ditto'])
+        self.url = '/comparison/{}'.format(self.comparison.id)
+        # Pages are only validated for clients with a CSRF cookie.
+        self.client.get(self.url)
+
+    def get_again(self, url, response):
+        return self.client.get(
+            url, HTTP_IF_NONE_MATCH=response['ETag'],
+            HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+
+    def test_comparison_not_modified(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('no-cache', response['Cache-Control'])
+
+        # Session, user and the comparison version.
+        with self.assertNumQueries(3):
+            again = self.get_again(self.url, response)
+
+        self.assertEqual(again.status_code, 304)
+        self.assertEqual(again['ETag'], response['ETag'])
+
+    def test_comparison_modified(self):
+        response = self.client.get(self.url)
+        for change in [
+                lambda: self.comparison.add_pokemon(
+                    Pokemon.objects.get(name='ditto'), 1),
+                lambda: self.comparison.remove_pokemon(0, 1),
+                lambda: self.comparison.reset_list(2)]:
+            change()
+
+            again = self.get_again(self.url, response)
+
+            self.assertEqual(again.status_code, 200)
+            self.assertNotEqual(again['ETag'], response['ETag'])
+            response = again
+
+    def test_comparison_with_messages(self):
+        response = self.client.get(self.url)
+        with mock.patch(
+                'poketrader.views.fetch_pokemon',
+                side_effect=PokemonNotFound('agumon')):
+            self.client.post(self.url, {
+                'pokemon_set': '1', 'pokemon_name': 'agumon'})
+
+        again = self.get_again(self.url, response)
+
+        self.assertEqual(again.status_code, 200)
+        self.assertIn('&quot;agumon.&quot;', again.content.decode())
+
+    def test_index_not_modified(self):
+        response = self.client.get('/')
+        self.assertEqual(self.get_again('/', response).status_code, 304)
+
+        self.create_comparison(self.user, ['mew'])
+        response = self.get_again('/', response)
+        self.assertEqual(response.status_code, 200)
+
+        self.comparison.delete()
+        self.assertEqual(self.get_again('/', response).status_code, 200)
+
+    def test_other_user(self):
+        response = self.client.get(self.url)
+        self.client.force_login(User.objects.create(username='gary'))
+
+        self.assertEqual(self.get_again(self.url, response).status_code, 200)
+
+
+@override_settings(CACHES=TEST_CACHES)
+class FragmentCacheTest(ViewTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create(username='ash')
+        self.client = Client(enforce_csrf_checks=True)
+        self.client.force_login(self.user)
+        self.comparison = self.create_comparison(
+            self.user, ['pikachu', 'ditto'], ['mew'])
+        self.url = '/comparison/{}'.format(self.comparison.id)
+
+    def get_page(self):
+        with CaptureQueriesContext(connection) as context:
+            content = self.client.get(self.url).content.decode()
+        item_queries = [
+            q for q in context.captured_queries
+            if 'poketrader_pokemonlistitem' in q['sql']]
+        return content, len(item_queries)
+
+    def test_lists_from_cache(self):
+        content, item_queries = self.get_page()
+        self.assertEqual(item_queries, 1)
+
+        content, item_queries = self.get_page()
+        self.assertEqual(item_queries, 0)
+        self.assertIn('<h2 class="card-title">ditto</h2>', content)
+        self.assertIn('<h2 class="card-title">mew</h2>', content)
+
+    def test_cards_shared_by_comparisons(self):
+        self.get_page()
+        pikachu = Pokemon.objects.get(name='pikachu')
+
+        key = make_template_fragment_key('pokemon_card', [
+            pikachu.name, pikachu.base_experience, pikachu.sprite_url])
+
+        self.assertIn('pikachu picture', caches['default'].get(key))
+
+    def test_changes_invalidate_lists(self):
+        self.get_page()
+        self.comparison.add_pokemon(Pokemon.objects.get(name='mew'), 1)
+        content, item_queries = self.get_page()
+        self.assertEqual(item_queries, 1)
+        self.assertEqual(content.count('<h2 class="card-title">mew</h2>'), 2)
+
+        self.comparison.reset_list(2)
+        content, _ = self.get_page()
+        self.assertEqual(content.count('<h2 class="card-title">mew</h2>'), 1)
+
+    def test_remove_with_token_of_cached_page(self):
+        self.get_page()
+        self.client.logout()
+        self.client.force_login(self.user)
+
+        content, item_queries = self.get_page()
+        token = re.search(
+            r'action="/remove/\d+" method="POST">\n'
+            r'<input type="hidden" name="csrfmiddlewaretoken" value="(\w+)"',
+            content).group(1)
+        response = self.client.post('/remove/{}'.format(self.comparison.id), {
+            'csrfmiddlewaretoken': token, 'pokemon_set': '1', 'index': '0'})
+
+        self.assertEqual(item_queries, 0)
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(
+            [p.name for p in self.get_comparison(self.user).list1], ['ditto'])
+
+
+@override_settings(CACHES=TEST_CACHES)
+class RequestMetricsTest(TestCase):
+
+    def setUp(self):
+        get_pokedex_cache().clear()
+        caches[settings.FRAGMENT_CACHE_ALIAS].clear()
+        pokemon.BREAKER.reset()
+        reset_latency_histograms()
+        self.addCleanup(reset_latency_histograms)
+        patcher = mock.patch('poketrader.pokemon.CLIENT')
+        self.client_mock = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client_mock.get_pokemon.return_value = make_api_pokemon(
+            'pikachu', 112, 25)
+        self.user = User.objects.create(username='ash')
+        self.client.force_login(self.user)
+
+    def get_timings(self, response):
+        return {
+            entry.split(';')[0]: entry
+            for entry in response['Server-Timing'].split(', ')
+        }
+
+    def test_server_timing(self):
+        with self.assertLogs('poketrader.metrics') as logs:
+            response = self.client.post('/comparison/', {
+                'pokemon_set': '1', 'pokemon_name': 'pikachu'})
+            response = self.client.get(response['Location'])
+
+        timings = self.get_timings(response)
+        self.assertIn('db', timings)
+        self.assertIn('render', timings)
+        self.assertIn('total', timings)
+        self.assertNotIn('fetch', timings)
+
+        line = json.loads(logs.records[0].getMessage())
+        self.assertEqual(line['view'], 'comparison_new')
+        self.assertEqual(line['status'], 302)
+        self.assertEqual(line['metrics']['fetch']['count'], 1)
+        self.assertEqual(line['metrics']['pokeapi']['count'], 1)
+        self.assertEqual(line['metrics']['cache_miss']['count'], 1)
+        self.assertGreater(line['metrics']['db']['count'], 0)
+
+    def test_cache_hit(self):
+        fetch_pokemon('pikachu')
+
+        with self.assertLogs('poketrader.metrics'):
+            response = self.client.post('/comparison/', {
+                'pokemon_set': '1', 'pokemon_name': 'pikachu'})
+
+        timings = self.get_timings(response)
+        self.assertEqual(timings['cache_hit'], 'cache_hit;desc="1 calls"')
+        self.assertNotIn('pokeapi', timings)
+
+    def test_metrics_view(self):
+        with self.assertLogs('poketrader.metrics'):
+            for i in range(3):
+                self.client.get('/')
+            response = self.client.get('/metrics/')
+        self.assertEqual(response.status_code, 302)
+
+        self.user.is_staff = True
+        self.user.save()
+        with self.assertLogs('poketrader.metrics'):
+            response = self.client.get('/metrics/')
+
+        histogram = response.json()['views']['index']
+        self.assertEqual(histogram['count'], 3)
+        self.assertEqual(histogram['buckets'][-1], ['+Inf', 3])
+        self.assertIn('hits', response.json()['pokedex_cache'])
+
+
+class BenchmarkTest(TestCase):
+
+    def setUp(self):
+        caches[settings.FRAGMENT_CACHE_ALIAS].clear()
+
+    def test_generate_dataset(self):
+        users = generate_dataset(
+            users=2, comparisons=3, list_size=4, species=10, seed=1)
+
+        self.assertEqual(len(users), 2)
+        comparisons = PokemonComparison.objects.filter(user__in=users)
+        self.assertEqual(comparisons.count(), 6)
+        for comparison in comparisons:
+            self.assertEqual(comparison.count1, 4)
+            self.assertEqual(comparison.count2, 4)
+            self.assertEqual(
+                comparison.base_experience1,
+                sum(p.base_experience for p in comparison.list1))
+
+    def test_generate_dataset_is_reproducible(self):
+        def names(users):
+            return [
+                c.list1_as_string() for c in
+                PokemonComparison.objects.filter(user__in=users)]
+
+        first = names(generate_dataset(users=1, comparisons=2, seed=7))
+        second = names(generate_dataset(users=1, comparisons=2, seed=7))
+
+        self.assertEqual(first, second)
+
+    def test_run_scenarios(self):
+        user = generate_dataset(users=1, comparisons=3, list_size=2)[0]
+
+        with self.assertLogs('poketrader.metrics'):
+            results = run_scenarios(user, list_size=2, iterations=2)
+
+        self.assertEqual(set(results), {
+            'index', 'comparison_get', 'comparison_post', 'remove', 'reset',
+            'delete'})
+        for result in results.values():
+            self.assertGreater(result['wall_time'], 0)
+            self.assertGreater(result['queries'], 0)
+            self.assertGreater(result['memory'], 0)
+        self.assertTrue(
+            Pokemon.objects.filter(name='new-benchmon-0').exists())
+
+
+class FakePokeAPIHandler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        self.server.paths.append(self.path)
+        name = self.path.rstrip('/').rsplit('/', 1)[-1]
+        time.sleep(self.server.delay)
+
+        if self.server.status != 200:
+            self.send_response(self.server.status)
+            self.end_headers()
+        elif name not in self.server.pokemons:
+            self.send_response(404)
+            self.end_headers()
+        else:
+            body = json.dumps({
+                'name': name,
+                'base_experience': self.server.pokemons[name],
+                'sprites': {'front_default': 'http://x/{}.png'.format(name)}
+            }).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class FakePokeAPIServer(http.server.ThreadingHTTPServer):
+    # Accepts many concurrent connections.
+    request_queue_size = 128
+
+
+def start_fake_pokeapi(test_case):
+    """
+    Starts a FakePokeAPIHandler server, stopped when the test case ends.
+    """
+    server = FakePokeAPIServer(('127.0.0.1', 0), FakePokeAPIHandler)
+    server.daemon_threads = True
+    server.block_on_close = False
+    server.pokemons = {'pikachu': 112}
+    server.paths = []
+    server.status = 200
+    server.delay = 0
+    server.url = 'http://127.0.0.1:{}/api/v2'.format(server.server_port)
+    threading.Thread(
+        target=server.serve_forever, args=(0.05,), daemon=True).start()
+    test_case.addCleanup(server.server_close)
+    test_case.addCleanup(server.shutdown)
+    return server
+
+
+@override_settings(
+    CACHES=TEST_CACHES, POKEDEX_CACHE_TIMEOUT=60, POKEDEX_STALE_TIMEOUT=60)
+class PokeAPIClientTest(TestCase):
+
+    def setUp(self):
+        get_pokedex_cache().clear()
+        pokemon.BREAKER.reset()
+        self.addCleanup(pokemon.BREAKER.reset)
+
+        self.server = start_fake_pokeapi(self)
+
+        patcher = mock.patch('poketrader.pokemon.CLIENT', PokeAPIClient(
+            self.server.url, timeout=0.5))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_fetch_pokemon(self):
+        self.assertEqual(fetch_pokemon('Pikachu'), {
+            'name': 'pikachu', 'base_experience': 112,
+            'picture_url': 'http://x/pikachu.png'
+        })
+        self.assertEqual(self.server.paths, ['/api/v2/pokemon/pikachu'])
+
+    def test_not_found(self):
+        for i in range(2):
+            with self.assertRaises(PokemonNotFound):
+                fetch_pokemon('agumon')
+
+        self.assertEqual(len(self.server.paths), 1)
+
+    def test_unavailable_not_cached(self):
+        self.server.status = 503
+
+        for i in range(2):
+            with self.assertRaises(PokeAPIUnavailable):
+                fetch_pokemon('pikachu')
+
+        self.assertEqual(len(self.server.paths), 2)
+
+    def test_timeout(self):
+        self.server.delay = 2
+
+        start = time.monotonic()
+        with self.assertRaises(PokeAPIUnavailable):
+            fetch_pokemon('pikachu')
+
+        self.assertLess(time.monotonic() - start, 1.5)
+
+    @mock.patch.object(pokemon.BREAKER, 'failure_threshold', 3)
+    def test_circuit_breaker(self):
+        self.server.status = 500
+
+        for name in ['a', 'b', 'c', 'd', 'e']:
+            with self.assertRaises(PokeAPIUnavailable):
+                fetch_pokemon(name)
+
+        self.assertEqual(len(self.server.paths), 3)
+
+        pokemon.BREAKER.opened_at -= pokemon.BREAKER.reset_timeout
+        self.server.status = 200
+
+        self.assertEqual(fetch_pokemon('pikachu')['base_experience'], 112)
+        self.assertFalse(pokemon.BREAKER.is_open)
+
+    @mock.patch.object(pokemon.BREAKER, 'failure_threshold', 3)
+    def test_not_found_keeps_circuit_closed(self):
+        for name in ['agumon', 'gabumon', 'patamon', 'tentomon']:
+            with self.assertRaises(PokemonNotFound):
+                fetch_pokemon(name)
+
+        self.assertFalse(pokemon.BREAKER.is_open)
+        self.assertEqual(fetch_pokemon('pikachu')['base_experience'], 112)
+
+    @override_settings(POKEDEX_CACHE_TIMEOUT=0)
+    def test_stale_while_revalidate(self):
+        fetch_pokemon('pikachu')
+        self.server.pokemons['pikachu'] = 120
+        threads = []
+        refresh_in_background = pokemon.refresh_in_background
+
+        def refresh(name):
+            threads.append(refresh_in_background(name))
+
+        with mock.patch(
+                'poketrader.pokemon.refresh_in_background', refresh):
+            self.assertEqual(fetch_pokemon('pikachu')['base_experience'], 112)
+            threads[0].join(5)
+            self.server.status = 503
+            self.assertEqual(fetch_pokemon('pikachu')['base_experience'], 120)
+            threads[1].join(5)
+            self.assertEqual(fetch_pokemon('pikachu')['base_experience'], 120)
+
+        self.assertEqual(len(self.server.paths), 3)
+
+
+@override_settings(CACHES=TEST_CACHES)
+class AsyncViewsTest(ViewTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.addCleanup(pokemon.BREAKER.reset)
+        self.server = start_fake_pokeapi(self)
+        self.server.pokemons.update(ditto=101, mew=64)
+        patcher = mock.patch(
+            'poketrader.pokemon.ASYNC_CLIENT',
+            AsyncPokeAPIClient(self.server.url, timeout=2))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.async_factory = AsyncRequestFactory()
+
+    def test_fetch_pokemon_async(self):
+        self.assertEqual(
+            async_to_sync(fetch_pokemon_async)('  Ditto '), {
+                'name': 'ditto', 'base_experience': 101,
+                'picture_url': 'http://x/ditto.png'
+            })
+        self.assertEqual(
+            async_to_sync(fetch_pokemon_async)('ditto')['base_experience'],
+            101)
+        self.assertEqual(self.server.paths, ['/api/v2/pokemon/ditto'])
+
+        with self.assertRaises(PokemonNotFound):
+            async_to_sync(fetch_pokemon_async)('agumon')
+        self.server.status = 503
+        with self.assertRaises(PokeAPIUnavailable):
+            async_to_sync(fetch_pokemon_async)('mew')
+
+    @mock.patch.object(pokemon.BREAKER, 'failure_threshold', 3)
+    def test_not_found_keeps_circuit_closed(self):
+        for name in ['agumon', 'gabumon', 'patamon', 'tentomon']:
+            with self.assertRaises(PokemonNotFound):
+                async_to_sync(fetch_pokemon_async)(name)
+
+        self.assertFalse(pokemon.BREAKER.is_open)
+        self.assertEqual(
+            async_to_sync(fetch_pokemon_async)('ditto')['base_experience'],
+            101)
+
+    def test_concurrent_lookups(self):
+        self.server.delay = 0.5
+        names = ['pokemon-{}'.format(i) for i in range(100)]
+        self.server.pokemons.update((name, 100) for name in names)
+
+        async def fetch_all():
+            return await asyncio.gather(*map(fetch_pokemon_async, names))
+
+        start = time.monotonic()
+        results = async_to_sync(fetch_all)()
+
+        self.assertEqual(len(results), 100)
+        self.assertLess(time.monotonic() - start, 5)
+
+    def test_post_comparison(self):
+        with self.logged_in() as user:
+            request = self.async_factory.post(
+                '/comparison', 'pokemon_set=1&pokemon_name=mew',
+                content_type='application/x-www-form-urlencoded')
+            self._set_up_request(request)
+
+            response = async_to_sync(async_views.comparison)(request, None)
+
+            comparison = self.get_comparison(user)
+            self.assertRedirect(
+                response, '/comparison/{}'.format(comparison.id))
+            self.assertEqual([p.name for p in comparison.list1], ['mew'])
+
+            request = self.async_factory.get(
+                '/comparison/{}'.format(comparison.id))
+            self._set_up_request(request)
+            response = async_to_sync(async_views.comparison)(
+                request, comparison.id)
+
+            self.assertIn('mew picture', response.content.decode())
+
+    def test_add_many(self):
+        with self.logged_in() as user:
+            request = self.async_factory.post(
+                '/add', json.dumps({
+                    'pokemon_set': 2,
+                    'pokemon_names': ['pikachu', 'agumon', 'ditto']}),
+                content_type='application/json')
+            self._set_up_request(request)
+
+            response = async_to_sync(async_views.add)(request, None)
+
+            self.assertEqual(json.loads(response.content), {
+                'comparison_id': self.get_comparison(user).id,
+                'added': ['pikachu', 'ditto'],
+                'errors': {
+                    'agumon': 'There is no such Pokémon called "agumon."'}
+            })
+
+    def test_redirect_unauthenticated(self):
+        request = self.async_factory.get('/comparison/')
+        self._set_up_request(request)
+
+        response = async_to_sync(async_views.comparison)(request, None)
+
+        self.assertRedirect(response, '/login')
+
+
+# A 1x1 transparent PNG.
+TINY_PNG = base64.b64decode(
+    'iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNkYPhfDwAChwGA'
+    '60e6kgAAAABJRU5ErkJggg==')
+
+
+class FakeImageHandler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        self.server.paths.append(self.path)
+        if self.path not in self.server.images:
+            self.send_response(404)
+            self.end_headers()
+            return
+
+        content_type, body = self.server.images[self.path]
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@override_settings(CACHES=TEST_CACHES)
+class SpriteMirrorTest(TestCase):
+
+    def setUp(self):
+        get_pokedex_cache().clear()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        settings_override = override_settings(SPRITES_ROOT=directory.name)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.root = directory.name
+
+        self.server = FakePokeAPIServer(('127.0.0.1', 0), FakeImageHandler)
+        self.server.daemon_threads = True
+        self.server.images = {'/25.png': ('image/png', TINY_PNG)}
+        self.server.paths = []
+        threading.Thread(
+            target=self.server.serve_forever, args=(0.05,),
+            daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+    def create_pokemon(self, name, path):
+        return Pokemon.objects.create(
+            name=name, base_experience=100,
+            picture_url='http://127.0.0.1:{}{}'.format(
+                self.server.server_port, path))
+
+    def test_content_addressed(self):
+        pikachu = self.create_pokemon('pikachu', '/25.png')
+        pikachu_gmax = self.create_pokemon('pikachu-gmax', '/25.png')
+
+        mirror_sprite(pikachu)
+        mirror_sprite(pikachu_gmax)
+
+        digest = hashlib.sha256(TINY_PNG).hexdigest()
+        self.assertEqual(pikachu.sprite, digest + '.png')
+        self.assertEqual(pikachu_gmax.sprite, digest + '.png')
+        self.assertEqual(os.listdir(self.root), [digest + '.png'])
+        self.assertEqual(
+            Pokemon.objects.get(name='pikachu').sprite_url,
+            '/sprites/{}.png'.format(digest))
+
+    @mock.patch('poketrader.views.mirror_in_background')
+    def test_picture_until_mirrored(self, mirror_in_background):
+        pikachu = self.create_pokemon('pikachu', '/25.png')
+        self.assertEqual(pikachu.sprite_url, pikachu.picture_url)
+
+        url = '/sprites/pokemon/{}'.format(pikachu.id)
+        response = self.client.get(url)
+        self.assertRedirects(
+            response, pikachu.picture_url, fetch_redirect_response=False)
+        mirror_in_background.assert_called_once_with([pikachu])
+        self.assertEqual(self.server.paths, [])
+
+        mirror_sprite(pikachu)
+        response = self.client.get(url)
+        self.assertRedirects(
+            response, pikachu.sprite_url, fetch_redirect_response=False)
+
+        response = self.client.get(pikachu.sprite_url)
+        self.assertEqual(b''.join(response.streaming_content), TINY_PNG)
+        self.assertEqual(response['Content-Type'], 'image/png')
+        self.assertIn('immutable', response['Cache-Control'])
+        self.assertIn('max-age=31536000', response['Cache-Control'])
+
+    def test_unavailable(self):
+        self.server.images['/evil.svg'] = ('image/svg+xml', b'<svg/>')
+        for path in ['/missing.png', '/evil.svg']:
+            pokemon = self.create_pokemon(path, path)
+
+            with self.assertRaises(SpriteUnavailable):
+                mirror_sprite(pokemon)
+            self.assertEqual(pokemon.sprite_url, pokemon.picture_url)
+
+        self.assertEqual(os.listdir(self.root), [])
+
+    @mock.patch('poketrader.views.mirror_in_background')
+    def test_mirrored_once_stored(self, mirror_in_background):
+        pokemons = {}
+        with self.captureOnCommitCallbacks(execute=True):
+            views.store_fetched_pokemons(pokemons, {'pikachu': {
+                'name': 'pikachu', 'base_experience': 112,
+                'picture_url': 'http://example.com/25.png'}})
+
+        mirror_in_background.assert_called_once_with([pokemons['pikachu']])
+
+    @mock.patch('poketrader.sprites.mirror_sprite')
+    def test_failures_not_retried_at_once(self, mirror_sprite):
+        mirror_sprite.side_effect = SpriteUnavailable('Down')
+        pokemon = self.create_pokemon('pikachu', '/25.png')
+
+        mirror_in_background([pokemon]).join()
+        self.assertIsNone(mirror_in_background([pokemon]))
+        self.assertEqual(mirror_sprite.call_count, 1)
+
+        # As if SPRITE_RETRY_TIMEOUT passed.
+        get_pokedex_cache().clear()
+        mirror_in_background([pokemon]).join()
+        self.assertEqual(mirror_sprite.call_count, 2)
+
+    @override_settings(SPRITE_MAX_BYTES=10)
+    def test_too_large(self):
+        with self.assertRaises(SpriteUnavailable):
+            mirror_sprite(self.create_pokemon('pikachu', '/25.png'))
+
+    def test_invalid_names(self):
+        for name in ['settings.py', 'abc.png', '{}.svg'.format('0' * 64)]:
+            response = self.client.get('/sprites/' + name)
+            self.assertEqual(response.status_code, 404)
+
+    @unittest.skipIf(Image is None, 'Pillow is not installed')
+    @override_settings(SPRITE_THUMBNAIL_SIZE=48)
+    def test_thumbnails(self):
+        output = io.BytesIO()
+        Image.new('RGBA', (200, 100), 'red').save(output, format='PNG')
+        self.server.images['/big.png'] = ('image/png', output.getvalue())
+        big = self.create_pokemon('big', '/big.png')
+        small = self.create_pokemon('small', '/25.png')
+
+        mirror_sprite(big)
+        mirror_sprite(small)
+
+        self.assertTrue(big.thumbnail.endswith('-48.png'))
+        self.assertEqual(big.sprite_url, '/sprites/' + big.thumbnail)
+        response = self.client.get(big.sprite_url)
+        thumbnail = Image.open(io.BytesIO(
+            b''.join(response.streaming_content)))
+        self.assertEqual(thumbnail.size, (48, 24))
+        self.assertEqual(small.thumbnail, '')
+        self.assertEqual(small.sprite_url, '/sprites/' + small.sprite)
+
+    def test_mirror_sprites_command(self):
+        self.create_pokemon('pikachu', '/25.png')
+        self.create_pokemon('agumon', '/agumon.png')
+        out, err = io.StringIO(), io.StringIO()
+
+        call_command('mirror_sprites', stdout=out, stderr=err)
+        call_command('mirror_sprites', stdout=out, stderr=err)
+
+        self.assertIn('Mirrored 1 sprites, 1 failed.', out.getvalue())
+        self.assertIn('Mirrored 0 sprites, 1 failed.', out.getvalue())
+        self.assertEqual(self.server.paths.count('/25.png'), 1)
@@ -0,0 +1,285 @@
+"""
+This module exports all the comparisons of a user, and imports them back, as
+NDJSON (one JSON object per line) or CSV. Exports are generated while they
+are sent, from chunked queries, and imports are read while they are
+received, in batches, so neither needs memory for more than a chunk of
+comparisons.
+"""
+import codecs
+import csv
+import itertools
+import json
+import math
+import operator
+
+from django.conf import settings
+from django.db import connections, router, transaction
+
+from .models import (
+    ComparisonEvent, Pokemon, PokemonComparison, PokemonListItem,
+    allocate_ids, is_sharded)
+from .pokemon import normalize_name
+
+# Columns of CSV exports. The lists are given as comma-separated names.
+CSV_FIELDS = [
+    'id', 'modified', 'list1', 'list2', 'base_experience1',
+    'base_experience2', 'fair', 'unfairness'
+]
+
+
+def get_verdict(comparison):
+    """
+    Returns the verdict on the lists of a comparison, as in
+    compare_pokemon_lists(), ready to be encoded as JSON.
+    """
+    verdict = comparison.compare(
+        fairness_threshold=settings.FAIRNESS_THRESHOLD)
+    if math.isnan(verdict['unfairness']):
+        verdict['unfairness'] = None
+    return verdict
+
+
+def iter_comparisons(user, chunk_size=None):
+    """
+    Yields a dict for each comparison of a user, oldest first, with the names
+    in each list and the verdict on them.
+
+    Comparisons and items are read by two queries, in chunks of `chunk_size`
+    rows (settings.EXPORT_CHUNK_SIZE by default), both in the order of the
+    comparisons, and merged as they are read.
+    """
+    chunk_size = chunk_size or settings.EXPORT_CHUNK_SIZE
+    # Exports are read after the request, so the shard of the user must be
+    # given.
+    using = router.db_for_read(PokemonComparison, user=user)
+    comparisons = PokemonComparison.objects.using(using).filter(
+        user=user).order_by('id').iterator(chunk_size=chunk_size)
+    items = PokemonListItem.objects.using(using).filter(
+        comparison__user=user).order_by(
+            'comparison', 'list_number', 'position').values_list(
+                'comparison', 'list_number', 'pokemon__name').iterator(
+                    chunk_size=chunk_size)
+    groups = itertools.groupby(items, key=operator.itemgetter(0))
+
+    group = next(groups, None)
+    for comparison in comparisons:
+        lists = ([], [])
+        # Items of comparisons created after the first query are skipped.
+        while group is not None and group[0] <= comparison.id:
+            if group[0] == comparison.id:
+                for _, list_number, name in group[1]:
+                    lists[list_number - 1].append(name)
+            group = next(groups, None)
+
+        yield {
+            'id': comparison.id,
+            'modified': comparison.modified.isoformat(),
+            'list1': lists[0],
+            'list2': lists[1],
+            'verdict': get_verdict(comparison)
+        }
+
+
+def export_ndjson(user):
+    """
+    Yields the lines of an NDJSON export of the comparisons of a user.
+    """
+    for record in iter_comparisons(user):
+        yield json.dumps(record) + '\n'
+
+
+class Echo:
+    """
+    A file whose writes return what is written, so that csv.writer() can
+    generate lines instead of writing them.
+    """
+
+    def write(self, value):
+        return value
+
+
+def export_csv(user):
+    """
+    Yields the lines of a CSV export of the comparisons of a user.
+    """
+    writer = csv.writer(Echo())
+    yield writer.writerow(CSV_FIELDS)
+    for record in iter_comparisons(user):
+        verdict = record['verdict']
+        yield writer.writerow([
+            record['id'], record['modified'], ', '.join(record['list1']),
+            ', '.join(record['list2']), verdict['base_experience1'],
+            verdict['base_experience2'], verdict['fair'],
+            verdict['unfairness']
+        ])
+
+
+class InvalidRecord(Exception):
+    pass
+
+
+def read_ndjson(lines):
+    """
+    Yields the lists of names in each line of an NDJSON export, or an
+    InvalidRecord exception for lines that are not comparisons. Blank lines
+    are skipped:
+
+    >>> list(read_ndjson([b'{"list1": ["ditto"], "list2": []}\\n', b'\\n']))
+    [(['ditto'], [])]
+    >>> list(read_ndjson([b'{"list1": "ditto"}']))
+    [InvalidRecord('Invalid comparison.')]
+    """
+    for line in lines:
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            yield InvalidRecord('Invalid JSON.')
+            continue
+
+        lists = isinstance(record, dict) and (
+            record.get('list1', []), record.get('list2', []))
+        if not lists or not all(
+                isinstance(names, list)
+                and all(isinstance(name, str) for name in names)
+                for names in lists):
+            yield InvalidRecord('Invalid comparison.')
+        else:
+            yield lists
+
+
+def read_csv(lines):
+    """
+    Yields the lists of names in each row of a CSV export, which needs only
+    the "list1" and "list2" columns:
+
+    >>> list(read_csv([b'list1,list2\\n', b'"pikachu, ditto",mew\\n',
+    ...                b',\\n']))
+    [(['pikachu', 'ditto'], ['mew']), ([], [])]
+
+    Reading stops at the first row that is not valid UTF-8 CSV:
+
+    >>> list(read_csv([b'list1\\n', b'ditto\\n', b'\\xff\\n']))
+    [(['ditto'], []), InvalidRecord('Invalid CSV.')]
+    """
+    try:
+        for row in csv.DictReader(codecs.iterdecode(lines, 'utf-8-sig')):
+            yield tuple(
+                [name.strip() for name in (row.get(field) or '').split(',')
+                 if name.strip()]
+                for field in ('list1', 'list2'))
+    except (csv.Error, UnicodeDecodeError):
+        yield InvalidRecord('Invalid CSV.')
+
+
+def import_comparisons(user, records, batch_size=None):
+    """
+    Creates a comparison of a user for each pair of lists of names in
+    `records`, as yielded by read_ndjson() or read_csv().
+
+    Records are imported in batches of `batch_size` (settings.
+    IMPORT_BATCH_SIZE by default), each one in a transaction that looks up
+    the pokémons of the whole batch in a single query and creates the
+    comparisons and their items with bulk inserts. Pokémons are not fetched
+    from the PokéAPI: names not in the database are left out.
+
+    Returns the number of comparisons created and a list of errors, each one
+    with the number of its record, starting from 1.
+    """
+    batch_size = batch_size or settings.IMPORT_BATCH_SIZE
+    created = 0
+    errors = []
+
+    numbered = enumerate(records, 1)
+    while True:
+        batch = list(itertools.islice(numbered, batch_size))
+        if not batch:
+            break
+
+        valid = []
+        for number, record in batch:
+            if isinstance(record, InvalidRecord):
+                errors.append({'record': number, 'error': str(record)})
+            else:
+                valid.append((number, [
+                    [normalize_name(name) for name in names if name.strip()]
+                    for names in record]))
+
+        using = router.db_for_write(PokemonComparison, user=user)
+        with transaction.atomic(using=using):
+            created += import_batch(user, valid, errors, using)
+
+    return created, errors
+
+
+def import_batch(user, records, errors, using):
+    """
+    Imports a batch of records for import_comparisons() into the database
+    `using`, adding the names not found to `errors`. Returns the number of
+    comparisons created.
+    """
+    pokemons = Pokemon.objects.filter(name__in={
+        name for _, lists in records for names in lists for name in names
+    }).in_bulk(field_name='name')
+
+    comparisons = []
+    lists_by_comparison = []
+    for number, lists in records:
+        missing = sorted({
+            name for names in lists for name in names
+            if name not in pokemons})
+        if missing:
+            errors.append({
+                'record': number,
+                'error': 'Unknown pokémons: {}.'.format(', '.join(missing))
+            })
+
+        lists = [[pokemons[name] for name in names if name in pokemons]
+                 for names in lists]
+        comparisons.append(PokemonComparison(
+            user=user,
+            base_experience1=sum(p.base_experience for p in lists[0]),
+            base_experience2=sum(p.base_experience for p in lists[1]),
+            count1=len(lists[0]), count2=len(lists[1])))
+        lists_by_comparison.append(lists)
+
+    create_comparisons(comparisons, using)
+    items = []
+    # The history of each comparison starts with its imported lists.
+    events = []
+    for comparison, lists in zip(comparisons, lists_by_comparison):
+        events.append(ComparisonEvent(
+            comparison=comparison, version=0, kind=ComparisonEvent.START))
+        for list_number, names in enumerate(lists, 1):
+            for position, pokemon in enumerate(names):
+                items.append(PokemonListItem(
+                    comparison=comparison, list_number=list_number,
+                    position=position, pokemon=pokemon))
+                events.append(ComparisonEvent(
+                    comparison=comparison, version=0,
+                    kind=ComparisonEvent.ADD, list_number=list_number,
+                    position=position, pokemon=pokemon))
+    PokemonListItem.objects.using(using).bulk_create(
+        items, batch_size=settings.IMPORT_BATCH_SIZE)
+    ComparisonEvent.objects.using(using).bulk_create(
+        events, batch_size=settings.IMPORT_BATCH_SIZE)
+    return len(comparisons)
+
+
+def create_comparisons(comparisons, using):
+    """
+    Inserts new comparisons, with a single query if their ids are allocated
+    across shards or the database tells the ids of the rows inserted in
+    bulk.
+    """
+    if is_sharded():
+        ids = allocate_ids(PokemonComparison, len(comparisons))
+        for comparison, comparison_id in zip(comparisons, ids):
+            comparison.id = comparison_id
+        PokemonComparison.objects.using(using).bulk_create(comparisons)
+    elif connections[using].features.can_return_rows_from_bulk_insert:
+        PokemonComparison.objects.using(using).bulk_create(comparisons)
+    else:
+        for comparison in comparisons:
+            comparison.save(using=using)
@@ -1,7 +1,10 @@
+from django.conf import settings
 from django.urls import path, include
 from django.contrib import admin
 from django.contrib.auth.views import LoginView, LogoutView
 
+import poketrader.api
+import poketrader.async_views
 import poketrader.views
 
 # To add a new path, first import the app:
@@ -12,17 +15,62 @@ import poketrader.views
 #
 # Learn more here: https://docs.djangoproject.com/en/2.1/topics/http/urls/
 
+# Views that call the PokéAPI, served asynchronously under ASGI.
+fetching_views = (
+    poketrader.async_views if settings.ASYNC_VIEWS else poketrader.views)
+
 urlpatterns = [
     path("", poketrader.views.index, name="index"),
     path(
-        "comparison/", poketrader.views.comparison,
+        "comparison/", fetching_views.comparison,
         kwargs={'comparison_id': None}, name="comparison_new"),
     path(
-        "comparison/<int:comparison_id>", poketrader.views.comparison,
+        "comparison/<int:comparison_id>", fetching_views.comparison,
         name="comparison"),
+    path(
+        "add/", fetching_views.add, kwargs={'comparison_id': None},
+        name="add_new"),
+    path("add/<int:comparison_id>", fetching_views.add, name="add"),
     path("reset/<int:comparison_id>", poketrader.views.reset, name="reset"),
     path("remove/<int:comparison_id>", poketrader.views.remove, name="remove"),
     path("delete/<int:comparison_id>", poketrader.views.delete, name="delete"),
+    path("undo/<int:comparison_id>", poketrader.views.undo, name="undo"),
+    path("api/comparisons/", poketrader.api.create, name="api_create"),
+    path(
+        "api/comparisons/export", poketrader.api.export_comparisons,
+        name="api_export"),
+    path(
+        "api/comparisons/import", poketrader.api.import_comparisons,
+        name="api_import"),
+    path(
+        "api/comparisons/<int:comparison_id>", poketrader.api.comparison,
+        name="api_comparison"),
+    path(
+        "api/comparisons/<int:comparison_id>/add", poketrader.api.add,
+        name="api_add"),
+    path(
+        "api/comparisons/<int:comparison_id>/remove", poketrader.api.remove,
+        name="api_remove"),
+    path(
+        "api/comparisons/<int:comparison_id>/reset", poketrader.api.reset,
+        name="api_reset"),
+    path(
+        "api/comparisons/<int:comparison_id>/undo", poketrader.api.undo,
+        name="api_undo"),
+    path(
+        "api/comparisons/<int:comparison_id>/history",
+        poketrader.api.comparison_history, name="api_history"),
+    path(
+        "api/comparisons/<int:comparison_id>/offer", poketrader.api.offer,
+        name="api_offer"),
+    path(
+        "sprites/pokemon/<int:pokemon_id>", poketrader.views.pokemon_sprite,
+        name="pokemon_sprite"),
+    path("sprites/<str:name>", poketrader.views.sprite, name="sprite"),
+    path(
+        "autocomplete/", poketrader.views.autocomplete_names,
+        name="autocomplete"),
+    path("metrics/", poketrader.views.metrics_view, name="metrics"),
     path('login/', LoginView.as_view(), name="login"),
     path('logout/', LogoutView.as_view(), name="logout"),
     path("admin/", admin.site.urls)
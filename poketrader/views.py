@@ -1,23 +1,104 @@
+import hashlib
+import json
+import mimetypes
+import re
+from concurrent.futures import ThreadPoolExecutor
+
 from django.shortcuts import render, get_object_or_404
-from django.http import HttpResponse, HttpResponseRedirect
+from django.conf import settings
+from django.db import router, transaction
+from django.utils.functional import SimpleLazyObject
+from django.http import (
+    FileResponse, Http404, HttpResponse, HttpResponseRedirect,
+    HttpResponseBadRequest, JsonResponse)
 from django.contrib import messages
+from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth.decorators import login_required
+from django.db.models import Count, Max, Sum
+from django.utils.cache import patch_cache_control
+from django.views.decorators.cache import cache_control
 from django.views.decorators.http import (
-    require_GET, require_POST, require_http_methods)
+    require_GET, require_POST, require_http_methods, condition)
 
+from . import autocomplete, history, matching, metrics, sharding
 from .models import Pokemon, PokemonComparison
-from .pokemon import fetch_pokemon, compare_pokemon_lists, APIException
+from .pokemon import (
+    fetch_pokemon, normalize_name, APIException, CACHE_STATS)
+from .sprites import get_sprite_storage, mirror_in_background, NAME_PATTERN
+from .suggestions import suggest_additions
 from .utils import as_percent, get_best_list
 
 
+def conditional_page(get_state):
+    """
+    Makes a view answer 304 Not Modified to GET requests from clients that
+    already have the current page, as told by the If-None-Match or
+    If-Modified-Since headers.
+
+    get_state(request, ...) is called with the arguments of the view. It
+    should cheaply return a key that changes whenever the page data changes
+    and the time of the last change, or (None, None) if the page should be
+    rendered anyway. Pages with messages to show, or for clients without a
+    CSRF cookie, are always rendered.
+    """
+    def get_validators(request, *args, **kwargs):
+        if not hasattr(request, 'page_validators'):
+            request.page_validators = None, None
+            csrf_cookie = request.META.get('CSRF_COOKIE')
+            if (request.method == 'GET' and csrf_cookie
+                    and not len(messages.get_messages(request))):
+                key, modified = get_state(request, *args, **kwargs)
+                if key is not None:
+                    etag = hashlib.sha1('{}:{}:{}'.format(
+                        key, request.user.pk, csrf_cookie).encode()
+                    ).hexdigest()
+                    request.page_validators = etag, modified
+        return request.page_validators
+
+    def decorator(view):
+        return cache_control(private=True, no_cache=True)(condition(
+            etag_func=lambda *a, **kw: get_validators(*a, **kw)[0],
+            last_modified_func=lambda *a, **kw: get_validators(*a, **kw)[1]
+        )(view))
+
+    return decorator
+
+
+def get_index_state(request):
+    state = PokemonComparison.objects.filter(user=request.user).aggregate(
+        count=Count('id'), versions=Sum('version'), modified=Max('modified'))
+    if state['modified'] is None:
+        return None, None
+    return (
+        '{count}:{versions}:{modified}'.format(**state), state['modified'])
+
+
+def get_comparison_state(request, comparison_id):
+    state = PokemonComparison.objects.filter(id=comparison_id).values_list(
+        'version', 'modified').first()
+    if state is None:
+        return None, None
+    version, modified = state
+    return '{}:{}'.format(comparison_id, version), modified
+
+
 @login_required
 @require_GET
+@conditional_page(get_index_state)
 def index(request):
-    comparisons = PokemonComparison.objects.filter(user=request.user)
+    try:
+        before = int(request.GET['before']) if 'before' in request.GET else None
+    except ValueError:
+        return HttpResponseBadRequest('Invalid page.')
 
-    return render(request, 'index.html', {
-        'comparisons': comparisons
-    })
+    comparisons, next_before = PokemonComparison.objects.filter(
+        user=request.user).with_lists().keyset_page(
+            before, size=settings.COMPARISONS_PER_PAGE)
+
+    with metrics.timed('render'):
+        return render(request, 'index.html', {
+            'comparisons': comparisons, 'next_before': next_before
+        })
 
 
 @login_required
@@ -35,10 +116,8 @@ def reset(request, comparison_id):
     pokemon_set = request.POST['pokemon_set']
     comparison = get_object_or_404(PokemonComparison, id=comparison_id)
 
-    if pokemon_set == '1':
-        comparison.list_items1.clear()
-    elif pokemon_set == '2':
-        comparison.list_items2.clear()
+    if pokemon_set in ('1', '2'):
+        comparison.reset_list(int(pokemon_set))
 
     return HttpResponseRedirect('/comparison/{}'.format(comparison_id))
 
@@ -50,20 +129,97 @@ def remove(request, comparison_id):
     index = int(request.POST['index'])
     comparison = get_object_or_404(PokemonComparison, id=comparison_id)
 
-    if pokemon_set == '1':
-        list = comparison.list_items1
-    elif pokemon_set == '2':
-        list = comparison.list_items2
-    items = list.all()
-    list.remove(items[index])
+    if pokemon_set in ('1', '2'):
+        comparison.remove_pokemon(index, int(pokemon_set))
+
+    return HttpResponseRedirect('/comparison/{}'.format(comparison_id))
+
+
+@login_required
+@require_POST
+def undo(request, comparison_id):
+    comparison = get_object_or_404(PokemonComparison, id=comparison_id)
+
+    if not history.undo(comparison):
+        messages.add_message(request, messages.INFO, 'Nothing to undo.')
 
     return HttpResponseRedirect('/comparison/{}'.format(comparison_id))
 
 
+@login_required
+@require_POST
+def add(request, comparison_id):
+    """
+    Adds many pokémons to a list at once. Names come either from the
+    "pokemon_name" form fields, each of which may hold many names separated
+    by commas, or from a JSON object such as
+
+        {"pokemon_set": 1, "pokemon_names": ["pikachu", "ditto"]}
+
+    in which case the response is a JSON object with the comparison id, the
+    names added and the errors for the names that could not be added.
+    """
+    arguments = parse_add_request(request)
+    if isinstance(arguments, HttpResponse):
+        return arguments
+    is_json, list_number, names = arguments
+
+    comparison, added, errors = add_pokemons_by_name(
+        request.user, comparison_id, names, list_number)
+
+    return respond_to_add(request, is_json, comparison, added, errors)
+
+
+def parse_add_request(request):
+    """
+    Returns whether a request to add() is JSON, the list number and the
+    names in it, or a response to invalid requests.
+    """
+    is_json = request.content_type == 'application/json'
+
+    if is_json:
+        try:
+            data = json.loads(request.body)
+            pokemon_set = str(data['pokemon_set'])
+            names = data['pokemon_names']
+        except (ValueError, KeyError, TypeError):
+            return HttpResponseBadRequest('Invalid request.')
+        if not (isinstance(names, list)
+                and all(isinstance(n, str) for n in names)):
+            return HttpResponseBadRequest('Invalid request.')
+    else:
+        pokemon_set = request.POST.get('pokemon_set')
+        names = [
+            name for value in request.POST.getlist('pokemon_name')
+            for name in value.split(',')
+        ]
+
+    if pokemon_set not in ('1', '2'):
+        return HttpResponseBadRequest('Invalid pokémon set.')
+
+    return is_json, int(pokemon_set), names
+
+
+def respond_to_add(request, is_json, comparison, added, errors):
+    if is_json:
+        return JsonResponse({
+            'comparison_id': comparison.id,
+            'added': [p.name for p in added],
+            'errors': errors
+        })
+
+    for message in errors.values():
+        messages.add_message(
+            request, messages.ERROR, message, extra_tags='danger')
+
+    return HttpResponseRedirect('/comparison/{}'.format(comparison.id))
+
+
 @login_required
 @require_POST
 def delete(request, comparison_id):
     comparison = get_object_or_404(PokemonComparison, id=comparison_id)
+    matching.withdraw(comparison.id)
     comparison.delete()
 
     messages.add_message(
@@ -72,16 +228,90 @@ def delete(request, comparison_id):
     return HttpResponseRedirect('/')
 
 
-def handle_comparison_get_request(request, comparison_id):
-    pokemon_list1 = []
-    pokemon_list2 = []
+@require_GET
+def sprite(request, name):
+    """
+    Serves a sprite from the local mirror. Their names change with their
+    content, so they can be cached forever.
+    """
+    if not re.fullmatch(NAME_PATTERN, name):
+        raise Http404('No such sprite.')
+    try:
+        file = get_sprite_storage().open(name)
+    except FileNotFoundError:
+        raise Http404('No such sprite.')
+
+    response = FileResponse(file, content_type=mimetypes.guess_type(name)[0])
+    patch_cache_control(
+        response, public=True, max_age=365 * 24 * 3600, immutable=True)
+    return response
+
+
+@require_GET
+def pokemon_sprite(request, pokemon_id):
+    """
+    Redirects to the local copy of the sprite of a pokémon or, until it is
+    mirrored in the background, to the original picture. Pages link to those
+    directly, but used to link here.
+    """
+    pokemon = get_object_or_404(Pokemon, id=pokemon_id)
+    if not pokemon.sprite:
+        if not pokemon.picture_url:
+            raise Http404('No sprite for this pokémon.')
+        mirror_in_background([pokemon])
+        return HttpResponseRedirect(pokemon.picture_url)
+
+    response = HttpResponseRedirect(pokemon.sprite_url)
+    patch_cache_control(response, public=True, max_age=24 * 3600)
+    return response
+
 
+@require_GET
+def autocomplete_names(request):
+    """
+    Answers with the names of the pokémons that complete the "q" parameter,
+    even if mistyped, for the pokémon name inputs. Names come from an index
+    in memory (see autocomplete.get_index()), not from the database.
+    """
+    prefix = request.GET.get('q', '')
+    if len(prefix) > autocomplete.MAX_PREFIX_LENGTH:
+        names = []
+    else:
+        names = autocomplete.get_index().suggest(prefix)
+
+    response = JsonResponse({'names': names})
+    patch_cache_control(
+        response, public=True, max_age=settings.AUTOCOMPLETE_INDEX_TIMEOUT)
+    return response
+
+
+@staff_member_required
+@require_GET
+def metrics_view(request):
+    """
+    Shows the latency histograms of each view and the hits and misses of the
+    pokédex cache in this process.
+    """
+    return JsonResponse({
+        'views': metrics.get_latency_histograms(),
+        'pokedex_cache': dict(CACHE_STATS)
+    })
+
+
+@conditional_page(get_comparison_state)
+def handle_comparison_get_request(request, comparison_id):
     if comparison_id is not None:
         comparison = get_object_or_404(PokemonComparison, id=comparison_id)
-        pokemon_list1, pokemon_list2 = comparison.as_list_of_dicts()
+        # Only loaded if the lists are not in the fragment cache.
+        lists = SimpleLazyObject(comparison.as_list_of_dicts)
+        pokemon_list1 = SimpleLazyObject(lambda: lists[0])
+        pokemon_list2 = SimpleLazyObject(lambda: lists[1])
+    else:
+        comparison = PokemonComparison()
+        pokemon_list1, pokemon_list2 = [], []
 
-    comp = compare_pokemon_lists(
-        pokemon_list1, pokemon_list2, fairness_threshold=0.15)
+    comp = comparison.compare(
+        fairness_threshold=settings.FAIRNESS_THRESHOLD)
 
     base_experience1 = comp['base_experience1']
     base_experience2 = comp['base_experience2']
@@ -94,37 +324,135 @@ def handle_comparison_get_request(request, comparison_id):
     else:
         percentage = None
 
-    return render(request, 'comparison.html', {
-        'comparison_id': comparison_id if comparison_id is not None else '',
-        'pokemon_list1': pokemon_list1, 'pokemon_list2': pokemon_list2,
-        'base_experience1': base_experience1,
-        'base_experience2': base_experience2, 'fair': comp['fair'],
-        'difference': difference,
-        'best_list': get_best_list(base_experience1, base_experience2),
-        'percentage': percentage, 'success': success
-    })
+    suggested_list, suggestions, suggested_pairs = (
+        suggest_additions(
+            base_experience1, base_experience2, settings.FAIRNESS_THRESHOLD)
+        if comparison_id is not None else (None, [], []))
+
+    with metrics.timed('render'):
+        return render(request, 'comparison.html', {
+            'comparison_id': (
+                comparison_id if comparison_id is not None else ''),
+            'comparison_version': comparison.version,
+            'pokemon_list1': pokemon_list1, 'pokemon_list2': pokemon_list2,
+            'count1': comparison.count1, 'count2': comparison.count2,
+            'base_experience1': base_experience1,
+            'base_experience2': base_experience2, 'fair': comp['fair'],
+            'difference': difference,
+            'best_list': get_best_list(base_experience1, base_experience2),
+            'percentage': percentage, 'success': success,
+            'suggested_list': suggested_list,
+            'suggestions': suggestions or suggested_pairs,
+            'fragment_cache': settings.FRAGMENT_CACHE_ALIAS,
+            'fragment_timeout': settings.FRAGMENT_CACHE_TIMEOUT
+        })
 
 
 def handle_comparison_post_request(request, comparison_id):
     pokemon_set = request.POST['pokemon_set']
     pokemon_name = request.POST['pokemon_name']
 
-    user = request.user
-    if comparison_id is not None:
-        comparison = get_object_or_404(PokemonComparison, id=comparison_id)
-    else:
-        comparison = PokemonComparison.objects.create(user=user)
-
-    try:
-        pokemon, _ = Pokemon.objects.get_or_create(
-            name=pokemon_name, defaults=fetch_pokemon(pokemon_name))
+    comparison, _, errors = add_pokemons_by_name(
+        request.user, comparison_id, [pokemon_name], int(pokemon_set))
 
-        comparison.add_pokemon(pokemon, int(pokemon_set))
-
-        comparison.save()
-    except APIException as e:
+    for message in errors.values():
         messages.add_message(
-            request, messages.ERROR, e.message, extra_tags='danger')
+            request, messages.ERROR, message, extra_tags='danger')
 
     redirect_url = '/comparison/{}'.format(comparison.id)
     return HttpResponseRedirect(redirect_url)
+
+
+def add_pokemons_by_name(user, comparison_id, names, list_number):
+    """
+    Adds the pokémons with the given names to a list of a comparison, or of a
+    new one if comparison_id is None, in a single transaction.
+
+    Returns the comparison, the pokémons added and a dict from the names that
+    could not be added to the error messages.
+    """
+    names = [normalize_name(n) for n in names if n.strip()]
+    pokemons, errors = resolve_pokemons(names)
+    comparison, added = add_resolved_pokemons(
+        user, comparison_id, names, pokemons, list_number)
+    return comparison, added, errors
+
+
+def add_resolved_pokemons(user, comparison_id, names, pokemons, list_number):
+    """
+    Adds the pokémons with the given names, among the resolved `pokemons`, to
+    a list as add_pokemons_by_name() does. Returns the comparison and the
+    pokémons added.
+    """
+    comparisons = PokemonComparison.objects.using(
+        router.db_for_write(PokemonComparison, user=user))
+    with transaction.atomic(using=comparisons.db):
+        if comparison_id is not None:
+            comparison = get_object_or_404(comparisons, id=comparison_id)
+        else:
+            comparison = comparisons.create(user=user)
+
+        added = [pokemons[n] for n in names if n in pokemons]
+        comparison.add_pokemons(added, list_number)
+
+    return comparison, added
+
+
+def resolve_pokemons(names):
+    """
+    Finds the pokémons with the given names in the database. The ones not
+    stored yet are fetched from the PokéAPI concurrently, by at most
+    settings.POKEAPI_MAX_WORKERS threads, and then stored.
+
+    Returns a dict from names to pokémons and a dict from the names that could
+    not be found to the error messages.
+    """
+    pokemons, missing = find_stored_pokemons(names)
+    errors = {}
+
+    if not missing:
+        return pokemons, errors
+
+    workers = min(len(missing), settings.POKEAPI_MAX_WORKERS)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {name: executor.submit(metrics.bound(fetch_pokemon), name)
+                   for name in missing}
+
+    fetched = {}
+    for name, future in futures.items():
+        try:
+            fetched[name] = future.result()
+        except APIException as e:
+            errors[name] = e.message
+
+    store_fetched_pokemons(pokemons, fetched)
+    return pokemons, errors
+
+
+def find_stored_pokemons(names):
+    """
+    Returns a dict from the given names to the pokémons stored with them and
+    the set of names not stored yet.
+    """
+    names = set(names)
+    pokemons = Pokemon.objects.filter(name__in=names).in_bulk(
+        field_name='name')
+    return pokemons, names - set(pokemons)
+
+
+def store_fetched_pokemons(pokemons, fetched):
+    """
+    Stores the pokémons fetched by name, ignoring the ones some other request
+    stored meanwhile, and adds them to `pokemons` by the same names. Their
+    sprites are mirrored in the background once they are committed.
+    """
+    Pokemon.objects.bulk_create(
+        [Pokemon(**data) for data in fetched.values()], ignore_conflicts=True)
+    stored = Pokemon.objects.filter(
+        name__in=[data['name'] for data in fetched.values()]).in_bulk(
+            field_name='name')
+    for name, data in fetched.items():
+        pokemons[name] = stored[data['name']]
+    sharding.replicate_catalog([p.pk for p in stored.values()])
+    unmirrored = [p for p in stored.values() if not p.sprite]
+    transaction.on_commit(lambda: mirror_in_background(unmirrored))